@@ -10,10 +10,10 @@ import time
 
 from ginga import AstroImage
 from ginga.canvas.CanvasObject import get_canvas_types
-from ginga.util.toolbox import ModeIndicator
-from ginga.util import plots
+from ginga.misc import Callback
 
-import ZView
+from gview import ZView
+from gview import timing
 
 
 class FitsViewer(object):
@@ -24,6 +24,7 @@ class FitsViewer(object):
         self.zv = zv
         self.name = name
         self.app = gv.app
+        self.timing = gv.timing
         ## self.drawcolors = colors.get_colors()
         self.dc = get_canvas_types()
 
@@ -45,9 +46,11 @@ class FitsViewer(object):
         fi.show_pan_mark(True)
         fi.set_callback('drag-drop', self.drop_file)
         fi.set_callback('none-move', self.motion)
+        fi.add_callback('none-move', self.zv.track_cursor)
         fi.set_bg(0.2, 0.2, 0.2)
         fi.ui_setActive(True)
         self.gw = fi
+        self.timing.instrument(fi, 'redraw_now', 'render.redraw')
 
         bd = fi.get_bindings()
         bd.enable_all(True)
@@ -77,6 +80,7 @@ class FitsViewer(object):
         ## canvas.enable_edit(True)
         canvas.set_drawtype('rectangle', color='lightblue')
         canvas.setSurface(fi)
+        canvas.add_callback('draw-event', self.zv.region_drawn_cb, self)
         self.canvas = canvas
         # add canvas to view
         fi.get_canvas().add(canvas)
@@ -99,6 +103,8 @@ class FitsViewer(object):
         fi.set_callback('keydown-gaussians-plot',
                         self.gv.plot_cmd_cb, self.zv.do_gaussians_plot,
                         "FWHM", self.viewer_w)
+        bm.map_event('zview', (), 'f', 'live-plot')
+        fi.set_callback('keydown-live-plot', self.zv.toggle_live)
 
         self.readout = Widgets.Label("")
         self.readout.set_color(bg='black', fg='lightgreen')
@@ -106,9 +112,11 @@ class FitsViewer(object):
 
         self.top.set_widget(vbox)
 
+    @timing.timed('load.file')
     def load_file(self, filepath):
         image = AstroImage.AstroImage(logger=self.logger)
         image.load_file(filepath)
+        self.zv.count_load(filepath)
 
         self.gw.set_image(image)
         self.top.set_title(filepath)
@@ -164,6 +172,10 @@ class FitsViewer(object):
     ##         val = 0.1
     ##     settings.set(scroll_zoom_acceleration=val)
 
+    def get_size(self):
+        # of the whole window, as make_viewer() takes it
+        return self.top.get_size()
+
     def closed(self, w):
         self.logger.info("viewer '%s' closed." % (self.name))
         self.zv.delete_viewer(self.name)
@@ -179,6 +191,8 @@ class GView(object):
         self.histlimit = 5000
         self._plot_w = None
 
+        self.timing = timing.Timing(logger)
+
         self.zv = ZView.ZView(logger, self)
 
         from ginga.gw import Widgets, GwHelp
@@ -247,6 +261,19 @@ class GView(object):
         self._plot_w.set_widget(pw)
         self._plot_w.show()
 
+    def set_plot_title(self, title):
+        if self._plot_w is not None:
+            self._plot_w.set_title(title)
+
+    def make_timer(self, ival_sec, expire_cb):
+        from ginga.gw import GwHelp
+        if not issubclass(GwHelp.Timer, Callback.Callbacks):
+            # ginga <= 2.6
+            return GwHelp.Timer(ival_sec, expire_cb)
+        timer = GwHelp.Timer(ival_sec)
+        timer.add_callback('expired', expire_cb)
+        return timer
+
     def delete_viewer(self, viewer):
         viewer.top.delete()
 
@@ -263,14 +290,17 @@ class GView(object):
         cmd, args = args[0], args[1:]
 
         try:
-            method = getattr(self.zv, "cmd_" + cmd.lower())
+            # commands like "save-session" map to cmd_save_session()
+            attrname = "cmd_" + cmd.lower().replace('-', '_')
+            method = getattr(self.zv, attrname)
 
         except AttributeError:
             self.log("!! No such command: '%s'" % (cmd))
             return
 
         try:
-            res = method(*args)
+            with self.timing.measure('cmd.' + cmd.lower()):
+                res = method(*args)
             if res is not None:
                 self.log(str(res))
 
@@ -290,9 +320,10 @@ class GView(object):
 
     def plot_cmd_cb(self, viewer, event, data_x, data_y, fn, title, viewer_w):
         try:
-            fn(viewer, event, data_x, data_y)
+            with self.timing.measure('key.' + fn.__name__):
+                fn(viewer, event, data_x, data_y)
 
-            self._plot_w.set_title(title)
+            self.set_plot_title(title)
         finally:
             # this keeps the focus on the viewer widget, in case a new
             # window was popped up
@@ -316,6 +347,9 @@ class GView(object):
                                     autoscroll=True)
 
     def quit(self):
+        self.zv.stop_live()
+        self.zv.stop_track()
+        self.zv.stop_metrics()
         self.ev_quit.set()
         self.top.delete()
 
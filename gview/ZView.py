@@ -16,10 +16,16 @@ Examples:
 """
 import time
 import os
+import glob
+
+import numpy
 
 from ginga.misc import Bunch
-from ginga import AstroImage, colors
-from ginga.util import plots, iqcalc, wcs
+from ginga import AstroImage
+
+from gview import (combine, timing, viewsync, rendercache, session, hindex,
+                   asyncrender, metrics, storage, regions, psfmap, cube,
+                   crclean, align, parallel, buffers, export, phot)
 
 
 class ZView(object):
@@ -27,6 +33,7 @@ class ZView(object):
     def __init__(self, logger, gv):
         self.logger = logger
         self.gv = gv
+        self.timing = gv.timing
 
         self.viewers = Bunch.Bunch()
         # the current viewer
@@ -35,9 +42,19 @@ class ZView(object):
         self.default_viewer_width = 900
         self.default_viewer_height = 1000
 
-        self.buffers = Bunch.Bunch()
+        self.buffers = buffers.BufferStore(logger)
+        # where the data of each buffer came from, see get_buffer_source
+        self._sources = {}
+
+        # pan/zoom/cut synchronization between viewers, and blinking
+        self.sync = viewsync.ViewSync(logger)
+        self._blinkers = {}
+        # cube players and their buffer handles, by viewer name
+        self._players = {}
+        self.blink_interval = 0.5
 
-        self.iqcalc = iqcalc.IQCalc(self.logger)
+        # created on first use, see the iqcalc property
+        self._iqcalc = None
         self._plot = None
 
         # Peak finding parameters and selection criteria
@@ -57,8 +74,116 @@ class ZView(object):
 
         self.contour_radius = 10
 
+        # PSF map: default grid, and the number of the brightest peaks
+        # evaluated in each cell
+        self.psfmap_grid = self.settings.get('psfmap_grid', (4, 4))
+        self.psfmap_max_peaks = self.settings.get('psfmap_max_peaks', 25)
+
+        # named regions, see cmd_region; and the names of the regions
+        # waiting to be drawn, by viewer
+        self.regions = Bunch.Bunch()
+        self._region_pending = {}
+        self.region_color = self.settings.get('region_color', 'yellow')
+
+        # Live (cursor following) analysis: maximum updates per second
+        # and how often the GUI checks for a new result
+        self.live_max_rate = self.settings.get('live_max_rate', 10.0)
+        self.live_poll_interval = self.settings.get('live_poll_interval',
+                                                    0.05)
+        self._live = None
+        self._live_kind = 'radial'
+        self._live_timer = None
+
+        # Star tracking (see cmd_track): the tracker and the timer that
+        # updates its plot, at most track_plot_rate times per second
+        self.track_plot_rate = self.settings.get('track_plot_rate', 5.0)
+        self._tracker = None
+        self._track_timer = None
+
+        # Image combining parameters
+        self.combine_nsigma = self.settings.get('combine_nsigma', 3.0)
+        self.combine_mem_limit = self.settings.get('combine_mem_limit',
+                                                   256 * 1024 ** 2)
+        self.num_workers = self.settings.get('num_workers', None)
+        # how `rd` keeps pixels in memory, see storage.policies
+        self.rd_dtype = self.settings.get('rd_dtype', 'native')
+        # cosmic ray detection, see crclean.py
+        self.crclean_sigclip = self.settings.get('crclean_sigclip', 5.0)
+        self.crclean_sharpness = self.settings.get('crclean_sharpness', 0.5)
+        self.crclean_iterations = self.settings.get('crclean_iterations', 2)
+        # frame registration: size of the cutout correlated, and how
+        # images are shifted ('fourier' or 'spline')
+        self.align_size = self.settings.get('align_size', 512)
+        self.align_method = self.settings.get('align_method', 'fourier')
+        # aperture photometry: magnitude zero point, the most rows shown
+        # and the most positions drawn; the last results, see cmd_phot
+        self.phot_zeropoint = self.settings.get('phot_zeropoint', 25.0)
+        self.phot_max_lines = self.settings.get('phot_max_lines', 20)
+        self.phot_max_overlay = self.settings.get('phot_max_overlay', 2000)
+        self._phot = None
+        # export: default output size, color map and distribution
+        self.export_size = self.settings.get('export_size', 256)
+        self.export_cmap = self.settings.get('export_cmap', 'gray')
+        self.export_dist = self.settings.get('export_dist', 'linear')
+        # cube playback: default rate, and number of planes read ahead
+        self.play_fps = self.settings.get('play_fps', 10.0)
+        self.play_prefetch = self.settings.get('play_prefetch', 8)
+
+        # rendered output shared by all viewers
+        self.render_cache = rendercache.RenderCache(
+            logger, max_bytes=self.settings.get('render_cache_size',
+                                                128 * 1024 ** 2))
+        # build the rendered output of viewers in worker threads
+        self.render_in_thread = self.settings.get('render_in_thread', True)
+        self._renderers = {}
+
+        # FITS header index, opened on first use
+        self.hindex_path = self.settings.get('hindex_path',
+                                             hindex.get_default_path())
+        self.hindex_columns = self.settings.get(
+            'hindex_columns', ['OBJECT', 'EXPTIME', 'FILTER', 'DATE-OBS'])
+        self._hindex = None
+        self._hsearch_results = []
+
+        # counters and gauges for monitoring, see cmd_metrics
+        self.metrics = metrics.Metrics(self.timing, logger)
+        self.metrics.add_counter('files_loaded_total',
+                                 "Number of files read into buffers")
+        self.metrics.add_counter('bytes_read_total',
+                                 "Size of the files read into buffers")
+        self.metrics.add_gauge('buffers', "Number of buffers",
+                               lambda: len(self.buffers))
+        self.metrics.add_gauge('buffer_bytes',
+                               "Memory used by the data of loaded buffers",
+                               self.get_buffer_bytes)
+        self.metrics.add_gauge('viewers', "Number of viewers",
+                               lambda: len(self.viewers.keys()))
+        self.metrics.add_gauge('render_queue_depth',
+                               "Renders waiting or in progress",
+                               lambda: sum([renderer.get_queue_depth()
+                                            for renderer in
+                                            list(self._renderers.values())]))
+        self.metrics.add_gauge('live_queue_depth',
+                               "Live analysis requests waiting",
+                               lambda: (0 if self._live is None else
+                                        self._live.get_queue_depth()))
+        self.metrics.add_gauge('render_cache_bytes',
+                               "Size of the cached renders",
+                               lambda: self.render_cache.num_bytes)
+        self._metrics_server = None
+        self._metrics_writer = None
+
         self.cwd = os.getcwd()
 
+    @property
+    def iqcalc(self):
+        # the analysis and plotting modules are only loaded when needed,
+        # so that viewing an image starts as quickly as possible
+        if self._iqcalc is None:
+            from ginga.util import iqcalc
+            self._iqcalc = iqcalc.IQCalc(self.logger)
+        return self._iqcalc
+
     def log(self, text, w_time=False):
         self.gv.log(text, w_time=w_time)
 
@@ -71,18 +196,71 @@ class ZView(object):
             path = os.environ['HOME']
         else:
             path = args[0]
+        self.set_cwd(path)
+        self.cmd_pwd()
+
+    def set_cwd(self, path):
+        # the process follows, for anything opening relative paths
         os.chdir(path)
         self.cwd = os.getcwd()
-        self.cmd_pwd()
 
     def cmd_ls(self, *args):
         """ls [options]
+        ls -h [dir|glob] [kwd ...]
+
+        Execute list files command.
 
-        Execute list files command
+        With -h, list the FITS files in `dir` (default: the current
+        directory) or matching `glob` from the header index, with the
+        values of header keywords `kwd` (default: OBJECT, EXPTIME, FILTER
+        and DATE-OBS).  The directory is indexed first if needed.
         """
+        if len(args) > 0 and args[0] == '-h':
+            self.list_headers(*args[1:])
+            return
         cmd_str = ' '.join(['ls'] + list(args))
         self.gv.exec_shell(cmd_str)
 
+    def list_headers(self, *args):
+        args = list(args)
+        pattern = self.cwd
+        if len(args) > 0 and (os.path.isdir(self.get_path(args[0])) or
+                              glob.has_magic(args[0]) or
+                              hindex.is_fits_file(args[0])):
+            pattern = self.get_path(args.pop(0))
+        columns = [kwd.upper() for kwd in args]
+        if len(columns) == 0:
+            columns = self.hindex_columns
+
+        # as the index has them: absolute and normalized
+        pattern = os.path.abspath(pattern)
+        if os.path.isdir(pattern):
+            dirpath, path_glob = pattern, None
+        else:
+            dirpath, path_glob = os.path.dirname(pattern), pattern
+        with self.timing.measure('hindex.update'):
+            self.hindex.update([dirpath])
+        with self.timing.measure('hindex.query'):
+            res = self.hindex.query([], columns=columns, path_glob=path_glob)
+        res = [bnch for bnch in res
+               if os.path.normpath(os.path.dirname(bnch.path)) == dirpath]
+        self.log(self.format_headers(res, columns))
+
+    def format_headers(self, res, columns):
+        if len(res) == 0:
+            return "No files"
+        names = [os.path.relpath(bnch.path, self.cwd)
+                 if bnch.path.startswith(self.cwd + '/') else bnch.path
+                 for bnch in res]
+        rows = [['FILE'] + list(columns)]
+        for name, bnch in zip(names, res):
+            rows.append([name] + [bnch.kwds.get(kwd, '-')
+                                  for kwd in columns])
+        widths = [min(max([len(row[i]) for row in rows]), 40)
+                  for i in range(len(rows[0]))]
+        fmt = '  '.join(["%%-%d.%ds" % (width, width) for width in widths])
+        return '\n'.join([(fmt % tuple(row)).rstrip() for row in rows])
+
     def cmd_pwd(self):
         """pwd
 
@@ -91,30 +269,80 @@ class ZView(object):
         self.log("%s" % (self.cwd))
 
     def cmd_rd(self, bufname, path, *args):
-        """rd bufname path
+        """rd bufname path [native | float32 | float64]
 
         Read file from `path` into buffer `bufname`.  If the buffer does
         not exist it will be created.
 
         If `path` does not begin with a slash it is assumed to be relative
         to the current working directory.
+
+        Optional:
+        The last argument sets how the pixels are kept in memory: `native`
+        (the default) keeps integer data as it is in the file, applying
+        BSCALE/BZERO only to the parts of the image being used; `float32`
+        and `float64` convert the whole image when it is read.
         """
+        policy = self.rd_dtype
+        if len(args) > 0:
+            policy = args[0].lower()
+            if policy not in storage.policies:
+                self.log("!! Unknown data type: '%s'" % (args[0]))
+                return
         if not path.startswith('/'):
             path = os.path.join(self.cwd, path)
+        old_image = None
         if bufname in self.buffers:
             self.log("Buffer %s is in use. Will discard the previous data" % (
                 bufname))
-            image = self.buffers[bufname]
-        else:
-            # new buffer
-            image = AstroImage.AstroImage(logger=self.logger)
-            self.buffers[bufname] = image
+            if self.buffers.is_loaded(bufname):
+                old_image = self.buffers[bufname]
+        if old_image is not None:
+            # a player must not read the cube while it is replaced
+            self.stop_play_image(old_image)
+        # always a new image: handles on the buffer (see buffers.py) keep
+        # the data they were given
+        image = storage.ScaledImage(logger=self.logger)
 
         self.log("Reading file...(%s)" % (path))
-        image.load_file(path)
+        with self.timing.measure('load.file'):
+            try:
+                storage.load_file(image, path, policy=policy)
+            except storage.CubeError:
+                # read lazily, a plane at a time
+                image = cube.CubeImage(logger=self.logger)
+                cube.load_file(image, path, policy=policy)
+                self.log("%d planes, see 'slice' and 'play'" % (
+                    image.get_num_planes()))
+            except storage.StorageError as e:
+                # e.g. more than 3 dimensions; let ginga deal with it
+                self.logger.info("%s; loading it as is" % (str(e)))
+                image.load_file(path)
+        self.buffers[bufname] = image
+        if old_image is not None:
+            self.replace_in_viewers(old_image, image)
+        self.count_load(path)
+        kind = 'cube' if isinstance(image, cube.CubeImage) else 'file'
+        self.set_buffer_source(bufname, kind, path, policy=policy)
         # TODO: how to know if there is an error
         self.log("File read")
 
+    def replace_in_viewers(self, old_image, image):
+        """Show `image` in the viewers showing `old_image`, keeping their
+        pan and zoom as for a new frame in the same buffer.
+        """
+        for viewer in self.viewers.values():
+            gw = viewer.gw
+            if gw.get_image() is not old_image:
+                continue
+            settings = gw.get_settings()
+            saved = dict(autozoom=settings.get('autozoom', 'off'),
+                         autocenter=settings.get('autocenter', 'off'))
+            with gw.suppress_redraw:
+                settings.set(autozoom='off', autocenter='off')
+                gw.set_image(image)
+                settings.set(**saved)
+
     def cmd_v(self, bufname, *args):
         """v bufname [min max] [colormap]
 
@@ -136,6 +364,8 @@ class ZView(object):
             self.make_viewer("gview_0")
         gw = self._view.gw
 
+        self.stop_blink(self._view.name)
+        self.stop_play(self._view.name)
         gw.set_image(image)
 
         locut = None
@@ -233,7 +463,7 @@ class ZView(object):
         if len(args) > 0:
             cmdname = args[0].lower()
             try:
-                method = getattr(self, "cmd_" + cmdname)
+                method = getattr(self, "cmd_" + cmdname.replace('-', '_'))
                 doc = method.__doc__
                 if doc is None:
                     self.log("Sorry, no documentation found for '%s'" % (
@@ -249,7 +479,7 @@ class ZView(object):
                 if attrname.startswith('cmd_'):
                     method = getattr(self, attrname)
                     doc = method.__doc__
-                    cmdname = attrname[4:]
+                    cmdname = attrname[4:].replace('_', '-')
                     if doc is None:
                         doc = "no documentation"
                     res.append("%s: %s" % (cmdname, doc))
@@ -354,7 +584,7 @@ class ZView(object):
         for name in names:
             d = self.get_buffer_info(name)
             d.size = "%dx%d" % (d.width, d.height)
-            res.append("%(name)-10.10s  %(size)13s  %(path)s" % d)
+            res.append("%(name)-10.10s  %(size)13s  %(dtype)-8s  %(path)s" % d)
         self.log("\n".join(res))
 
     def cmd_rmb(self, *args):
@@ -364,22 +594,1271 @@ class ZView(object):
         """
         for name in args:
             if name in self.buffers:
+                self.stop_play_image(self.buffers.peek(name))
                 del self.buffers[name]
+                self._sources.pop(name, None)
             else:
                 self.log("No such buffer: '%s'" % (name))
         self.cmd_lsb()
 
+    def cmd_timing(self, *args):
+        """timing [prefix | reset | profile on [N] | profile off |
+                profile name]
+
+        Show the count and the median (p50), 95th percentile (p95) and
+        maximum latency of each instrumented operation: commands
+        (`cmd.*`), key handlers (`key.*`), file loads, analysis and
+        renders.  If `prefix` is given, only operations starting with it
+        are shown.
+
+        `reset` clears the statistics.  `profile on` runs one in every
+        `N` (default 1) calls of each operation under cProfile;
+        `profile name` shows the statistics of the last profiled call of
+        operation `name`.
+        """
+        if len(args) == 0:
+            self.log(self.timing.get_report())
+            return
+
+        subcmd = args[0].lower()
+        if subcmd == 'reset':
+            self.timing.reset()
+            self.log("Timing statistics cleared")
+
+        elif subcmd == 'profile':
+            if len(args) < 2:
+                self.log("profiling is %s" % (
+                    'on' if self.timing.profiling else 'off'))
+            elif args[1].lower() == 'on':
+                every = 1
+                if len(args) > 2:
+                    every = int(args[2])
+                self.timing.set_profiling(True, every=every)
+                self.log("profiling 1 in %d calls of each operation" % (
+                    every))
+            elif args[1].lower() == 'off':
+                self.timing.set_profiling(False)
+                self.log("profiling off")
+            else:
+                text = self.timing.get_profile(args[1])
+                if text is None:
+                    self.log("No profile recorded for '%s'" % (args[1]))
+                else:
+                    self.log(text)
+
+        else:
+            self.log(self.timing.get_report(prefix=args[0]))
+
+    def cmd_live(self, *args):
+        """live [radial | fwhm | off] [rate]
+
+        Turn on live analysis, in which the radial profile (default) or
+        FWHM plot follows the star under the cursor in any viewer, or
+        turn it off.  With no arguments, report the current state.  The
+        key 'f' in zview mode toggles live analysis.
+
+        Optional:
+        `rate` is the maximum number of plot updates per second.
+        """
+        if len(args) == 0:
+            if self._live is None:
+                self.log("live analysis is off")
+            else:
+                live = self._live
+                self.log("live %s plot at up to %.1f Hz: %d requests, "
+                         "%d dropped, %d plotted" % (
+                             self._live_kind, self.live_max_rate,
+                             live.num_submitted, live.num_dropped,
+                             live.num_done))
+            return
+
+        kind = args[0].lower()
+        if kind == 'off':
+            self.stop_live()
+            self.log("live analysis off")
+            return
+        if kind not in ('radial', 'fwhm'):
+            self.log("!! live plot type must be 'radial' or 'fwhm'")
+            return
+        if len(args) > 1:
+            self.live_max_rate = float(args[1])
+
+        self.start_live(kind)
+        self.log("live %s plot on" % (kind))
+
+    def cmd_blink(self, *args):
+        """blink buf1 buf2 ... [-i interval] | blink off
+
+        Blink the current viewer between the named buffers, switching
+        every `interval` seconds (default 0.5).  A number at the end that
+        is not the name of a buffer is also taken as the interval.  Each
+        buffer is rendered once at the current pan, zoom and color map, so
+        blinking is fast even for large images.  `blink off` (or `v`)
+        stops blinking.
+        """
+        if self._view is None:
+            self.log("No viewers")
+            return
+        args = list(args)
+        if len(args) == 1 and args[0].lower() == 'off':
+            self.stop_blink(self._view.name)
+            return
+
+        interval = self.blink_interval
+        if '-i' in args[:-1]:
+            i = args.index('-i')
+            try:
+                interval = float(args[i + 1])
+            except ValueError:
+                self.log("!! Bad interval: '%s'" % (args[i + 1]))
+                return
+            del args[i:i + 2]
+        elif len(args) > 0 and args[-1] not in self.buffers:
+            # (not a buffer: reported below if not a number either)
+            try:
+                interval = float(args[-1])
+                args.pop()
+            except ValueError:
+                pass
+
+        for name in args:
+            if name not in self.buffers:
+                self.log("!! No such buffer: '%s'" % (name))
+                return
+        if len(args) < 2:
+            self.log("!! Need at least two buffers to blink")
+            return
+
+        viewer = self._view
+        blinker = self._blinkers.get(viewer.name, None)
+        if blinker is None:
+            from gview import blink
+            blinker = blink.Blinker(viewer.gw, self.logger, self.gv.make_timer,
+                                    timing=self.timing)
+            self._blinkers[viewer.name] = blinker
+        blinker.start(args, [self.buffers[name] for name in args],
+                      interval=interval)
+        self.log("Blinking %s every %.2f sec" % (', '.join(args), interval))
+
+    def stop_blink(self, name):
+        blinker = self._blinkers.get(name, None)
+        if blinker is not None and blinker.active:
+            blinker.stop()
+
+    def cmd_slice(self, bufname, *args):
+        """slice buf [n]
+
+        Show plane `n` (counting from 0) of the cube in buffer `buf`, or
+        tell which plane is shown.
+        """
+        image = self.get_cube(bufname)
+        if image is None:
+            return
+        if len(args) == 0:
+            self.log("plane %d of %d" % (image.plane, image.get_num_planes()))
+            return
+        with self.timing.measure('cube.slice'):
+            try:
+                image.set_plane(int(args[0]))
+            except storage.StorageError as e:
+                self.log("!! %s" % (str(e)))
+
+    def cmd_play(self, *args):
+        """play buf [fps] | play off
+
+        Show the planes of the cube in buffer `buf` one after the other
+        in the current viewer, at `fps` planes per second (default 10).
+        The next planes are read, and their cut levels computed, in the
+        background.  `play off` (or `v`) stops playing.
+        """
+        if len(args) == 0 or args[0] == 'off':
+            if self._view is not None:
+                self.stop_play(self._view.name)
+            return
+        bufname = args[0]
+        image = self.get_cube(bufname)
+        if image is None:
+            return
+        fps = self.play_fps
+        if len(args) > 1:
+            fps = float(args[1])
+
+        self.cmd_v(bufname)
+        viewer = self._view
+        # keeps the cube open while it plays, even if the buffer is
+        # replaced
+        handle = self.buffers.acquire(bufname)
+        player = cube.Player(viewer.gw, handle.image, self.gv.make_timer,
+                             fps=fps, num_ahead=self.play_prefetch,
+                             logger=self.logger, timing=self.timing)
+        self._players[viewer.name] = (player, handle)
+        player.start()
+        self.log("Playing %s at %.1f planes/sec" % (bufname, fps))
+
+    def get_cube(self, bufname):
+        if bufname not in self.buffers:
+            self.log("!! No such buffer: '%s'" % (bufname))
+            return None
+        image = self.buffers[bufname]
+        if not isinstance(image, cube.CubeImage):
+            self.log("!! Buffer %s is not a cube" % (bufname))
+            return None
+        return image
+
+    def stop_play(self, name):
+        player, handle = self._players.pop(name, (None, None))
+        if player is not None:
+            player.stop()
+            handle.release()
+            self.log("played %(shown)d planes (%(late)d late, "
+                     "%(skipped)d unreadable)" % (player.get_stats()))
+
+    def stop_play_image(self, image):
+        for name, (player, handle) in list(self._players.items()):
+            if player.image is image:
+                self.stop_play(name)
+
+    def cmd_sync(self, *args):
+        """sync [on | off]
+
+        Turn on or off synchronization of pan, zoom and cut levels
+        between all viewers.  When turned on, the other viewers are
+        matched to the current one.  With no argument, report the state.
+        """
+        if len(args) == 0:
+            self.log("sync is %s" % ('on' if self.sync.enabled else 'off'))
+            return
+
+        tf = args[0].lower() == 'on'
+        self.sync.set_enabled(tf)
+        if tf and self._view is not None:
+            self.sync.sync_to(self._view.gw)
+        self.log("sync %s" % ('on' if tf else 'off'))
+
+    def cmd_cache(self, *args):
+        """cache [clear | size MB]
+
+        Show statistics of the cache of rendered images, which lets a
+        viewer show a buffer again at a recently rendered pan, zoom, cut
+        levels and color map without rendering it.  `clear` empties the
+        cache; `size` sets its maximum size in megabytes.
+        """
+        if len(args) > 0:
+            subcmd = args[0].lower()
+            if subcmd == 'clear':
+                self.render_cache.clear()
+            elif subcmd == 'size':
+                self.render_cache.set_max_bytes(
+                    int(float(args[1]) * 1024 ** 2))
+            else:
+                self.log("!! Unknown cache command: '%s'" % (args[0]))
+                return
+
+        d = self.render_cache.get_stats()
+        self.log("%(renders)d renders (%(num_bytes)d of %(max_bytes)d "
+                 "bytes), %(cuts)d cut levels; %(hits)d hits, "
+                 "%(misses)d misses" % d)
+
+    def cmd_region(self, *args):
+        """region [name [box x1 y1 x2 y2 | circle x y r |
+                polygon x1 y1 x2 y2 x3 y3 ... | draw [box|circle|polygon]]]
+        region -d name ...
+
+        Define region `name` as a box, circle or polygon with the given
+        pixel coordinates, or as the next shape drawn with the mouse in
+        the current viewer (`draw`; a box unless another kind is given).
+        The region is shown on the current viewer.  With just a name,
+        show the region; with no arguments, list the regions.
+
+        -d deletes the named regions.
+
+        Commands that take a region (e.g. `stat`) only use the pixels
+        inside it.
+        """
+        if len(args) == 0:
+            names = sorted(self.regions.keys())
+            if len(names) == 0:
+                self.log("No regions")
+                return
+            self.log("\n".join([self.format_region(self.regions[name])
+                                for name in names]))
+            return
+
+        if args[0] == '-d':
+            for name in args[1:]:
+                if name not in self.regions:
+                    self.log("No such region: '%s'" % (name))
+                    continue
+                del self.regions[name]
+                for viewer in self.viewers.values():
+                    self.remove_region_object(viewer, name)
+            return
+
+        name = args[0]
+        if len(args) == 1:
+            if name not in self.regions:
+                self.log("No such region: '%s'" % (name))
+                return
+            self.log(self.format_region(self.regions[name]))
+            if self._view is not None:
+                self.show_region(self._view, self.regions[name])
+            return
+
+        kind = args[1].lower()
+        if kind == 'draw':
+            kind = 'box'
+            if len(args) > 2:
+                kind = args[2].lower()
+            self.start_region_draw(name, kind)
+            return
+
+        try:
+            # coordinates are given as reported, but kept 0-based
+            coords = [float(arg) for arg in args[2:]]
+            region = regions.make_region(name, kind, coords,
+                                         offset=self.pixel_coords_offset)
+        except (ValueError, regions.RegionError) as e:
+            self.log("!! Bad region: %s" % (str(e)))
+            return
+        self.set_region(region)
+
+    def format_region(self, region):
+        # with coordinates as reported elsewhere
+        off = self.pixel_coords_offset
+        params = list(region.get_params())
+        if region.kind == 'circle':
+            params[0:2] = [params[0] + off, params[1] + off]
+        else:
+            params = [val + off for val in params]
+        return "%-10.10s  %-8s  %s" % (region.name, region.kind, ' '.join(
+            ["%.2f" % (val) for val in params]))
+
+    def set_region(self, region):
+        self.regions[region.name] = region
+        if self._view is not None:
+            self.show_region(self._view, region)
+        self.log(self.format_region(region))
+
+    def get_region(self, name):
+        if name not in self.regions:
+            raise regions.RegionError("No such region: '%s'" % (name))
+        return self.regions[name]
+
+    def show_region(self, viewer, region):
+        canvas = getattr(viewer, 'canvas', None)
+        if canvas is None:
+            # e.g. an offscreen viewer
+            return
+        from ginga.canvas.CanvasObject import get_canvas_types
+        self.remove_region_object(viewer, region.name)
+        obj = regions.make_canvas_object(get_canvas_types(), region,
+                                         color=self.region_color)
+        canvas.add(obj, tag='region_' + region.name)
+
+    def remove_region_object(self, viewer, name):
+        canvas = getattr(viewer, 'canvas', None)
+        if canvas is None:
+            return
+        try:
+            canvas.delete_object_by_tag('region_' + name)
+        except KeyError:
+            pass
+
+    def start_region_draw(self, name, kind):
+        drawtypes = dict(box='rectangle', circle='circle', polygon='polygon')
+        if kind not in drawtypes:
+            self.log("!! Can't draw a region of kind '%s'" % (kind))
+            return
+        viewer = self._view
+        canvas = getattr(viewer, 'canvas', None)
+        if canvas is None:
+            self.log("!! No viewer to draw in")
+            return
+        self._region_pending[viewer.name] = name
+        canvas.set_drawtype(drawtypes[kind], color=self.region_color)
+        canvas.set_draw_mode('draw')
+        canvas.enable_draw(True)
+        self.log("Draw the %s for region %s in viewer %s" % (
+            kind, name, viewer.name))
+
+    def region_drawn_cb(self, canvas, tag, viewer):
+        name = self._region_pending.pop(viewer.name, None)
+        if name is None:
+            return
+        canvas.enable_draw(False)
+        obj = canvas.get_object_by_tag(tag)
+        canvas.delete_object_by_tag(tag)
+        try:
+            region = regions.from_canvas_object(name, obj)
+        except regions.RegionError as e:
+            self.log("!! %s" % (str(e)))
+            return
+        self.set_region(region)
+
+    def cmd_stat(self, bufname, *args):
+        """stat buf [region]
+
+        Show the number of pixels, mean, median, standard deviation,
+        minimum and maximum of the image in buffer `buf`, or of the part
+        of it in region `region` (see `region`).  NaNs, and the pixels
+        replaced by `crclean`, are ignored.
+        """
+        if bufname not in self.buffers:
+            self.log("!! No such buffer: '%s'" % (bufname))
+            return
+        try:
+            if len(args) > 0:
+                image = self.buffers[bufname]
+                values = self.get_region(args[0]).get_values(
+                    image, bad=self.get_bad_pixels(image))
+                st = regions.calc_stats(values)
+            else:
+                # kept until the buffer changes
+                st = self.buffers.get_cached(bufname, 'stat',
+                                             self.calc_image_stats)
+        except regions.RegionError as e:
+            self.log("!! %s" % (str(e)))
+            return
+        self.log("npix %(npix)d  mean %(mean).4g  median %(median).4g  "
+                 "stddev %(stddev).4g  min %(min).4g  max %(max).4g" % st)
+
+    def calc_image_stats(self, image):
+        bad = self.get_bad_pixels(image)
+        wd, ht = image.get_size()
+        values = image.cutout_data(0, 0, wd, ht)
+        values = values.ravel() if bad is None else values[~bad]
+        return regions.calc_stats(values)
+
+    def cmd_psfmap(self, bufname, *args):
+        """psfmap buf [nx ny]
+
+        Split the image in buffer `buf` into a grid of `nx` x `ny` cells
+        (default 4 x 4), find the stars in each cell with the same
+        selection criteria as for a single object, and show the median
+        FWHM (pixels), ellipticity (1 - minor/major axis) and number of
+        stars in each cell.  The map is also drawn over the viewer
+        showing the buffer.
+        """
+        if bufname not in self.buffers:
+            self.log("!! No such buffer: '%s'" % (bufname))
+            return
+        nx, ny = self.psfmap_grid
+        if len(args) > 0:
+            nx = int(args[0])
+            ny = int(args[1]) if len(args) > 1 else nx
+        image = self.buffers[bufname]
+        params = self.get_star_params()
+
+        def calc(image):
+            return psfmap.calc_psfmap(image, nx, ny, params,
+                                      max_peaks=self.psfmap_max_peaks,
+                                      num_workers=self.num_workers,
+                                      bad=self.get_bad_pixels(image))
+
+        # kept until the buffer changes
+        key = ('psfmap', nx, ny, self.psfmap_max_peaks,
+               tuple(sorted(params.items())))
+        with self.timing.measure('analysis.psfmap'):
+            cells = self.buffers.get_cached(bufname, key, calc)
+
+        # top row first, as displayed
+        res = ["FWHM / ellipticity (stars) for %s, top row first" % (
+            bufname)]
+        for j in reversed(range(ny)):
+            row = cells[j * nx:(j + 1) * nx]
+            res.append('  '.join([
+                "%17s" % ("-" if cell.fwhm is None else "%.2f / %.2f (%d)" % (
+                    cell.fwhm, cell.ellipticity, cell.num))
+                for cell in row]))
+        stars = [star for cell in cells for star in cell.stars]
+        if len(stars) > 0:
+            res.append("all: FWHM %.2f  ellipticity %.2f  (%d stars)" % (
+                numpy.median([star[2] for star in stars]),
+                numpy.median([star[3] for star in stars]), len(stars)))
+        self.log('\n'.join(res))
+
+        for viewer in self.viewers.values():
+            if viewer.gw.get_image() is image:
+                self.show_psfmap(viewer, cells)
+
+    def show_psfmap(self, viewer, cells):
+        canvas = getattr(viewer, 'canvas', None)
+        if canvas is None:
+            return
+        from ginga.canvas.CanvasObject import get_canvas_types
+        try:
+            canvas.delete_object_by_tag('psfmap')
+        except KeyError:
+            pass
+        canvas.add(psfmap.make_canvas_object(get_canvas_types(), cells),
+                   tag='psfmap')
+
+    def cmd_phot(self, bufname, *args):
+        """phot buf [catalog | x y ...] r_ap r_in r_out | phot save path
+
+        Measure the flux in apertures of radius `r_ap` pixels at the
+        positions `x y ...`, or those in the first two columns of text file
+        `catalog`, in the image in buffer `buf`, less the sky taken from
+        the median in the annulus between `r_in` and `r_out`.  Magnitudes
+        are relative to the zero point setting, and the errors use the
+        GAIN keyword.  Pixels replaced by `crclean` are left out.
+
+        The apertures are drawn over the viewers showing the buffer.
+        `save` writes the last results to text file `path`.
+        """
+        if bufname == 'save':
+            if self._phot is None or len(args) == 0:
+                self.log("!! phot save path, after measuring")
+                return
+            path = self.get_path(args[0])
+            phot.save(path, self._phot.res, offset=self.pixel_coords_offset)
+            self.log("wrote %s" % (path))
+            return
+
+        if bufname not in self.buffers:
+            self.log("!! No such buffer: '%s'" % (bufname))
+            return
+        try:
+            if len(args) < 4:
+                raise ValueError("Need positions and three radii")
+            r_ap, r_in, r_out = [float(arg) for arg in args[-3:]]
+            pos = args[:-3]
+            if len(pos) == 1:
+                xs, ys = phot.read_catalog(self.get_path(pos[0]))
+            elif len(pos) % 2 == 0:
+                xs = numpy.array([float(arg) for arg in pos[0::2]])
+                ys = numpy.array([float(arg) for arg in pos[1::2]])
+            else:
+                raise ValueError("positions must be x y pairs")
+        except (ValueError, phot.PhotError) as e:
+            self.log("!! %s" % (str(e)))
+            self.log("!! phot buf [catalog | x y ...] r_ap r_in r_out")
+            return
+        off = self.pixel_coords_offset
+        image = self.buffers[bufname]
+
+        with self.timing.measure('analysis.phot'):
+            wd, ht = image.get_size()
+            try:
+                res = phot.measure(image.cutout_data(0, 0, wd, ht),
+                                   xs - off, ys - off, r_ap, r_in, r_out,
+                                   bad=self.get_bad_pixels(image),
+                                   gain=float(image.get_keyword('GAIN', 1.0)),
+                                   zeropoint=self.phot_zeropoint)
+            except phot.PhotError as e:
+                self.log("!! %s" % (str(e)))
+                return
+        self._phot = Bunch.Bunch(name=bufname, res=res)
+
+        lines = ["%9s %9s %12s %10s %10s %7s %6s %4s" % (
+            'X', 'Y', 'flux', 'error', 'sky', 'mag', 'err', 'bad')]
+        for row in res[:self.phot_max_lines]:
+            x, y, flux, flux_err, sky, sky_std, area, mag, mag_err, nbad = row
+            lines.append("%9.2f %9.2f %12.5g %10.4g %10.5g %7.3f %6.3f %4d" % (
+                x + off, y + off, flux, flux_err, sky, mag, mag_err, nbad))
+        if len(res) > self.phot_max_lines:
+            lines.append("... %d more (see 'phot save')" % (
+                len(res) - self.phot_max_lines))
+        self.log('\n'.join(lines))
+
+        for viewer in self.viewers.values():
+            if viewer.gw.get_image() is image:
+                self.show_phot(viewer, res, r_ap, r_in, r_out)
+
+    def show_phot(self, viewer, res, r_ap, r_in, r_out):
+        canvas = getattr(viewer, 'canvas', None)
+        if canvas is None:
+            return
+        from ginga.canvas.CanvasObject import get_canvas_types
+        try:
+            canvas.delete_object_by_tag('phot')
+        except KeyError:
+            pass
+        if len(res) > self.phot_max_overlay:
+            self.log("not drawing more than %d apertures" % (
+                self.phot_max_overlay))
+            return
+        canvas.add(phot.make_canvas_object(get_canvas_types(), res, r_ap,
+                                           r_in, r_out), tag='phot')
+
+    def cmd_crclean(self, bufname, *args):
+        """crclean buf [bufD] [-m maskbuf]
+
+        Find the pixels of the image in buffer `buf` hit by cosmic rays
+        and replace them by interpolating from their neighbors, along
+        with the nonzero pixels of the bad pixel mask in buffer `maskbuf`,
+        if given.  The result goes into buffer `bufD` (by default `buf`
+        itself).  The replaced pixels are remembered, and left out of
+        `stat` and object finding, until the buffer is changed.
+        """
+        args = list(args)
+        maskname = None
+        if '-m' in args:
+            i = args.index('-m')
+            maskname = args[i + 1]
+            del args[i:i + 2]
+        outbuf = args[0] if len(args) > 0 else bufname
+        for name in (bufname, maskname):
+            if name is not None and name not in self.buffers:
+                self.log("!! No such buffer: '%s'" % (name))
+                return
+        image = self.buffers[bufname]
+
+        bad = None
+        if maskname is not None:
+            mask_image = self.buffers[maskname]
+            if mask_image.get_size() != image.get_size():
+                self.log("!! Mask %s is not the size of %s" % (maskname,
+                                                               bufname))
+                return
+            wd, ht = mask_image.get_size()
+            bad = mask_image.cutout_data(0, 0, wd, ht) != 0
+
+        with self.timing.measure('analysis.crclean'):
+            data, mask = crclean.clean(image, bad=bad,
+                                       sigclip=self.crclean_sigclip,
+                                       sharpness=self.crclean_sharpness,
+                                       iterations=self.crclean_iterations,
+                                       num_workers=self.num_workers)
+        num_bad = 0 if bad is None else int(bad.sum())
+        self.log("replaced %d pixels (%d cosmic ray, %d bad)" % (
+            mask.sum(), mask.sum() - num_bad, num_bad))
+
+        processing = list(image.get('processing', []))
+        processing.append('crclean %s' % (bufname))
+        if outbuf == bufname:
+            image.set_data(data)
+        else:
+            if outbuf in self.buffers:
+                self.log("Buffer %s is in use. Will discard the previous "
+                         "data" % (outbuf))
+            kwds = combine.BufferSource(bufname, image).get_keywords()
+            image = AstroImage.AstroImage(logger=self.logger)
+            image.set_data(data)
+            image.update_keywords(kwds)
+            image.set(name=outbuf)
+            self.buffers[outbuf] = image
+            self._sources.pop(outbuf, None)
+        # (the buffer's version changes whenever its image does)
+        image.set(processing=processing,
+                  bad_pixels=Bunch.Bunch(
+                      mask=mask, buffer=outbuf,
+                      version=self.buffers.get_version(outbuf)))
+
+    def get_bad_pixels(self, image):
+        """Return the mask of the pixels replaced in `image` by crclean, or
+        None if there is none or the image has changed since.
+        """
+        bnch = image.get('bad_pixels', None)
+        if bnch is None:
+            return None
+        try:
+            version = self.buffers.get_version(bnch.buffer)
+        except KeyError:
+            return None
+        if version != bnch.version:
+            return None
+        return bnch.mask
+
+    def cmd_align(self, refname, *args):
+        """align ref buf bufD | align ref buf ... -s suffix
+
+        Find the offset of the image in buffer `buf` from the one in
+        buffer `ref` by cross-correlation, to a fraction of a pixel, and
+        put the image shifted to match `ref` into buffer `bufD`.
+
+        With `-s`, align each of the named buffers into a buffer named
+        with `suffix` appended (e.g. `align a b c d -s _al` makes b_al,
+        c_al and d_al), in parallel.
+        """
+        args = list(args)
+        suffix = None
+        if '-s' in args[:-1]:
+            i = args.index('-s')
+            suffix = args[i + 1]
+            del args[i:i + 2]
+            pairs = [(name, name + suffix) for name in args]
+        elif len(args) == 2:
+            pairs = [tuple(args)]
+        else:
+            self.log("!! align ref buf bufD | align ref buf ... -s suffix")
+            return
+        for name in [refname] + [pair[0] for pair in pairs]:
+            if name not in self.buffers:
+                self.log("!! No such buffer: '%s'" % (name))
+                return
+        # the images stay usable even if a buffer is replaced meanwhile
+        handles = [self.buffers.acquire(name)
+                   for name in [refname] + [pair[0] for pair in pairs]]
+        ref_image = handles[0].image
+        images = [handle.image for handle in handles[1:]]
+
+        def align_one(image):
+            try:
+                dx, dy, signif = align.find_offset(ref_image, image,
+                                                   size=self.align_size)
+                # one buffer per worker: don't split them further
+                data = align.shift_image(image, -dx, -dy,
+                                         method=self.align_method,
+                                         num_workers=(None if len(pairs) == 1
+                                                      else 1))
+            except align.AlignError as e:
+                return str(e)
+            return dx, dy, signif, data
+
+        try:
+            with self.timing.measure('analysis.align'):
+                results = parallel.run_parallel(align_one,
+                                                [(image,) for image in images],
+                                                num_workers=self.num_workers)
+        finally:
+            for handle in handles:
+                handle.release()
+
+        for (name, outbuf), image, res in zip(pairs, images, results):
+            if not isinstance(res, tuple):
+                self.log("!! Can't align %s: %s" % (name, res))
+                continue
+            dx, dy, signif, data = res
+            self.log("%s: offset %.3f %.3f from %s (peak %.1f sigma)" % (
+                name, dx, dy, refname, signif))
+            self.set_shifted(name, image, outbuf, data, 'align %s %s' % (
+                refname, name))
+
+    def cmd_map(self, bufname, outbuf, *args):
+        """map buf bufD [shiftx shifty]
+
+        Put the image in buffer `buf`, shifted by `shiftx`, `shifty`
+        pixels (default 0; fractions of a pixel are interpolated), into
+        buffer `bufD`.
+        """
+        if bufname not in self.buffers:
+            self.log("!! No such buffer: '%s'" % (bufname))
+            return
+        image = self.buffers[bufname]
+        dx = float(args[0]) if len(args) > 0 else 0.0
+        dy = float(args[1]) if len(args) > 1 else 0.0
+        with self.timing.measure('analysis.map'):
+            try:
+                data = align.shift_image(image, dx, dy,
+                                         method=self.align_method,
+                                         num_workers=self.num_workers)
+            except align.AlignError as e:
+                self.log("!! %s" % (str(e)))
+                return
+        self.set_shifted(bufname, image, outbuf, data, 'map %s %s %s' % (
+            bufname, dx, dy))
+
+    def set_shifted(self, bufname, image, outbuf, data, processing):
+        """Put `data`, shifted from `image` of buffer `bufname`, into
+        buffer `outbuf`, with the keywords of the original.
+        """
+        if outbuf in self.buffers:
+            self.log("Buffer %s is in use. Will discard the previous data" % (
+                outbuf))
+        kwds = combine.BufferSource(bufname, image).get_keywords()
+        new_image = AstroImage.AstroImage(logger=self.logger)
+        new_image.set_data(data)
+        new_image.update_keywords(kwds)
+        new_image.set(name=outbuf, processing=[processing])
+        self.buffers[outbuf] = new_image
+        self._sources.pop(outbuf, None)
+
+    def cmd_track(self, *args):
+        """track [x y | off | save path]
+
+        Follow the star nearest `x`, `y` in the image in the current
+        viewer.  Every time new data is put into that buffer (e.g. by `rd`)
+        the star is measured again near its predicted position, and its
+        offset from the starting position and FWHM are plotted.
+
+        With no arguments, show the drift of the star so far.  `off` stops
+        tracking and `save` writes the measurements to text file `path`.
+        """
+        tracker = self._tracker
+        if len(args) == 0:
+            if tracker is None:
+                self.log("not tracking")
+                return
+            st = tracker.get_stats()
+            if 'x' not in st:
+                self.log("%(frames)d frames, star lost in %(lost)d" % st)
+                return
+            off = self.pixel_coords_offset
+            self.log("%d frames (star lost in %d): X %.2f Y %.2f  drift "
+                     "%.2f %.2f  rms %.3f %.3f  FWHM %.2f" % (
+                         st.frames, st.lost, st.x + off, st.y + off, st.dx,
+                         st.dy, st.rms_x, st.rms_y, st.fwhm))
+            return
+
+        if args[0] == 'off':
+            self.stop_track()
+            self.log("tracking off")
+            return
+        if args[0] == 'save':
+            if tracker is None:
+                self.log("!! not tracking")
+                return
+            path = self.get_path(args[1])
+            tracker.save(path)
+            self.log("wrote %s" % (path))
+            return
+
+        if self._view is None or self._view.gw.get_image() is None:
+            self.log("!! No image in the current viewer")
+            return
+        x = float(args[0]) - self.pixel_coords_offset
+        y = float(args[1]) - self.pixel_coords_offset
+        gw = self._view.gw
+        try:
+            qs = self.find_objects(gw, x, y)[0]
+        except Exception as e:
+            self.log("!! No star found: %s" % (str(e)))
+            return
+
+        bufname = self.get_buffer_name(gw.get_image())
+        if bufname is None:
+            self.log("!! The image in the current viewer is not in a buffer")
+            return
+
+        from gview import track
+        self.stop_track()
+        self._tracker = track.Tracker(self.buffers, bufname, qs.objx,
+                                      qs.objy, qs.fwhm, timing=self.timing)
+        self.get_plot('track')
+        if self._track_timer is None:
+            self._track_timer = self.gv.make_timer(
+                1.0 / self.track_plot_rate, self.track_plot_cb)
+        self._track_timer.start()
+        self.log("tracking star at X %.2f Y %.2f (FWHM %.2f)" % (
+            qs.objx + self.pixel_coords_offset,
+            qs.objy + self.pixel_coords_offset, qs.fwhm))
+
+    def stop_track(self):
+        if self._tracker is not None:
+            self._tracker.stop()
+            self._tracker = None
+        if self._track_timer is not None:
+            self._track_timer.cancel()
+
+    def track_plot_cb(self, timer):
+        tracker = self._tracker
+        if tracker is None:
+            return
+        if tracker.has_new():
+            self.get_plot('track').show_track(tracker.get_series(),
+                                              tracker.x0, tracker.y0)
+        timer.start()
+
+    def cmd_export(self, name, pattern, *args):
+        """export buf|glob out_pattern [size] [cmap] [dist]
+
+        Render the image in buffer `buf`, or the FITS files matching
+        `glob`, to PNG or JPEG files, with zscale cut levels, color map
+        `cmap` and color distribution `dist`, fitted in `size` x `size`
+        pixels (default 256; 0 for full size).
+
+        `out_pattern` may contain %(name)s (the buffer name or file name
+        without extension) and %(n)d (the number of the image), e.g.
+        `thumbs/%(name)s.jpg`; or it can be a directory, into which PNG
+        files named after the images are written.
+        """
+        from ginga import cmap, ColorDist
+
+        size, cm_name, dist = (self.export_size, self.export_cmap,
+                               self.export_dist)
+        for arg in args:
+            if arg.isdigit():
+                size = int(arg) if int(arg) > 0 else None
+            elif arg in ColorDist.get_dist_names():
+                dist = arg
+            elif arg in cmap.get_names():
+                cm_name = arg
+            else:
+                self.log("!! Unknown color map or distribution: '%s'" % (
+                    arg))
+                return
+
+        if name in self.buffers:
+            image = self.buffers[name]
+            srcs = [(name, export.decimate_image(image, size))]
+        else:
+            paths = self.expand_paths(name)
+            if len(paths) == 0:
+                self.log("!! No such buffer or file: '%s'" % (name))
+                return
+            srcs = [(export.get_name(path), path) for path in paths]
+
+        pattern = self.get_path(pattern)
+        if len(srcs) > 1 and '%(' not in pattern and \
+               not (pattern.endswith('/') or os.path.isdir(pattern)):
+            self.log("!! Need %(name)s or %(n)d in the output pattern, or "
+                     "a directory, for more than one image")
+            return
+        items = [(src, export.get_out_path(pattern, src_name, i))
+                 for i, (src_name, src) in enumerate(srcs)]
+
+        time_start = timing.clock()
+        with self.timing.measure('export.render'):
+            try:
+                errors = export.export(items, size=size, cmap=cm_name,
+                                       dist=dist,
+                                       num_workers=self.num_workers)
+            except export.ExportError as e:
+                self.log("!! %s" % (str(e)))
+                return
+        for msg in errors:
+            self.log("!! %s" % (msg))
+        self.log("Exported %d images in %.2f sec" % (
+            len(items) - len(errors), timing.clock() - time_start))
+
+    def cmd_psprint(self, *args):
+        """psprint [path]
+
+        Write the image in the current viewer, with its cut levels, color
+        map and distribution, to an encapsulated PostScript file `path`
+        (default gview.eps).  A .png or .jpg file can be written as well.
+        """
+        if self._view is None:
+            self.log("No viewers")
+            return
+        gw = self._view.gw
+        image = gw.get_image()
+        if image is None:
+            self.log("!! No image in viewer %s" % (self._view.name))
+            return
+        path = self.get_path(args[0] if len(args) > 0 else 'gview.eps')
+        rgbmap = gw.get_rgbmap()
+        wd, ht = image.get_size()
+        try:
+            export.render(image.cutout_data(0, 0, wd, ht), wd, ht, path,
+                          cmap=rgbmap.get_cmap().name,
+                          dist=rgbmap.get_hash_algorithm(),
+                          cuts=gw.get_cut_levels())
+        except (export.ExportError, IOError) as e:
+            self.log("!! %s" % (str(e)))
+            return
+        self.log("Wrote %s" % (path))
+
     def cmd_rm(self, *args):
         """command to be deprecated--use 'rmb'
         """
         self.log("warning: this command will be deprecated--use 'rmb'")
         self.cmd_rmb(*args)
 
+    def cmd_combine(self, outbuf, *args):
+        """combine outbuf buf|glob ... [median|mean|clip]
+
+        Combine the images in the named buffers and/or the FITS files
+        matching the glob patterns into buffer `outbuf`.  All frames must
+        have the same dimensions.
+
+        Optional:
+        The last argument selects the combining method: `median`
+        (default), `mean` or `clip` (sigma-clipped mean).
+        """
+        args = list(args)
+        method = 'median'
+        if len(args) > 0 and args[-1].lower() in combine.methods:
+            method = args.pop().lower()
+
+        sources = []
+        try:
+            for name in args:
+                if name in self.buffers:
+                    # the frame stays usable even if the buffer is
+                    # replaced while combining
+                    handle = self.buffers.acquire(name)
+                    sources.append(combine.BufferSource(name, handle.image,
+                                                        handle=handle))
+                    continue
+
+                paths = self.expand_paths(name)
+                if len(paths) == 0:
+                    self.log("!! No such buffer or file: '%s'" % (name))
+                    return
+                for path in paths:
+                    sources.append(combine.FileSource(path))
+
+            if len(sources) < 2:
+                self.log("!! Need at least two frames to combine")
+                return
+
+            self.log("Combining %d frames (%s)..." % (len(sources), method))
+            data = combine.combine(sources, method=method,
+                                   nsigma=self.combine_nsigma,
+                                   mem_limit=self.combine_mem_limit,
+                                   num_workers=self.num_workers,
+                                   logger=self.logger)
+            kwds = sources[0].get_keywords()
+
+        finally:
+            for src in sources:
+                src.close()
+
+        image = AstroImage.AstroImage(logger=self.logger)
+        image.set_data(data)
+        kwds.update(dict(NCOMBINE=len(sources), COMBTYPE=method.upper()))
+        image.update_keywords(kwds)
+        image.set(name=outbuf, processing=['combine %s %s' % (
+            method, ' '.join(args))])
+        if outbuf in self.buffers:
+            self.log("Buffer %s is in use. Will discard the previous data" % (
+                outbuf))
+        self.buffers[outbuf] = image
+        self._sources.pop(outbuf, None)
+        self.log("Combined %d frames into buffer %s" % (len(sources), outbuf))
+
+    def cmd_save_session(self, *args):
+        """save-session [path]
+
+        Save the buffers and viewers, with their view settings, so that
+        they can be brought back with `load-session` or the --restore
+        option.  Buffers read from files are recorded by path; other
+        buffers are saved as .npy files.  The default `path` is
+        ~/.gview/session.
+        """
+        path = session.get_default_path()
+        if len(args) > 0:
+            path = self.get_path(args[0])
+        num_written = session.save_session(self, path)
+        self.log("Saved session in %s (%d buffers written)" % (
+            path, num_written))
+
+    def cmd_load_session(self, *args):
+        """load-session [path]
+
+        Restore a session saved with `save-session`.  Buffers are only
+        read when first used, except the ones shown in viewers.  The
+        default `path` is ~/.gview/session.
+        """
+        path = session.get_default_path()
+        if len(args) > 0:
+            path = self.get_path(args[0])
+        num_buffers, num_viewers = session.load_session(self, path)
+        self.log("Restored %d buffers and %d viewers from %s" % (
+            num_buffers, num_viewers, path))
+
+    @property
+    def hindex(self):
+        if self._hindex is None:
+            self._hindex = hindex.HeaderIndex(self.hindex_path, self.logger,
+                                              num_workers=self.num_workers)
+        return self._hindex
+
+    def cmd_hindex(self, *args):
+        """hindex [-r] [dir ...]
+
+        Add the FITS headers of the files in the directories `dir` to the
+        header index searched by `hsearch` and `ls -h`, or bring them up
+        to date; only new or changed files are read.  With -r,
+        subdirectories are included.  With no directory, show what is
+        indexed.
+        """
+        args = list(args)
+        recursive = '-r' in args
+        dirs = [self.get_path(arg) for arg in args if arg != '-r']
+        if len(dirs) == 0:
+            d = self.hindex.get_stats()
+            self.log("%(files)d files in %(dirs)d directories indexed "
+                     "in %(path)s" % d)
+            return
+
+        self.log("Indexing headers...")
+        with self.timing.measure('hindex.update'):
+            num_read, num_gone, num_files = self.hindex.update(
+                dirs, recursive=recursive)
+        self.log("%d files indexed (%d read, %d removed)" % (
+            num_files, num_read, num_gone))
+
+    def cmd_hsearch(self, *args):
+        """hsearch cond ... [-c kwd,...] [-b prefix]
+
+        Search the header index (see `hindex`) for the files matching all
+        the conditions `cond`, of the form KWD=value, KWD!=value,
+        KWD<value, KWD<=value, KWD>value, KWD>=value or KWD~pattern (a
+        case-insensitive glob, e.g. OBJECT~M3*).  Numeric values are
+        compared as numbers, others as text.
+
+        Optional:
+        -c lists the values of the given keywords instead of the default
+        columns.  -b reads the matching files into buffers `prefix`1,
+        `prefix`2, ...; with no conditions, the files found by the
+        previous search are read.
+        """
+        args = list(args)
+        columns = self.hindex_columns
+        prefix = None
+        conditions = []
+        while len(args) > 0:
+            arg = args.pop(0)
+            if arg in ('-b', '-c'):
+                if len(args) == 0:
+                    self.log("!! %s needs an argument" % (arg))
+                    return
+                if arg == '-b':
+                    prefix = args.pop(0)
+                else:
+                    columns = args.pop(0).upper().split(',')
+                continue
+            try:
+                conditions.append(hindex.parse_condition(arg))
+            except hindex.HeaderIndexError as e:
+                self.log("!! %s" % (str(e)))
+                return
+
+        if len(conditions) > 0 or prefix is None:
+            with self.timing.measure('hindex.query'):
+                res = self.hindex.query(conditions, columns=columns)
+            self._hsearch_results = [bnch.path for bnch in res]
+            self.log(self.format_headers(res, columns))
+            self.log("%d files found" % (len(res)))
+
+        if prefix is not None:
+            for i, path in enumerate(self._hsearch_results):
+                self.cmd_rd("%s%d" % (prefix, i + 1), path)
+
+    def cmd_metrics(self, *args):
+        """metrics [http [port] | file path [interval] | off]
+
+        Show the monitoring metrics (files loaded, bytes read, buffers and
+        their memory, queue depths and the latencies of `timing`) in the
+        Prometheus text format.
+
+        `http` serves them at http://localhost:port/metrics (default port
+        9120); `file` writes them to `path` every `interval` seconds
+        (default 15); `off` stops both.
+        """
+        if len(args) == 0:
+            self.log(self.metrics.get_text())
+            return
+
+        subcmd = args[0].lower()
+        if subcmd == 'http':
+            port = 9120
+            if len(args) > 1:
+                port = int(args[1])
+            self.start_metrics_server(port)
+            self.log("Serving metrics at http://localhost:%d/metrics" % (
+                self._metrics_server.port))
+
+        elif subcmd == 'file':
+            if len(args) < 2:
+                self.log("!! metrics file needs a path")
+                return
+            interval = 15.0
+            if len(args) > 2:
+                interval = float(args[2])
+            path = self.get_path(args[1])
+            self.start_metrics_writer(path, interval)
+            self.log("Writing metrics to %s every %.1f sec" % (
+                path, interval))
+
+        elif subcmd == 'off':
+            self.stop_metrics()
+            self.log("metrics export off")
+
+        else:
+            self.log("!! Unknown metrics command: '%s'" % (args[0]))
+
+    def start_metrics_server(self, port):
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
+        self._metrics_server = metrics.MetricsServer(self.metrics, port)
+        self._metrics_server.start()
+
+    def start_metrics_writer(self, path, interval=15.0):
+        if self._metrics_writer is not None:
+            self._metrics_writer.stop()
+        self._metrics_writer = metrics.MetricsWriter(self.metrics, path,
+                                                     interval=interval)
+        self._metrics_writer.start()
+
+    def stop_metrics(self):
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
+            self._metrics_server = None
+        if self._metrics_writer is not None:
+            self._metrics_writer.stop()
+            self._metrics_writer = None
+
+    def count_load(self, path):
+        self.metrics.inc('files_loaded_total')
+        try:
+            self.metrics.inc('bytes_read_total', os.path.getsize(path))
+        except OSError:
+            pass
+
+    def get_buffer_bytes(self):
+        # (called from the metrics server thread)
+        total = 0
+        for entry in self.buffers.snapshot().entries():
+            if not isinstance(entry.image, session.LazyBuffer):
+                total += storage.get_nbytes(entry.image)
+        return total
+
+    def get_buffer_name(self, image):
+        """Return the name of a buffer holding `image`, or None."""
+        for entry in self.buffers.snapshot().entries():
+            if entry.image is image:
+                return entry.name
+        return None
+
+    def set_buffer_source(self, name, kind, path, policy=None):
+        """Record that buffer `name`, as it is now, was read from `path`,
+        which is a FITS file (`kind` 'file', or 'cube' for a CubeImage,
+        read with data type policy `policy`) or a session .npy file
+        ('npy').
+        """
+        self._sources[name] = dict(kind=kind, path=path, policy=policy,
+                                   version=self.buffers.get_version(name))
+
+    def get_buffer_source(self, name, snap=None):
+        """Return the source recorded for buffer `name` if the buffer
+        still holds the data read from it, otherwise None.  `snap` is a
+        snapshot of the buffers to check against, by default the current
+        buffers.
+        """
+        if snap is None:
+            snap = self.buffers.snapshot()
+        source = self._sources.get(name, None)
+        if source is None or name not in snap:
+            return None
+        if source['version'] == snap.get_version(name):
+            return source
+        image = snap[name]
+        if source['kind'] == 'cube' and isinstance(image, cube.CubeImage) \
+               and image.get('path', None) == source['path'] and \
+               not image.edited:
+            # showing another plane changes the version, not the source
+            return source
+        return None
+
+    def get_path(self, path):
+        if not path.startswith('/'):
+            path = os.path.join(self.cwd, os.path.expanduser(path))
+        return path
+
+    def expand_paths(self, pattern):
+        """Return the sorted list of files matching `pattern`, which is
+        taken relative to the current working directory unless absolute.
+        """
+        if not pattern.startswith('/'):
+            pattern = os.path.join(self.cwd, pattern)
+        return sorted(glob.glob(pattern))
+
     def get_buffer_info(self, name):
-        image = self.buffers[name]
+        # don't load restored buffers just to list them
+        image = self.buffers.peek(name)
         path = image.get('path', "None")
+        if isinstance(image, storage.ScaledImage):
+            dtype = image.get_storage()
+        elif isinstance(image, session.LazyBuffer):
+            dtype = '-'
+        else:
+            dtype = image.get_data().dtype.name
         res = Bunch.Bunch(dict(name=name, path=path, width=image.width,
-                               height=image.height))
+                               height=image.height, dtype=dtype))
         return res
 
     def make_viewer(self, name, width=None, height=None):
@@ -391,32 +1870,118 @@ class ZView(object):
         viewer = self.gv.make_viewer(name, width=width, height=height)
         viewer.gw.name = name
         self.viewers[name] = viewer
+        self.sync.add_viewer(viewer.gw)
+        self.render_cache.attach(viewer.gw)
+        if self.render_in_thread and asyncrender.can_render(viewer.gw):
+            renderer = asyncrender.AsyncRenderer(
+                viewer.gw, self.logger, self.gv.make_timer,
+                timing=self.timing, render_cache=self.render_cache)
+            renderer.start()
+            self._renderers[name] = renderer
         if self._view is None:
             self._view = viewer
         return viewer
 
     def delete_viewer(self, name):
         viewer = self.viewers[name]
+        self.stop_blink(name)
+        self._blinkers.pop(name, None)
+        self.stop_play(name)
+        renderer = self._renderers.pop(name, None)
+        if renderer is not None:
+            renderer.stop()
+        self.sync.remove_viewer(viewer.gw)
         del self.viewers[name]
         self.gv.delete_viewer(viewer)
 
     def initialize_plot(self):
-        self._plot = plots.Plot(logger=self.logger,
-                                width=600, height=600)
+        from gview import plotting
+        self._plot = plotting.PlotManager(self.logger, width=600, height=600)
         self.gv.initialize_plot_gui(self._plot, width=600, height=600)
 
-    def make_contour_plot(self):
+    def get_plot(self, kind):
+        """Return the persistent plot object of type `kind`, creating the
+        plot window if necessary.
+        """
         if self._plot is None:
             self.initialize_plot()
+        return self._plot.get_plot(kind)
+
+    def start_live(self, kind):
+        """Start following the cursor with plot type `kind`."""
+        self.stop_live()
+        self._live_kind = kind
+        # create the plot window now, in the GUI thread
+        self.get_plot(kind)
+        from gview import live
+        self._live = live.LatestWinsWorker(self.calc_live,
+                                           interval=1.0 / self.live_max_rate,
+                                           logger=self.logger,
+                                           timing=self.timing,
+                                           name='analysis.live')
+        self._live.start()
+        if self._live_timer is None:
+            self._live_timer = self.gv.make_timer(self.live_poll_interval,
+                                                  self.live_poll_cb)
+        self._live_timer.start()
+
+    def stop_live(self):
+        if self._live is not None:
+            self._live.stop()
+            self._live = None
+        if self._live_timer is not None:
+            self._live_timer.cancel()
+
+    def toggle_live(self, viewer, event, data_x, data_y):
+        if self._live is None:
+            self.start_live(self._live_kind)
+            self.track_cursor(viewer, None, data_x, data_y)
+        else:
+            self.stop_live()
+        return True
 
-        fig = self._plot.get_figure()
-        fig.clf()
+    def track_cursor(self, viewer, button, data_x, data_y):
+        """Callback for cursor motion in a viewer; hands the position to
+        the live analysis worker, if it is running.
+        """
+        if self._live is not None:
+            self._live.submit(viewer, data_x, data_y)
+        return False
 
-        # Replace plot with Contour plot
-        self._plot = plots.ContourPlot(logger=self.logger,
-                                       figure=fig,
-                                       width=600, height=600)
-        self._plot.add_axis(axisbg='black')
+    def calc_live(self, viewer, data_x, data_y):
+        # runs in the worker thread: no GUI or plot calls in here
+        from gview import plotting
+        image = viewer.get_image()
+        if image is None:
+            return None
+        # no star under the cursor is common, and not worth logging
+        try:
+            results = self.select_stars_at(image, data_x, data_y)
+        except psfmap.StarError:
+            return None
+        if len(results) == 0:
+            return None
+        qs = results[0]
+        if self._live_kind == 'fwhm':
+            return plotting.calc_fwhm(qs.objx, qs.objy, self.radius, image,
+                                      self.iqcalc)
+        return plotting.calc_radial(qs.objx, qs.objy, self.radius, image)
+
+    def live_poll_cb(self, timer):
+        if self._live is None:
+            return
+        res = self._live.get_result()
+        if res is not None:
+            # the worker may have been restarted with another kind
+            # since this result was computed
+            if self._live_kind == 'fwhm' and 'x_axis' in res:
+                self.get_plot('fwhm').show_fwhm(res)
+            elif self._live_kind == 'radial' and 'r' in res:
+                self.get_plot('radial').show_radial(res)
+            self.gv.set_plot_title("Live %s: X %.1f Y %.1f" % (
+                self._live_kind, res.x + self.pixel_coords_offset,
+                res.y + self.pixel_coords_offset))
+        timer.start()
 
     def do_contour_plot(self, viewer, event, data_x, data_y):
         self.log("ZVIEW> (contour plot)", w_time=True)
@@ -431,27 +1996,13 @@ class ZView(object):
             # where the key was pressed
             x, y = data_x, data_y
 
-        self.make_contour_plot()
+        plot = self.get_plot('contour')
 
         image = viewer.get_image()
-        self._plot.plot_contours(x, y, self.contour_radius, image,
-                                 num_contours=12)
+        plot.plot_contours(x, y, self.contour_radius, image,
+                           num_contours=12)
         return True
 
-
-    def make_gaussians_plot(self):
-        if self._plot is None:
-            self.initialize_plot()
-
-        fig = self._plot.get_figure()
-        fig.clf()
-
-        # Replace plot with FWHM gaussians plot
-        self._plot = plots.FWHMPlot(logger=self.logger,
-                                    figure=fig,
-                                    width=600, height=600)
-        self._plot.add_axis(axisbg='white')
-
     def do_gaussians_plot(self, viewer, event, data_x, data_y):
         self.log("ZVIEW> (gaussians plot)", w_time=True)
         try:
@@ -462,27 +2013,14 @@ class ZView(object):
             self.log("No objects found")
             return
 
-        self.make_gaussians_plot()
+        plot = self.get_plot('fwhm')
 
         image = viewer.get_image()
         x, y = qs.objx, qs.objy
 
-        self._plot.plot_fwhm(x, y, self.radius, image)
+        plot.plot_fwhm(x, y, self.radius, image, self.iqcalc)
         return True
 
-    def make_radial_plot(self):
-        if self._plot is None:
-            self.initialize_plot()
-
-        fig = self._plot.get_figure()
-        fig.clf()
-
-        # Replace plot with Radial profile plot
-        self._plot = plots.RadialPlot(logger=self.logger,
-                                       figure=fig,
-                                       width=700, height=600)
-        self._plot.add_axis(axisbg='white')
-
     def do_radial_plot(self, viewer, event, data_x, data_y):
         self.log("ZVIEW> (radial plot)", w_time=True)
         try:
@@ -493,60 +2031,25 @@ class ZView(object):
             self.log("No objects found")
             return
 
-        self.make_radial_plot()
+        plot = self.get_plot('radial')
 
         image = viewer.get_image()
         x, y = qs.objx, qs.objy
 
-        self._plot.plot_radial(x, y, self.radius, image)
+        plot.plot_radial(x, y, self.radius, image)
 
         rpt = self.make_report(image, qs)
         self.log("seeing size %5.2f" % (rpt.starsize))
         # TODO: dump other stats from the report
         return True
 
+    @timing.timed('analysis.find_objects')
     def find_objects(self, viewer, x, y):
         #x, y = viewer.get_last_data_xy()
         image = viewer.get_image()
 
-        msg, results, qs = None, [], None
         try:
-            data, x1, y1, x2, y2 = image.cutout_radius(x, y, self.radius)
-
-            # Find bright peaks in the cutout
-            self.logger.debug("Finding bright peaks in cutout")
-            peaks = self.iqcalc.find_bright_peaks(data,
-                                                  threshold=self.threshold,
-                                                  radius=self.radius)
-            num_peaks = len(peaks)
-            if num_peaks == 0:
-                raise Exception("Cannot find bright peaks")
-
-            # Evaluate those peaks
-            self.logger.debug("Evaluating %d bright peaks..." % (num_peaks))
-            objlist = self.iqcalc.evaluate_peaks(peaks, data,
-                                                 fwhm_radius=self.radius)
-
-            num_candidates = len(objlist)
-            if num_candidates == 0:
-                raise Exception("Error evaluating bright peaks: no candidates found")
-
-            self.logger.debug("Selecting from %d candidates..." % (num_candidates))
-            height, width = data.shape
-            results = self.iqcalc.objlist_select(objlist, width, height,
-                                                 minfwhm=self.min_fwhm,
-                                                 maxfwhm=self.max_fwhm,
-                                                 minelipse=self.min_ellipse,
-                                                 edgew=self.edgew)
-            if len(results) == 0:
-                raise Exception("No object matches selection criteria")
-
-            # add back in offsets from cutout to result positions
-            for qs in results:
-                qs.x += x1
-                qs.y += y1
-                qs.objx += x1
-                qs.objy += y1
+            results = self.select_stars_at(image, x, y)
 
         except Exception as e:
             msg = str(e)
@@ -555,7 +2058,38 @@ class ZView(object):
 
         return results
 
+    def select_stars_at(self, image, x, y):
+        """Return the stars found within `radius` of `x`, `y` in `image`,
+        best first.  Errors are raised, not logged.
+        """
+        # (only the cutout is converted to floating point)
+        data, x1, y1, x2, y2 = image.cutout_radius(int(x), int(y),
+                                                   self.radius, astype=float)
+        bad = self.get_bad_pixels(image)
+        if bad is not None:
+            ht, wd = data.shape
+            data = crclean.fill_masked(data, bad[y1:y1 + ht, x1:x1 + wd])
+
+        results = psfmap.select_stars(data, self.iqcalc,
+                                      self.get_star_params())
+
+        # add back in offsets from cutout to result positions
+        for qs in results:
+            qs.x += x1
+            qs.y += y1
+            qs.objx += x1
+            qs.objy += y1
+        return results
+
+    def get_star_params(self):
+        """Return the parameters of peak finding and star selection."""
+        return dict(radius=self.radius, threshold=self.threshold,
+                    min_fwhm=self.min_fwhm, max_fwhm=self.max_fwhm,
+                    min_ellipse=self.min_ellipse, edgew=self.edgew)
+
+    @timing.timed('analysis.make_report')
     def make_report(self, image, qs):
+        from ginga.util import wcs
         d = Bunch.Bunch()
         try:
             x, y = qs.objx, qs.objy
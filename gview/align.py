@@ -0,0 +1,193 @@
+#
+# align.py -- register frames and shift them by fractions of a pixel
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Find the offset between two frames by FFT cross-correlation, and shift an
+image by any (sub-pixel) amount.
+
+The offset is found in two steps: a coarse one on block averaged copies
+of the whole frames, which catches large dithers, and a fine one on
+cutouts of `size` pixels around the center of the reference and the
+corresponding place in the other frame.  The peak of the fine correlation
+is located to a fraction of a pixel by fitting a parabola to the log of
+the peak and its neighbors in each axis (exact for a gaussian peak).
+
+Shifting is done in Fourier space, one axis at a time (a 1D FFT of every
+row, then of every column), by strips of rows or columns in parallel, so
+that the whole image is never transformed at once.  Pixels shifted in
+from outside of the image are set to NaN.  Spline interpolation is used
+instead if asked for and scipy is available.
+"""
+import numpy
+
+from gview import parallel
+
+methods = ('fourier', 'spline')
+
+
+class AlignError(Exception):
+    pass
+
+
+def _prepare(data):
+    # remove the sky, so that the correlation is of the objects, and
+    # taper the edges, which would otherwise correlate with each other
+    data = numpy.array(data, dtype=numpy.float64)
+    bad = ~numpy.isfinite(data)
+    sky = numpy.median(data[~bad]) if not bad.all() else 0.0
+    data[bad] = sky
+    data -= sky
+    ht, wd = data.shape
+    data *= numpy.outer(numpy.hanning(ht), numpy.hanning(wd))
+    return data
+
+
+def _fit_peak(c_m, c_0, c_p):
+    # vertex of the parabola through the logs of three positive values
+    if min(c_m, c_0, c_p) <= 0:
+        return 0.0
+    l_m, l_0, l_p = numpy.log(c_m), numpy.log(c_0), numpy.log(c_p)
+    denom = l_m - 2 * l_0 + l_p
+    if denom >= 0:
+        return 0.0
+    return float(numpy.clip(0.5 * (l_m - l_p) / denom, -0.5, 0.5))
+
+
+def cross_correlate(ref, data):
+    """Return the offset (dx, dy) of the objects in `data` from those in
+    `ref` (arrays of the same shape): an object at x, y in `ref` is at
+    x + dx, y + dy in `data`.  Also returns the height of the correlation
+    peak relative to its standard deviation, as a measure of confidence.
+    """
+    if ref.shape != data.shape:
+        raise AlignError("Can't correlate arrays of shapes %s and %s" % (
+            str(ref.shape), str(data.shape)))
+    ht, wd = ref.shape
+    f_ref = numpy.fft.rfft2(_prepare(ref))
+    f_data = numpy.fft.rfft2(_prepare(data))
+    corr = numpy.fft.irfft2(f_data * numpy.conj(f_ref), s=(ht, wd))
+
+    iy, ix = numpy.unravel_index(numpy.argmax(corr), corr.shape)
+    peak = corr[iy, ix]
+    frac_x = _fit_peak(corr[iy, ix - 1], peak, corr[iy, (ix + 1) % wd])
+    frac_y = _fit_peak(corr[iy - 1, ix], peak, corr[(iy + 1) % ht, ix])
+
+    # the correlation wraps around
+    dx = ix if ix <= wd // 2 else ix - wd
+    dy = iy if iy <= ht // 2 else iy - ht
+    std = corr.std()
+    signif = float(peak / std) if std > 0 else 0.0
+    return dx + frac_x, dy + frac_y, signif
+
+
+def block_average(data, factor):
+    """Return `data` averaged over blocks of `factor` x `factor` pixels
+    (any partial blocks at the edges are dropped).
+    """
+    ht, wd = data.shape
+    ht, wd = ht // factor, wd // factor
+    data = data[:ht * factor, :wd * factor].astype(numpy.float32)
+    return data.reshape(ht, factor, wd, factor).mean(axis=(1, 3))
+
+
+def find_offset(ref_image, image, size=512, coarse_size=512):
+    """Return (dx, dy, significance) of `image` relative to `ref_image`
+    (see `cross_correlate`).
+    """
+    wd, ht = ref_image.get_size()
+    if image.get_size() != (wd, ht):
+        raise AlignError("Images are of different sizes")
+
+    # coarse: the whole frames, reduced to about coarse_size pixels
+    dx = dy = 0
+    factor = int(max(wd, ht) // coarse_size)
+    if factor > 1:
+        ref = block_average(ref_image.cutout_data(0, 0, wd, ht), factor)
+        data = block_average(image.cutout_data(0, 0, wd, ht), factor)
+        cdx, cdy, signif = cross_correlate(ref, data)
+        dx, dy = int(round(cdx * factor)), int(round(cdy * factor))
+
+    # fine: a cutout around the center and the same place shifted by the
+    # coarse offset, clipped to both images
+    half_x, half_y = min(size, wd) // 2, min(size, ht) // 2
+    x1 = max(wd // 2 - half_x, -dx, 0)
+    x2 = min(wd // 2 + half_x, wd - dx, wd)
+    y1 = max(ht // 2 - half_y, -dy, 0)
+    y2 = min(ht // 2 + half_y, ht - dy, ht)
+    if x2 - x1 < 16 or y2 - y1 < 16:
+        raise AlignError("The images hardly overlap")
+    ref = ref_image.cutout_data(x1, y1, x2, y2)
+    data = image.cutout_data(x1 + dx, y1 + dy, x2 + dx, y2 + dy)
+    fdx, fdy, signif = cross_correlate(ref, data)
+    return dx + fdx, dy + fdy, signif
+
+
+def _shift_rows(data, shift):
+    # shift each row of `data` by `shift` pixels to the right
+    wd = data.shape[1]
+    freqs = numpy.fft.rfftfreq(wd)
+    ramp = numpy.exp(-2j * numpy.pi * freqs * shift)
+    return numpy.fft.irfft(numpy.fft.rfft(data, axis=1) * ramp, n=wd,
+                           axis=1)
+
+
+def _fourier_shift(data, dx, dy, strip_rows=256, num_workers=None):
+    ht, wd = data.shape
+    result = numpy.empty((ht, wd), dtype=numpy.float32)
+    tmp = numpy.empty((wd, ht), dtype=numpy.float32)
+
+    def shift_x(y1, y2):
+        # x shift of rows y1..y2, stored transposed for the y shift
+        tmp[:, y1:y2] = _shift_rows(data[y1:y2], dx).T
+
+    def shift_y(x1, x2):
+        result[:, x1:x2] = _shift_rows(tmp[x1:x2], dy).T
+
+    parallel.run_parallel(shift_x, parallel.get_strips(ht, strip_rows),
+                          num_workers=num_workers)
+    parallel.run_parallel(shift_y, parallel.get_strips(wd, strip_rows),
+                          num_workers=num_workers)
+    return result
+
+
+def shift_image(image, dx, dy, method='fourier', num_workers=None):
+    """Return the data of `image` shifted by `dx`, `dy` pixels, as a
+    float32 array of the same size.
+    """
+    if method not in methods:
+        raise AlignError("Unknown interpolation method '%s'; use one of: "
+                         "%s" % (method, ', '.join(methods)))
+    wd, ht = image.get_size()
+    data = image.cutout_data(0, 0, wd, ht, astype=numpy.float32)
+    bad = ~numpy.isfinite(data)
+    if bad.any():
+        data[bad] = numpy.median(data[~bad]) if not bad.all() else 0.0
+
+    if method == 'spline':
+        try:
+            from scipy import ndimage
+        except ImportError:
+            raise AlignError("Spline interpolation needs scipy")
+        result = ndimage.shift(data, (dy, dx), order=3, mode='constant',
+                               cval=numpy.nan)
+    else:
+        result = _fourier_shift(data, dx, dy, num_workers=num_workers)
+
+    # what came in from outside of the image (or around, for fourier)
+    ix, iy = int(numpy.ceil(abs(dx))), int(numpy.ceil(abs(dy)))
+    if ix > 0:
+        if dx > 0:
+            result[:, :ix] = numpy.nan
+        else:
+            result[:, -ix:] = numpy.nan
+    if iy > 0:
+        if dy > 0:
+            result[:iy, :] = numpy.nan
+        else:
+            result[-iy:, :] = numpy.nan
+    return result
+
+#END
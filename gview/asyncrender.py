@@ -0,0 +1,300 @@
+#
+# asyncrender.py -- render viewer output in a worker thread
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Move the numeric part of a viewer's redraws off the GUI thread.
+
+A ginga redraw has two parts: `get_rgb_object()` cuts out and resamples
+the data, applies the cut levels and color map and builds the RGB output,
+and the rest draws the graphics overlays and copies the result to the
+window.  The first part takes most of the time for large images and
+touches no GUI objects, so an `AsyncRenderer` runs it in a worker thread.
+When it is done the GUI thread picks up the result and redraws at the
+lowest level (whence=3), which only does the second part.
+
+The worker never touches the viewer itself, which the GUI thread goes on
+changing (pan, zoom, cut levels, cursor readout) while a render is in
+progress.  Each redraw request takes a snapshot of what is needed to
+render (the image, window size, view settings and a copy of the color
+map) on the GUI thread, and the worker renders that snapshot with a
+`ShadowView`, an offscreen viewer of its own.  Only the viewer's image is
+rendered, not other images put on its canvas.
+
+Redraw requests arriving while a render is in progress are merged into a
+single pending request for the lowest `whence` asked for, rendering the
+latest snapshot.  The output of a render that has been superseded by such
+a request is not shown, unless nothing has been shown for `max_lag`
+seconds, so that a viewer being panned or zoomed continuously still
+follows along.
+
+Viewers of ginga 3.0 and later render differently (they have no
+`get_rgb_object`), and are left to render on the GUI thread.
+"""
+import copy
+import threading
+
+from ginga.ImageView import ImageViewBase
+from ginga.misc import Bunch
+
+from gview.timing import clock
+
+# viewer settings that the rendered output depends on
+view_settings = ('pan', 'pan_coord', 'scale', 'rot_deg', 'flip_x', 'flip_y',
+                 'swap_xy', 'cuts', 'interpolation', 'icc_output_profile')
+
+
+def can_render(gw):
+    """Return True if viewer `gw` can have its output built in a worker
+    thread.
+    """
+    return hasattr(gw, 'get_rgb_object')
+
+
+class ShadowView(ImageViewBase):
+    """An offscreen viewer that renders only when asked to (with
+    get_rgb_object), in RGB order `order`.
+    """
+
+    def __init__(self, logger, order):
+        self._order = order
+        self._image_changed = False
+        ImageViewBase.__init__(self, logger=logger)
+        settings = self.get_settings()
+        settings.set(autocuts='off', autozoom='off', autocenter='off',
+                     auto_orient=False)
+
+    def get_rgb_order(self):
+        return self._order
+
+    def redraw(self, whence=0):
+        pass
+
+    def _image_modified_cb(self, image):
+        # (called in the thread modifying the image: see apply())
+        self._image_changed = True
+
+    def apply(self, snap):
+        """Set up the view of snapshot `snap` (see AsyncRenderer.snapshot).
+        Returns True if the image or its data changed since the last
+        render.
+        """
+        changed = self._image_changed
+        self._image_changed = False
+        if self.get_window_size() != snap.window_size:
+            self.configure(*snap.window_size)
+        if self.get_rgbmap() is not snap.rgbmap:
+            self.set_rgbmap(snap.rgbmap)
+        self.img_bg = snap.img_bg
+        if self.get_image() is not snap.image:
+            self.set_image(snap.image)
+            changed = True
+        elif changed:
+            canvas_img = self.get_canvas_image()
+            if canvas_img is not None:
+                canvas_img.reset_optimize()
+        self.get_settings().set(**snap.settings)
+        return changed
+
+
+class AsyncRenderer(object):
+    """Renders for the ginga viewer `gw` in a worker thread; `make_timer`
+    is a function returning a GUI timer (see GView.make_timer).  Renders
+    are shared through `render_cache` (a rendercache.RenderCache), if
+    given.
+    """
+
+    def __init__(self, gw, logger, make_timer, timing=None,
+                 poll_interval=0.01, max_lag=0.25, render_cache=None):
+        self.gw = gw
+        self.logger = logger
+        self.timing = timing
+        self.poll_interval = poll_interval
+        self.max_lag = max_lag
+
+        self.cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        self._whence = None
+        self._snap = None
+        self._result = None
+        self._time_shown = 0.0
+        # number of the latest request, and of the one being rendered
+        self._serial = 0
+        self._rendering = 0
+
+        # statistics
+        self.num_submitted = 0
+        self.num_superseded = 0
+        self.num_done = 0
+
+        # used by the worker thread only
+        self.shadow = ShadowView(logger, gw.get_rgb_order())
+        if render_cache is not None:
+            render_cache.attach(self.shadow)
+        # the copy of the viewer's color map given to the worker, made
+        # again when the color map changes
+        self._rgbmap = None
+        self._rgbmap_copy = None
+
+        self.timer = make_timer(self.poll_interval, self.poll_cb)
+
+        # (not timed by GView: we time the whole redraw ourselves)
+        self._redraw_now = gw.redraw_now
+        self._redraw_window = getattr(gw.redraw_now, '__wrapped__',
+                                      gw.redraw_now)
+        gw.redraw_now = self.redraw_now
+
+    def start(self):
+        with self.cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run,
+                                        name='render-%s' % (self.gw.name))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self.cond:
+            self._running = False
+            self._whence = None
+            self._snap = None
+            self.cond.notify()
+        self.timer.cancel()
+
+    def _rgbmap_changed_cb(self, rgbmap):
+        self._rgbmap_copy = None
+
+    def get_rgbmap_copy(self):
+        rgbmap = self.gw.get_rgbmap()
+        if rgbmap is not self._rgbmap:
+            rgbmap.add_callback('changed', self._rgbmap_changed_cb)
+            self._rgbmap, self._rgbmap_copy = rgbmap, None
+        if self._rgbmap_copy is None:
+            res = rgbmap.__class__(self.logger)
+            rgbmap.copy_attributes(res)
+            # (copy_attributes leaves out the hash size and the
+            # parameters of the distribution)
+            res.set_dist(copy.deepcopy(rgbmap.get_dist()), callback=False)
+            res.set_sarr(rgbmap.get_sarr().copy(), callback=False)
+            self._rgbmap_copy = res
+        return self._rgbmap_copy
+
+    def snapshot(self):
+        """Return what the worker needs to render the viewer as it is
+        now.  Called in the GUI thread.
+        """
+        gw = self.gw
+        settings = gw.get_settings()
+        values = [(name, settings.get(name, None)) for name in view_settings]
+        return Bunch.Bunch(image=gw.get_image(),
+                           window_size=gw.get_window_size(),
+                           rgbmap=self.get_rgbmap_copy(), img_bg=gw.img_bg,
+                           settings=dict([(name, value)
+                                          for name, value in values
+                                          if value is not None]))
+
+    def redraw_now(self, whence=0):
+        gw = self.gw
+        if (whence >= 3 or not self._running or not gw._imgwin_set or
+                gw._self_scaling or gw.get_image() is None):
+            self._redraw_now(whence=whence)
+            return
+
+        snap = self.snapshot()
+        with self.cond:
+            if self._whence is not None:
+                self.num_superseded += 1
+                whence = min(whence, self._whence)
+            elif self._rendering != 0:
+                # the render in progress may have started before the
+                # change that caused this redraw
+                self.num_superseded += 1
+            self._whence = whence
+            self._snap = snap
+            self._serial += 1
+            self.num_submitted += 1
+            self.cond.notify()
+        self.timer.start(self.poll_interval)
+
+    def render(self, snap, whence):
+        """Render snapshot `snap` in the shadow viewer; returns the RGB
+        output and where it goes in the window.  Runs in the worker.
+        """
+        shadow = self.shadow
+        if shadow.apply(snap):
+            whence = 0
+        rgbobj = shadow.get_rgb_object(whence=whence)
+        return rgbobj, (shadow._dst_x, shadow._dst_y)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self._running and self._whence is None:
+                    self.cond.wait()
+                if not self._running:
+                    return
+                whence, self._whence = self._whence, None
+                snap, self._snap = self._snap, None
+                serial = self._rendering = self._serial
+
+            time_start = clock()
+            try:
+                rgbobj, dst = self.render(snap, whence)
+            except Exception as e:
+                self.logger.error("Error rendering image: %s" % (str(e)))
+                rgbobj = None
+            time_render = clock() - time_start
+            if self.timing is not None:
+                self.timing.record('render.thread', time_render)
+
+            with self.cond:
+                self._rendering = 0
+                if rgbobj is not None:
+                    self._result = (serial, whence, rgbobj, dst,
+                                    time_render)
+
+    def poll_cb(self, timer):
+        with self.cond:
+            res, self._result = self._result, None
+            busy = (self._whence is not None) or (self._rendering != 0)
+            latest = self._serial
+
+        if res is not None:
+            serial, whence, rgbobj, dst, time_render = res
+            if serial == latest or clock() - self._time_shown > self.max_lag:
+                self.show(rgbobj, dst, whence, time_render)
+
+        if busy:
+            timer.start(self.poll_interval)
+
+    def show(self, rgbobj, dst, whence, time_render):
+        gw = self.gw
+        time_start = clock()
+        gw._rgbobj = rgbobj
+        gw._dst_x, gw._dst_y = dst
+        self._redraw_window(whence=3)
+        self._time_shown = clock()
+        self.num_done += 1
+        if self.timing is not None:
+            # the whole redraw, as for a viewer rendering synchronously
+            self.timing.record('render.redraw', time_render +
+                               self._time_shown - time_start)
+        if whence <= 0:
+            # as a full synchronous redraw would have done
+            gw.make_callback('redraw')
+
+    def get_queue_depth(self):
+        """Return the number of renders waiting or in progress."""
+        with self.cond:
+            return int(self._whence is not None) + int(self._rendering != 0)
+
+    def get_stats(self):
+        with self.cond:
+            return dict(submitted=self.num_submitted,
+                        superseded=self.num_superseded, done=self.num_done)
+
+#END
@@ -0,0 +1,163 @@
+#
+# blink.py -- blink between pre-rendered buffers in a viewer
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Blink a viewer between several images.
+
+Each image is rendered once, at the pan, zoom and color map of the viewer,
+and the resulting RGB frames are kept.  Blinking then only hands a cached
+frame to the viewer as its current RGB output and redraws at the lowest
+level (whence=3), which just copies it to the window.  The frames are
+rendered again only after the view changes (pan, zoom, rotation, color
+map or window size).
+
+Newer ginga viewers (3.0 and later) don't expose their RGB output, so
+with them the images themselves are swapped in.
+"""
+import numpy
+
+from ginga import RGBMap
+
+from gview.timing import clock
+
+
+def get_setting(settings, name):
+    # ginga renamed getSetting() at some point
+    if hasattr(settings, 'get_setting'):
+        return settings.get_setting(name)
+    return settings.getSetting(name)
+
+
+class Blinker(object):
+    """Blinks the ginga viewer `gw` between images; `make_timer` is a
+    function returning a GUI timer (see GView.make_timer).
+    """
+
+    # settings that invalidate the rendered frames when changed
+    view_settings = ('scale', 'pan', 'rot_deg', 'flip_x', 'flip_y',
+                     'swap_xy')
+
+    def __init__(self, gw, logger, make_timer, timing=None):
+        self.gw = gw
+        self.logger = logger
+        self.timing = timing
+
+        self.names = []
+        self.images = []
+        self.frames = []
+        self.index = 0
+        self.interval = 0.5
+        self.active = False
+        self._preparing = False
+        self._stale = False
+        self._saved = {}
+
+        self.timer = make_timer(self.interval, self.tick_cb)
+        # see the module docstring
+        self.prerender = hasattr(gw, 'get_rgb_object')
+        if not self.prerender:
+            logger.info("this ginga can't pre-render blink frames")
+
+        settings = gw.get_settings()
+        for name in self.view_settings:
+            get_setting(settings, name).add_callback('set',
+                                                     self.view_changed_cb)
+        gw.add_callback('configure', self.view_changed_cb)
+        self._rgbmap = None
+
+    def start(self, names, images, interval=0.5):
+        self.stop()
+        self.names = list(names)
+        self.images = list(images)
+        self.interval = interval
+        self.index = 0
+
+        # keep the view fixed while the images are swapped in
+        settings = self.gw.get_settings()
+        self._saved = dict(autozoom=settings.get('autozoom', 'off'),
+                           autocenter=settings.get('autocenter', 'off'))
+        settings.set(autozoom='off', autocenter='off')
+
+        # color map changes are seen through the rgbmap, which may have
+        # been replaced since we last looked
+        rgbmap = self.gw.get_rgbmap()
+        if rgbmap is not self._rgbmap:
+            rgbmap.add_callback('changed', self.view_changed_cb)
+            self._rgbmap = rgbmap
+
+        self.active = True
+        self.prepare()
+        self.show_frame(0)
+        self.timer.start(self.interval)
+
+    def stop(self):
+        if not self.active:
+            return
+        self.active = False
+        self.timer.cancel()
+        self.frames = []
+
+        settings = self.gw.get_settings()
+        settings.set(**self._saved)
+        # leave the viewer properly showing the image of the last frame
+        self.gw.set_image(self.images[self.index])
+        self.images = []
+
+    def prepare(self):
+        """Render every image at the current view and keep the RGB
+        output.
+        """
+        time_start = clock()
+        frames = [None] * len(self.images)
+        if not self.prerender:
+            self.frames = frames
+            self._stale = False
+            return
+        self._preparing = True
+        gw = self.gw
+        order = gw.get_rgb_order()
+        try:
+            # render in reverse, so that the viewer is left with the
+            # first image loaded
+            for i in reversed(range(len(self.images))):
+                gw.set_image(self.images[i])
+                rgbobj = gw.get_rgb_object(whence=0)
+                # the viewer reuses its buffers; keep our own copy
+                frames[i] = RGBMap.RGBPlanes(
+                    numpy.copy(rgbobj.get_array(order)), order)
+        finally:
+            self._preparing = False
+        self.frames = frames
+        self._stale = False
+        if self.timing is not None:
+            self.timing.record('render.blink_prepare', clock() - time_start)
+
+    def show_frame(self, index):
+        time_start = clock()
+        self.index = index
+        if self.frames[index] is None:
+            self.gw.set_image(self.images[index])
+        else:
+            # make the frame the viewer's current RGB output; a whence=3
+            # redraw copies that to the window without rendering anything
+            self.gw._rgbobj = self.frames[index]
+            self.gw.redraw_now(whence=3)
+        if self.timing is not None:
+            self.timing.record('render.blink', clock() - time_start)
+
+    def tick_cb(self, timer):
+        if not self.active:
+            return
+        if self._stale:
+            self.prepare()
+        self.show_frame((self.index + 1) % len(self.frames))
+        timer.start(self.interval)
+
+    def view_changed_cb(self, *args):
+        if self.active and not self._preparing:
+            self._stale = True
+
+#END
@@ -0,0 +1,321 @@
+#
+# buffers.py -- the table of named image buffers
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+The buffers of a gview session, with versions and change notification.
+
+A `BufferStore` maps buffer names to images like a Bunch, and in
+addition:
+
+* Each buffer has a version number, which changes whenever the buffer
+  is replaced, its image is modified (ginga images make a 'modified'
+  callback when their data is replaced) or its header is changed through
+  the store (`update_keywords`, `touch`).  Version numbers are never
+  reused, so anything computed from a buffer can be cached under its
+  name and version (see `get_cached`).
+
+* Listeners get 'added', 'modified' and 'removed' callbacks, made in the
+  thread that made the change, after it is complete.
+
+* Work in other threads can `acquire` a handle on a buffer, which keeps
+  its image usable after the buffer has been removed or replaced: an
+  image with a `close` method (a cube, which keeps its file open) is
+  closed only once it is in no buffer and the last handle on it has been
+  released.
+
+* Reads don't lock.  The table is never changed in place; a writer
+  replaces it with a changed copy, under a lock, so a look up never sees
+  a change half made and `snapshot` returns all the buffers at one
+  moment for the cost of a reference.
+
+Buffers restored from a session (session.LazyBuffer) are loaded when
+first looked up.
+"""
+import itertools
+import threading
+import weakref
+from collections import namedtuple
+
+from ginga.misc import Callback
+
+from gview import session
+
+Entry = namedtuple('Entry', ['name', 'image', 'version'])
+
+
+class Snapshot(object):
+    """The buffers at one moment, not affected by later changes.  Looking
+    up a restored buffer that is not loaded yet returns the LazyBuffer.
+    """
+
+    def __init__(self, table):
+        self._table = table
+
+    def keys(self):
+        return list(self._table.keys())
+
+    def entries(self):
+        """Return the Entry (name, image, version) of each buffer."""
+        return list(self._table.values())
+
+    def __contains__(self, name):
+        return name in self._table
+
+    def __len__(self):
+        return len(self._table)
+
+    def __getitem__(self, name):
+        return self._table[name].image
+
+    def get_version(self, name):
+        return self._table[name].version
+
+
+class BufferHandle(object):
+    """The image of a buffer as it was when the handle was acquired (see
+    BufferStore.acquire).  Use it as a context manager, or call
+    `release` when done with the image.
+    """
+
+    def __init__(self, store, entry):
+        self.store = store
+        self.name, self.image, self.version = entry
+        self._released = False
+
+    def is_current(self):
+        """Return True if the buffer still holds exactly this image."""
+        snap = self.store.snapshot()
+        return (self.name in snap and
+                snap.get_version(self.name) == self.version)
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.store._release(self.image)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+        return False
+
+
+class BufferStore(Callback.Callbacks):
+    """Named buffers holding ginga images.
+
+    Callbacks:
+      'added' (store, name, version)
+      'modified' (store, name, what, version); `what` is 'data' if the
+          image was replaced or its data modified, 'header' if only its
+          header changed
+      'removed' (store, name)
+    """
+
+    def __init__(self, logger=None):
+        Callback.Callbacks.__init__(self)
+        self.logger = logger
+        # held by writers only
+        self.lock = threading.RLock()
+        self._table = {}
+        self._counter = itertools.count(1)
+        # image id: [image, number of handles]
+        self._refs = {}
+        # buffer name: (version, {key: value}), see get_cached
+        self._cache = {}
+        # images we get 'modified' callbacks from (they can't be removed)
+        self._watched = weakref.WeakKeyDictionary()
+
+        for name in ('added', 'modified', 'removed'):
+            self.enable_callback(name)
+
+    # --- reading ---
+
+    def snapshot(self):
+        """Return a `Snapshot` of the buffers as they are now."""
+        return Snapshot(self._table)
+
+    def keys(self):
+        return list(self._table.keys())
+
+    def __contains__(self, name):
+        return name in self._table
+
+    def __len__(self):
+        return len(self._table)
+
+    def __getitem__(self, name):
+        return self._get_entry(name).image
+
+    def peek(self, name):
+        """Return buffer `name` without loading it if it is not loaded."""
+        return self._table[name].image
+
+    def is_loaded(self, name):
+        return not isinstance(self._table[name].image, session.LazyBuffer)
+
+    def get_version(self, name):
+        return self._table[name].version
+
+    def _get_entry(self, name):
+        """Return the Entry of buffer `name`, loading its image if it is a
+        restored buffer not loaded yet.
+        """
+        entry = self._table[name]
+        if not isinstance(entry.image, session.LazyBuffer):
+            return entry
+        with self.lock:
+            # it may have been loaded, replaced or deleted since
+            current = self._table.get(name, None)
+            if current is not None:
+                entry = current
+            if isinstance(entry.image, session.LazyBuffer):
+                entry.image.logger.info("loading restored buffer '%s'" % (
+                    name))
+                # the same contents: the version doesn't change
+                entry = entry._replace(image=entry.image.load())
+                if current is not None:
+                    self._put(entry)
+                    self._watch(entry.image)
+        return entry
+
+    # --- changing ---
+
+    def __setitem__(self, name, image):
+        with self.lock:
+            old = self._table.get(name, None)
+            version = next(self._counter)
+            self._put(Entry(name, image, version))
+            self._cache.pop(name, None)
+            if not isinstance(image, session.LazyBuffer):
+                self._watch(image)
+            to_close = []
+            if old is not None and old.image is not image:
+                to_close = self._retire(old.image)
+        self._close(to_close)
+        if old is None:
+            self.make_callback('added', name, version)
+        else:
+            self.make_callback('modified', name, 'data', version)
+
+    def __delitem__(self, name):
+        with self.lock:
+            old = self._table[name]
+            table = dict(self._table)
+            del table[name]
+            self._table = table
+            self._cache.pop(name, None)
+            to_close = self._retire(old.image)
+        self._close(to_close)
+        self.make_callback('removed', name)
+
+    def touch(self, name, what='header'):
+        """Give buffer `name` a new version, after a change made to its
+        image that the store can't see (e.g. to its header).
+        """
+        with self.lock:
+            entry = self._table[name]
+            version = next(self._counter)
+            self._put(entry._replace(version=version))
+            self._cache.pop(name, None)
+        self.make_callback('modified', name, what, version)
+
+    def update_keywords(self, name, kwds):
+        """Update the header of the image in buffer `name` from dict
+        `kwds`.
+        """
+        self[name].update_keywords(kwds)
+        self.touch(name, what='header')
+
+    def _put(self, entry):
+        # called with the lock held
+        table = dict(self._table)
+        table[entry.name] = entry
+        self._table = table
+
+    def _watch(self, image):
+        if image not in self._watched:
+            self._watched[image] = True
+            image.add_callback('modified', self._image_modified_cb)
+
+    def _image_modified_cb(self, image):
+        changed = []
+        with self.lock:
+            for entry in list(self._table.values()):
+                if entry.image is image:
+                    version = next(self._counter)
+                    self._put(entry._replace(version=version))
+                    self._cache.pop(entry.name, None)
+                    changed.append((entry.name, version))
+        for name, version in changed:
+            self.make_callback('modified', name, 'data', version)
+
+    # --- handles ---
+
+    def acquire(self, name):
+        """Return a `BufferHandle` on the image in buffer `name` (loading
+        it if necessary).
+        """
+        entry = self._get_entry(name)
+        with self.lock:
+            ref = self._refs.setdefault(id(entry.image), [entry.image, 0])
+            ref[1] += 1
+        return BufferHandle(self, entry)
+
+    def _release(self, image):
+        to_close = []
+        with self.lock:
+            ref = self._refs[id(image)]
+            ref[1] -= 1
+            if ref[1] <= 0:
+                del self._refs[id(image)]
+                to_close = self._retire(image)
+        self._close(to_close)
+
+    def _retire(self, image):
+        # called with the lock held when `image` leaves a buffer or loses
+        # a handle: returns it if it is now unused and must be closed
+        if id(image) in self._refs:
+            return []
+        for entry in self._table.values():
+            if entry.image is image:
+                return []
+        if not hasattr(image, 'close'):
+            return []
+        return [image]
+
+    def _close(self, images):
+        for image in images:
+            try:
+                image.close()
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.error("Error closing image: %s" % (str(e)))
+
+    # --- derived data ---
+
+    def get_cached(self, name, key, calc):
+        """Return `calc(image)` for the image in buffer `name`.  The result
+        is kept under `key` (which must be hashable) until the buffer
+        changes.
+        """
+        # the image and its version from the same entry, as in acquire
+        entry = self._get_entry(name)
+        image, version = entry.image, entry.version
+        with self.lock:
+            cached = self._cache.get(name, None)
+            if cached is not None and cached[0] == version and \
+                   key in cached[1]:
+                return cached[1][key]
+        # not under the lock, as it may take a while
+        value = calc(image)
+        with self.lock:
+            if name in self._table and self._table[name].version == version:
+                cached = self._cache.setdefault(name, (version, {}))
+                cached[1][key] = value
+        return value
+
+#END
@@ -0,0 +1,216 @@
+#
+# combine.py -- memory-bounded stacking of images
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Combine a stack of frames into a single image with a median, mean or
+sigma-clipped mean.
+
+The stack is never assembled in memory as a whole.  It is processed in
+strips of rows across a pool of workers, so the peak memory used is about
+`strip_rows * width * nframes * itemsize` per worker.  Frames may come
+from loaded buffers or be read in strips from FITS files on disk.
+"""
+import numpy
+
+from gview import parallel, storage
+
+methods = ('median', 'mean', 'clip')
+
+# header keywords that describe the on-disk array and should not be
+# carried over to a combined image
+_structural_kwds = ('SIMPLE', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2',
+                    'NAXIS3', 'EXTEND', 'BSCALE', 'BZERO', 'BLANK',
+                    'XTENSION', 'PCOUNT', 'GCOUNT', 'COMMENT', 'HISTORY',
+                    '')
+
+
+class CombineError(Exception):
+    pass
+
+
+class BufferSource(object):
+    """A frame that is already loaded into a buffer.  If given a handle on
+    the buffer (see buffers.BufferStore.acquire), the source releases it
+    when closed.
+    """
+
+    def __init__(self, name, image, handle=None):
+        self.name = name
+        self.image = image
+        self.handle = handle
+        self.shape = (image.height, image.width)
+        # the type of the data as it comes out of the image, which may
+        # be scaled as it is cut out (see storage.ScaledImage)
+        self.dtype = image.cutout_data(0, 0, 1, 1).dtype
+
+    def get_rows(self, y1, y2):
+        return self.image.cutout_data(0, y1, self.shape[1], y2)
+
+    def get_keywords(self):
+        header = self.image.get_header()
+        return dict([(kwd, header[kwd]) for kwd in header.keys()
+                     if kwd not in _structural_kwds])
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.release()
+
+
+class FileSource(object):
+    """A frame that is read in strips from a FITS file.
+
+    The file is memory mapped without scaling, and BSCALE/BZERO are
+    applied to each strip as it is read, so only the strip is ever
+    converted to floating point.  Blank pixels (see storage.py) become
+    NaN.
+    """
+
+    def __init__(self, path):
+        from astropy.io import fits
+
+        self.name = path
+        self.fits_f = fits.open(path, 'readonly', memmap=True,
+                                do_not_scale_image_data=True)
+        self.hdu = None
+        for hdu in self.fits_f:
+            if hdu.is_image and hdu.header.get('NAXIS', 0) >= 2:
+                self.hdu = hdu
+                break
+        if self.hdu is None:
+            self.close()
+            raise CombineError("No image data found in '%s'" % (path))
+
+        header = self.hdu.header
+        self.bscale, self.bzero, self.blank = storage.get_scaling(header)
+        self.scaled = ((self.bscale != 1.0) or (self.bzero != 0.0) or
+                       (self.blank is not None))
+
+        data = self.hdu.data
+        # drop degenerate leading axes (e.g. NAXIS3 = 1)
+        while data.ndim > 2 and data.shape[0] == 1:
+            data = data[0]
+        if data.ndim != 2:
+            self.close()
+            raise CombineError("'%s' is not a 2D image" % (path))
+        self.data = data
+        self.shape = data.shape
+        if self.scaled:
+            self.dtype = numpy.dtype(numpy.float32)
+        else:
+            self.dtype = data.dtype
+
+    def get_rows(self, y1, y2):
+        rows = self.data[y1:y2]
+        if self.scaled:
+            scaled = (rows * numpy.float32(self.bscale) +
+                      numpy.float32(self.bzero))
+            if self.blank is not None:
+                scaled[rows == self.blank] = numpy.nan
+            rows = scaled
+        return rows
+
+    def get_keywords(self):
+        return dict([(card.keyword, card.value)
+                     for card in self.hdu.header.cards
+                     if card.keyword not in _structural_kwds])
+
+    def close(self):
+        self.data = None
+        self.hdu = None
+        self.fits_f.close()
+
+
+def calc_strip_rows(width, num_frames, itemsize, num_workers, mem_limit):
+    """Return the number of rows per strip that keeps the stacks held by
+    all workers (plus working space for the reductions) under `mem_limit`
+    bytes.
+    """
+    # the reductions need a few temporaries the size of the stack
+    bytes_per_row = width * num_frames * itemsize * 3
+    rows = int(mem_limit // (bytes_per_row * num_workers))
+    return max(1, rows)
+
+
+def clipped_mean(stack, nsigma=3.0, iterations=3):
+    """Sigma-clipped mean along the first axis of `stack`.  Clipped
+    pixels are set to NaN in `stack`, which is modified in place.
+
+    The spread is estimated from the median absolute deviation, because
+    with the small stacks we usually combine a single outlier inflates
+    the standard deviation enough to never be rejected.
+    """
+    with numpy.errstate(invalid='ignore'):
+        for i in range(iterations):
+            center = numpy.nanmedian(stack, axis=0)
+            dev = numpy.abs(stack - center)
+            sdev = 1.4826 * numpy.nanmedian(dev, axis=0)
+            reject = dev > nsigma * sdev
+            if not reject.any():
+                break
+            stack[reject] = numpy.nan
+
+        return numpy.nanmean(stack, axis=0)
+
+
+def combine(sources, method='median', nsigma=3.0, iterations=3,
+            strip_rows=None, mem_limit=256 * 1024 ** 2, num_workers=None,
+            logger=None):
+    """Combine the frames in `sources` and return the result as a new
+    array.
+
+    `sources` is a list of objects with `shape`, `dtype` and a
+    `get_rows(y1, y2)` method, such as `BufferSource` and `FileSource`.
+    `method` is one of 'median', 'mean' or 'clip' (sigma-clipped mean
+    with rejection at `nsigma` standard deviations).
+    """
+    if method not in methods:
+        raise CombineError("Unknown combine method '%s'; use one of: %s" % (
+            method, ', '.join(methods)))
+    if len(sources) == 0:
+        raise CombineError("No frames to combine")
+
+    shape = sources[0].shape
+    for src in sources[1:]:
+        if src.shape != shape:
+            raise CombineError("Frame %s has shape %s; expected %s" % (
+                src.name, str(src.shape), str(shape)))
+
+    if any([src.dtype == numpy.float64 for src in sources]):
+        dtype = numpy.dtype(numpy.float64)
+    else:
+        dtype = numpy.dtype(numpy.float32)
+
+    ht, wd = shape
+    num_frames = len(sources)
+    num_workers = parallel.get_num_workers(num_workers)
+    if strip_rows is None:
+        strip_rows = calc_strip_rows(wd, num_frames, dtype.itemsize,
+                                     num_workers, mem_limit)
+    strips = parallel.get_strips(ht, strip_rows)
+    if logger is not None:
+        logger.debug("combining %d frames in %d strips of %d rows "
+                     "(%d workers)" % (num_frames, len(strips), strip_rows,
+                                       num_workers))
+
+    result = numpy.empty(shape, dtype=dtype)
+
+    def combine_strip(y1, y2):
+        stack = numpy.empty((num_frames, y2 - y1, wd), dtype=dtype)
+        for i, src in enumerate(sources):
+            stack[i] = src.get_rows(y1, y2)
+
+        if method == 'median':
+            result[y1:y2] = numpy.median(stack, axis=0)
+        elif method == 'mean':
+            result[y1:y2] = numpy.mean(stack, axis=0)
+        else:
+            result[y1:y2] = clipped_mean(stack, nsigma=nsigma,
+                                         iterations=iterations)
+
+    parallel.run_parallel(combine_strip, strips, num_workers=num_workers)
+    return result
+
+#END
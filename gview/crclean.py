@@ -0,0 +1,154 @@
+#
+# crclean.py -- cosmic ray and bad pixel cleaning
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Find cosmic rays with a Laplacian edge test and replace them, along with
+the pixels of a bad pixel mask, by interpolating from their neighbors.
+
+A pixel is taken to be hit by a cosmic ray if it stands out from the mean
+of its four neighbors (the discrete Laplacian) by more than `sigclip`
+times the noise, and if that difference is more than `sharpness` times
+its height over the sky.  A star is smooth enough that the second test
+fails even at its peak (for a gaussian with a FWHM of 2.5 pixels the
+ratio is about 0.36), while for a single hot pixel it is close to 1.  The
+neighbors of a hit that are also well above the sky are taken as part of
+the same track, and the test is repeated after the hits have been
+replaced, to find the rest of longer tracks.
+
+Masked pixels are replaced by the mean of the good pixels in the 5x5 box
+around them, visiting only the masked pixels.  The sky and noise are
+estimated for each strip of rows, and the strips are cleaned in
+parallel.
+"""
+import numpy
+
+from gview import parallel
+
+# the difference between a pixel and the mean of its 4 neighbors has
+# this many times the noise of a single pixel
+_lap_noise = numpy.sqrt(1.0 + 1.0 / 4.0)
+
+
+def get_sky(data):
+    """Return a robust estimate of the sky level and noise of `data`."""
+    sample = data[::4, ::4]
+    sample = sample[numpy.isfinite(sample)]
+    if len(sample) == 0:
+        return 0.0, 0.0
+    sky = numpy.median(sample)
+    sigma = 1.4826 * numpy.median(numpy.abs(sample - sky))
+    return sky, sigma
+
+
+def _neighbor_mean(data):
+    padded = numpy.pad(data, 1, mode='edge')
+    return 0.25 * (padded[:-2, 1:-1] + padded[2:, 1:-1] +
+                   padded[1:-1, :-2] + padded[1:-1, 2:])
+
+
+def _dilate(mask):
+    padded = numpy.pad(mask, 1, mode='constant')
+    return (mask | padded[:-2, 1:-1] | padded[2:, 1:-1] |
+            padded[1:-1, :-2] | padded[1:-1, 2:])
+
+
+def interpolate(data, mask, r=2, fill=0.0):
+    """Replace the pixels of `data` where `mask` is True, in place, with
+    the mean of the unmasked pixels within `r` of them (or `fill` if
+    there are none).
+    """
+    ys, xs = numpy.nonzero(mask)
+    if len(ys) == 0:
+        return data
+    ht, wd = data.shape
+    total = numpy.zeros(len(ys))
+    count = numpy.zeros(len(ys))
+    # only the masked pixels are looked at, a box offset at a time
+    for dy in range(-r, r + 1):
+        yi = numpy.clip(ys + dy, 0, ht - 1)
+        for dx in range(-r, r + 1):
+            xi = numpy.clip(xs + dx, 0, wd - 1)
+            good = ~mask[yi, xi]
+            total += numpy.where(good, data[yi, xi], 0.0)
+            count += good
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        data[ys, xs] = numpy.where(count > 0, total / count, fill)
+    return data
+
+
+def find_cosmic_rays(data, sky, sigma, sigclip=5.0, sharpness=0.5,
+                     iterations=2, bad=None):
+    """Return a boolean mask of the pixels of `data` hit by cosmic rays.
+    `data` (floating point) is modified: the hits found are replaced by
+    interpolation, as are the pixels in the mask `bad`, if given.
+    """
+    mask = numpy.zeros(data.shape, dtype=bool)
+    if bad is not None:
+        interpolate(data, bad, fill=sky)
+    if not sigma > 0:
+        return mask
+    thresh = sigclip * sigma
+
+    for i in range(iterations):
+        height = data - sky
+        diff = data - _neighbor_mean(data)
+        hits = (diff > thresh * _lap_noise) & (diff > sharpness * height)
+        if not hits.any():
+            break
+        # the rest of the track
+        hits |= _dilate(hits) & (height > thresh)
+        hits &= ~mask
+        if not hits.any():
+            break
+        mask |= hits
+        interpolate(data, hits if bad is None else (hits | bad), fill=sky)
+
+    return mask
+
+
+def clean(image, bad=None, sigclip=5.0, sharpness=0.5, iterations=2,
+          strip_rows=256, num_workers=None):
+    """Clean the image `image` of cosmic rays and bad pixels (a boolean
+    array of the size of the image, True where bad).  Returns the cleaned
+    data (float32) and the mask of the pixels that were replaced.
+    """
+    wd, ht = image.get_size()
+    result = numpy.empty((ht, wd), dtype=numpy.float32)
+    mask = numpy.zeros((ht, wd), dtype=bool)
+    # rows each strip needs from its neighbors: each iteration looks up
+    # to 4 rows away (track growing and interpolation)
+    margin = 4 * iterations + 2
+
+    def clean_strip(y1, y2):
+        ya, yb = max(0, y1 - margin), min(ht, y2 + margin)
+        data = image.cutout_data(0, ya, wd, yb, astype=numpy.float32)
+        sky, sigma = get_sky(data)
+        strip_bad = None if bad is None else bad[ya:yb]
+        hits = find_cosmic_rays(data, sky, sigma, sigclip=sigclip,
+                                sharpness=sharpness, iterations=iterations,
+                                bad=strip_bad)
+        if strip_bad is not None:
+            hits |= strip_bad
+        result[y1:y2] = data[y1 - ya:y2 - ya]
+        mask[y1:y2] = hits[y1 - ya:y2 - ya]
+
+    parallel.run_parallel(clean_strip, parallel.get_strips(ht, strip_rows),
+                          num_workers=num_workers)
+    return result, mask
+
+
+def fill_masked(data, mask):
+    """Return cutout `data` with the pixels where `mask` (of the same
+    shape) is True set to the median of the others, so that they can't
+    be taken for stars.
+    """
+    if mask is None or not mask.any():
+        return data
+    data = numpy.array(data, dtype=float)
+    data[mask] = numpy.median(data[~mask]) if not mask.all() else 0.0
+    return data
+
+#END
@@ -0,0 +1,363 @@
+#
+# cube.py -- lazily read data cubes, and play them
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Data cubes (IFU data, fast readout sequences) that may not fit in memory.
+
+A `CubeImage` shows one plane of a 3D FITS image at a time.  The file is
+kept open, memory mapped if possible, and a plane is read only when it is
+shown, so opening a cube costs the same as opening one plane of it.  The
+plane is stored according to the data type policy of `rd` (see
+storage.py).
+
+Playback (`Player`) is fed by a `Prefetcher`, which reads the next planes
+in a worker thread and computes their cut levels, so that showing a
+plane on a timer tick is just handing its data to the viewer.  Only the
+planes ahead of the current one are kept.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy
+
+from ginga.misc import Bunch
+from ginga.util import iohelper
+
+from gview import storage
+from gview.timing import clock
+
+
+class PlaneReader(object):
+    """Reads planes of the 3D image in HDU `idx` of open FITS file
+    `fits_f`, storing them according to data type `policy`.
+    """
+
+    def __init__(self, fits_f, idx, policy='native'):
+        self.fits_f = fits_f
+        self.hdu = fits_f[idx]
+        self.policy = policy
+        header = self.hdu.header
+        self.shape = storage.get_shape(header)
+        self.bscale, self.bzero, self.blank = storage.get_scaling(header)
+        # leading degenerate axes to index through
+        self._pfx = (0,) * (header['NAXIS'] - len(self.shape))
+        # reads share the file
+        self.lock = threading.Lock()
+
+    def get_num_planes(self):
+        return self.shape[0]
+
+    def read(self, n):
+        """Return Bunch(data, bscale, bzero, blank) for plane `n`."""
+        with self.lock:
+            # only this plane is read; when the file is memory mapped
+            # the section is a view of the map, which must not be
+            # converted in place, so copying it is the read
+            data = numpy.array(self.hdu.section[self._pfx + (n,)])
+        data, bscale, bzero, blank = storage.convert(
+            data, self.bscale, self.bzero, self.policy, blank=self.blank)
+        return Bunch.Bunch(data=data, bscale=bscale, bzero=bzero,
+                           blank=blank)
+
+    def close(self):
+        # not while a plane is being read
+        with self.lock:
+            self.fits_f.close()
+
+
+class CubeImage(storage.ScaledImage):
+    """An image showing one plane of a cube read by a `PlaneReader`."""
+
+    def __init__(self, data_np=None, metadata=None, logger=None,
+                 name=None, **kwdargs):
+        self.reader = None
+        self.plane = 0
+        # True if the data is not a plane as read, e.g. after crclean
+        self.edited = False
+        self._reading = False
+        super(CubeImage, self).__init__(data_np=data_np, metadata=metadata,
+                                        logger=logger, name=name, **kwdargs)
+
+    def set_reader(self, reader):
+        if self.reader is not None:
+            self.reader.close()
+        self.reader = reader
+
+    def get_num_planes(self):
+        return self.reader.get_num_planes()
+
+    def set_plane(self, n, plane=None):
+        """Show plane `n`; `plane` is the result of PlaneReader.read() for
+        it, if already read.
+        """
+        if not 0 <= n < self.get_num_planes():
+            raise storage.StorageError("No plane %d (the cube has %d)" % (
+                n, self.get_num_planes()))
+        if plane is None:
+            plane = self.reader.read(n)
+        self.plane = n
+        # as ginga keeps them for its slices of multidimensional data
+        self.naxispath = [n]
+        self.revnaxis = [n]
+        self._reading = True
+        try:
+            self.set_data(plane.data, bscale=plane.bscale, bzero=plane.bzero,
+                          blank=plane.blank)
+        finally:
+            self._reading = False
+
+    def set_data(self, data_np, metadata=None, astype=None, bscale=1.0,
+                 bzero=0.0, blank=None):
+        # (set before the 'modified' callback is made)
+        self.edited = not self._reading
+        super(CubeImage, self).set_data(data_np, metadata=metadata,
+                                        astype=astype, bscale=bscale,
+                                        bzero=bzero, blank=blank)
+
+    def set_naxispath(self, naxispath):
+        # ginga's way of choosing a plane
+        self.set_plane(naxispath[0])
+
+    def get_storage(self):
+        if self.reader is None:
+            return super(CubeImage, self).get_storage()
+        return "%s[%d]" % (super(CubeImage, self).get_storage(),
+                           self.get_num_planes())
+
+    def close(self):
+        self.set_reader(None)
+
+
+def load_file(image, path, policy='native'):
+    """Open the 3D FITS image in `path` in CubeImage `image` and show its
+    first plane.
+    """
+    from astropy.io import fits
+
+    if policy not in storage.policies:
+        raise storage.StorageError("Unknown data type policy: '%s'" % (
+            policy))
+
+    fits_f = fits.open(path, 'readonly', memmap=True,
+                       do_not_scale_image_data=True)
+    try:
+        idx, hdu = storage._find_image_hdu(fits_f)
+        if hdu is None:
+            raise storage.StorageError("No image data found in '%s'" % (
+                path))
+        if len(storage.get_shape(hdu.header)) != 3:
+            raise storage.StorageError("'%s' is not a 3D image" % (path))
+        reader = PlaneReader(fits_f, idx, policy=policy)
+
+        image.clear_metadata()
+        storage.copy_header(image, hdu)
+        image.wcs.load_header(hdu.header, fobj=fits_f)
+
+    except Exception:
+        fits_f.close()
+        raise
+
+    image.set_reader(reader)
+    image.set_plane(0)
+    image.set(name=iohelper.name_image_from_path(path), path=path, idx=idx)
+    return image
+
+
+class Prefetcher(object):
+    """Reads the `num_ahead` planes of `image` that will be shown after
+    the current one in a worker thread.  `calc_cuts(plane)` returns the
+    cut levels for a plane read, or None.  A plane that can't be read is
+    not tried again until the position has gone past it.
+    """
+
+    def __init__(self, image, calc_cuts, num_ahead=8, logger=None,
+                 timing=None):
+        self.image = image
+        self.reader = image.reader
+        self.calc_cuts = calc_cuts
+        self.num_ahead = num_ahead
+        self.logger = logger
+        self.timing = timing
+
+        self.cond = threading.Condition()
+        # plane number: Bunch(data, bscale, bzero, blank, cuts)
+        self.planes = OrderedDict()
+        # planes that could not be read
+        self.failed = set()
+        self._wanted = []
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        with self.cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name='prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self.cond:
+            self._running = False
+            self.planes.clear()
+            self.cond.notify()
+
+    def set_position(self, n):
+        """Plane `n` is being shown; get ready for the planes after it."""
+        num = self.reader.get_num_planes()
+        wanted = [(n + i) % num
+                  for i in range(1, min(self.num_ahead, num - 1) + 1)]
+        with self.cond:
+            self._wanted = wanted
+            # forget planes we have gone past
+            for key in list(self.planes.keys()):
+                if key not in wanted:
+                    del self.planes[key]
+            self.failed &= set(wanted)
+            self.cond.notify()
+
+    def get(self, n):
+        """Return plane `n` if it has been read, otherwise None."""
+        with self.cond:
+            return self.planes.get(n, None)
+
+    def has_failed(self, n):
+        """Return True if plane `n` could not be read."""
+        with self.cond:
+            return n in self.failed
+
+    def _run(self):
+        while True:
+            with self.cond:
+                n = None
+                while self._running:
+                    missing = [i for i in self._wanted
+                               if i not in self.planes and
+                               i not in self.failed]
+                    if len(missing) > 0:
+                        n = missing[0]
+                        break
+                    self.cond.wait()
+                if not self._running:
+                    return
+
+            time_start = clock()
+            try:
+                plane = self.reader.read(n)
+                plane.cuts = self.calc_cuts(plane)
+            except Exception as e:
+                # (the file may have been closed since we stopped)
+                if self.logger is not None and self._running:
+                    self.logger.error("Error reading plane %d: %s" % (
+                        n, str(e)))
+                plane = None
+            if self.timing is not None:
+                self.timing.record('cube.prefetch', clock() - time_start)
+
+            with self.cond:
+                if plane is None:
+                    self.failed.add(n)
+                elif n in self._wanted:
+                    self.planes[n] = plane
+
+
+class Player(object):
+    """Plays the cube `image` in the ginga viewer `gw` at `fps` planes per
+    second; `make_timer` is a function returning a GUI timer (see
+    GView.make_timer).
+    """
+
+    def __init__(self, gw, image, make_timer, fps=10.0, num_ahead=8,
+                 logger=None, timing=None):
+        self.gw = gw
+        self.image = image
+        self.fps = fps
+        self.logger = logger
+        self.timing = timing
+        self.active = False
+
+        # statistics
+        self.num_shown = 0
+        self.num_late = 0
+        self.num_skipped = 0
+
+        self.prefetcher = Prefetcher(image, self.calc_cuts,
+                                     num_ahead=num_ahead, logger=logger,
+                                     timing=timing)
+        self.timer = make_timer(1.0 / fps, self.tick_cb)
+        self._autocuts = None
+        self._next_time = 0.0
+
+    def calc_cuts(self, plane):
+        # runs in the prefetch thread
+        if self._autocuts == 'off':
+            return None
+        tmp = storage.ScaledImage(logger=self.logger)
+        tmp.set_data(plane.data, bscale=plane.bscale, bzero=plane.bzero,
+                     blank=plane.blank)
+        return self.gw.autocuts.calc_cut_levels(tmp)
+
+    def start(self):
+        settings = self.gw.get_settings()
+        # the cut levels are computed ahead instead of on every plane
+        self._autocuts = settings.get('autocuts', 'off')
+        settings.set(autocuts='off')
+        self.active = True
+        self.prefetcher.set_position(self.image.plane)
+        self.prefetcher.start()
+        self._next_time = clock() + 1.0 / self.fps
+        self.timer.start(1.0 / self.fps)
+
+    def stop(self):
+        if not self.active:
+            return
+        self.active = False
+        self.timer.cancel()
+        self.prefetcher.stop()
+        self.gw.get_settings().set(autocuts=self._autocuts)
+
+    def tick_cb(self, timer):
+        if not self.active:
+            return
+        image = self.image
+        num = image.get_num_planes()
+        n = (image.plane + 1) % num
+        # go past planes that could not be read, rather than waiting
+        # for them forever
+        while self.prefetcher.has_failed(n) and n != image.plane:
+            self.prefetcher.set_position(n)
+            self.num_skipped += 1
+            n = (n + 1) % num
+        plane = self.prefetcher.get(n)
+        if plane is None:
+            # not read yet: keep showing this plane, rather than holding
+            # up the GUI
+            self.num_late += 1
+        else:
+            time_start = clock()
+            with self.gw.suppress_redraw:
+                if plane.cuts is not None:
+                    self.gw.cut_levels(*plane.cuts)
+                image.set_plane(n, plane)
+            self.prefetcher.set_position(n)
+            self.num_shown += 1
+            if self.timing is not None:
+                self.timing.record('cube.show_plane', clock() - time_start)
+
+        # keep to the frame rate, whatever the time spent above
+        self._next_time += 1.0 / self.fps
+        delay = self._next_time - clock()
+        if delay < 0:
+            # fallen behind; don't try to catch up
+            self._next_time, delay = clock(), 0.0
+        timer.start(delay)
+
+    def get_stats(self):
+        return dict(shown=self.num_shown, late=self.num_late,
+                    skipped=self.num_skipped)
+
+#END
@@ -0,0 +1,257 @@
+#
+# export.py -- render images to PNG/JPEG files without a GUI
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Render buffers and FITS files to image files, e.g. for thumbnail galleries.
+
+Images are rendered by an offscreen ginga viewer set up like the viewers
+of gview (see GView.FitsViewer): zscale auto cut levels, then the color
+map and color distribution asked for, zoomed to fit the output size.
+
+A thumbnail doesn't need every pixel, so an image is first decimated to
+no less than the output size by taking every n-th pixel of every n-th
+row.  Files are read that way from a memory map, which reads only the
+rows kept, and only the decimated pixels of buffers are handed to the
+workers.  The images are rendered in a pool of processes, each with its
+own viewer.
+
+Run as a script (see `run_export`) to render files from the command line.
+"""
+from __future__ import print_function
+import os
+import sys
+
+import numpy
+
+from gview import parallel, storage
+from gview.timing import clock
+
+# PIL formats by file extension, and the options for writing them fast
+formats = {'.png': 'png', '.jpg': 'jpeg', '.jpeg': 'jpeg', '.eps': 'eps',
+           '.ps': 'eps'}
+_save_options = {'png': dict(compress_level=1), 'jpeg': dict(quality=90),
+                 'eps': dict()}
+
+# extensions removed from file names to name their output files
+_fits_exts = ('.gz', '.fz', '.fits', '.fit', '.fts')
+
+# the viewer of this process, see _get_viewer
+_viewer = None
+
+
+class ExportError(Exception):
+    pass
+
+
+def get_format(path):
+    """Return the PIL format for writing to `path`."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in formats:
+        raise ExportError("Unknown image file type '%s'; use one of: %s" % (
+            ext, ', '.join(sorted(formats.keys()))))
+    return formats[ext]
+
+
+def get_step(width, height, size):
+    """Return the decimation step for an image of `width` x `height` that
+    leaves at least `size` pixels along its longer side.
+    """
+    if size is None:
+        return 1
+    return max(1, max(width, height) // size)
+
+
+def get_output_size(width, height, size):
+    """Return the size of the rendered output for an image of `width` x
+    `height`, fitted in `size` x `size` (never enlarged).
+    """
+    if size is None:
+        return width, height
+    scale = min(1.0, float(size) / max(width, height))
+    return (max(1, int(round(width * scale))),
+            max(1, int(round(height * scale))))
+
+
+def get_name(path):
+    """Return the name to give the output for file `path`."""
+    name = os.path.basename(path)
+    while True:
+        base, ext = os.path.splitext(name)
+        if ext.lower() not in _fits_exts:
+            return name
+        name = base
+
+
+def get_out_path(pattern, name, n):
+    """Return the output path for image `name`, the `n`th exported.
+    `pattern` may use %(name)s and %(n)d; otherwise, if it is a directory,
+    the output is written there as `name`.png.
+    """
+    if '%(' in pattern:
+        return pattern % dict(name=name, n=n)
+    if pattern.endswith('/') or os.path.isdir(pattern):
+        return os.path.join(pattern, name + '.png')
+    return pattern
+
+
+def decimate_image(image, size):
+    """Return the data of ginga image `image` decimated for output of
+    `size`, with the size of the whole image.
+    """
+    wd, ht = image.get_size()
+    step = get_step(wd, ht, size)
+    data = image.cutout_data(0, 0, wd, ht, xstep=step, ystep=step)
+    return data, wd, ht
+
+
+def read_decimated(path, size):
+    """Return the data of the first image in FITS file `path` (the first
+    plane of a cube) decimated for output of `size`, with the size of
+    the whole image.
+    """
+    from astropy.io import fits
+
+    with fits.open(path, 'readonly', memmap=True,
+                   do_not_scale_image_data=True) as fits_f:
+        idx, hdu = storage._find_image_hdu(fits_f)
+        if hdu is None:
+            raise ExportError("No image data found in '%s'" % (path))
+        header = hdu.header
+        shape = storage.get_shape(header)
+        ht, wd = shape[-2:]
+        step = get_step(wd, ht, size)
+        pfx = (0,) * (header['NAXIS'] - 2)
+        # copied: only the rows kept are read from the map
+        data = numpy.array(hdu.data[pfx + (slice(None, None, step),
+                                           slice(None, None, step))])
+        bscale, bzero, blank = storage.get_scaling(header)
+        data, bscale, bzero, blank = storage.convert(
+            data, bscale, bzero, 'float32', blank=blank)
+    return data, wd, ht
+
+
+def _get_viewer():
+    # one offscreen viewer per process, reused for every image
+    global _viewer
+    if _viewer is None:
+        import logging
+        from ginga.pilw.ImageViewPil import CanvasView
+
+        logger = logging.getLogger('gview.export')
+        fi = CanvasView(logger=logger)
+        fi.enable_autocuts('on')
+        fi.set_autocut_params('zscale')
+        fi.enable_autozoom('on')
+        # draw once, when asked to, rather than on every change
+        fi.set_redraw_lag(0.0)
+        fi.configure_surface(1, 1)
+        _viewer = fi
+    return _viewer
+
+
+def render(data, width, height, out_path, size=None, cmap='gray',
+           dist='linear', cuts=None):
+    """Render `data` (decimated from an image of `width` x `height`) into
+    file `out_path`, fitted in `size` x `size` pixels, with color map
+    `cmap` and color distribution `dist`.  The cut levels are `cuts`
+    (low, high) if given, otherwise zscale.
+    """
+    from ginga import AstroImage
+
+    fmt = get_format(out_path)
+    out_wd, out_ht = get_output_size(width, height, size)
+    fi = _get_viewer()
+    image = AstroImage.AstroImage(logger=fi.logger)
+    image.set_data(data)
+    with fi.suppress_redraw:
+        if fi.get_window_size() != (out_wd, out_ht):
+            fi.configure_surface(out_wd, out_ht)
+        fi.set_color_map(cmap)
+        fi.set_color_algorithm(dist)
+        if cuts is None:
+            fi.enable_autocuts('on')
+        else:
+            fi.enable_autocuts('off')
+            fi.cut_levels(*cuts)
+        fi.set_image(image)
+
+    with open(out_path, 'wb') as out_f:
+        fi.get_surface().save(out_f, format=fmt, **_save_options[fmt])
+
+
+def export_one(src, out_path, size, cmap, dist):
+    """Render `src`, a FITS file path or the result of decimate_image(),
+    into `out_path`.  Returns None, or the error message if it failed.
+    Runs in the worker processes.
+    """
+    try:
+        if isinstance(src, tuple):
+            data, wd, ht = src
+        else:
+            data, wd, ht = read_decimated(src, size)
+        render(data, wd, ht, out_path, size=size, cmap=cmap, dist=dist)
+    except Exception as e:
+        return "%s: %s" % (out_path, str(e))
+    return None
+
+
+def export(items, size=256, cmap='gray', dist='linear', num_workers=None):
+    """Render each (src, out_path) in `items` (see `export_one`), in a
+    pool of processes.  Returns the list of error messages.
+    """
+    for src, out_path in items:
+        get_format(out_path)
+    res = parallel.run_parallel(export_one,
+                                [(src, out_path, size, cmap, dist)
+                                 for src, out_path in items],
+                                num_workers=num_workers, processes=True)
+    return [msg for msg in res if msg is not None]
+
+
+def run_export(sys_argv):
+    """Command line: render FITS files to image files."""
+    from optparse import OptionParser
+
+    usage = "usage: %prog [options] out_pattern fitsfile ..."
+    optprs = OptionParser(usage=usage, version=('%%prog'))
+    optprs.add_option("--cmap", dest="cmap", default='gray', metavar="NAME",
+                      help="Color map to use")
+    optprs.add_option("--dist", dest="dist", default='linear',
+                      metavar="NAME",
+                      help="Color distribution (linear, log, sqrt, ...)")
+    optprs.add_option("-n", "--num-workers", dest="num_workers",
+                      type="int", default=None, metavar="N",
+                      help="Number of processes (default: one per CPU)")
+    optprs.add_option("-s", "--size", dest="size", type="int", default=256,
+                      metavar="PIXELS",
+                      help="Fit the output in PIXELS x PIXELS (0: full size)")
+    (options, args) = optprs.parse_args(sys_argv[1:])
+
+    if len(args) < 2:
+        optprs.error("need an output pattern and at least one file")
+    pattern, paths = args[0], args[1:]
+    if len(paths) > 1 and '%(' not in pattern and \
+           not (pattern.endswith('/') or os.path.isdir(pattern)):
+        optprs.error("output pattern needs %(name)s or %(n)d, or must be "
+                     "a directory, for more than one file")
+
+    size = options.size if options.size > 0 else None
+    items = [(path, get_out_path(pattern, get_name(path), i))
+             for i, path in enumerate(paths)]
+    time_start = clock()
+    try:
+        errors = export(items, size=size, cmap=options.cmap,
+                        dist=options.dist, num_workers=options.num_workers)
+    except ExportError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    for msg in errors:
+        print(msg, file=sys.stderr)
+    print("%d images exported in %.2f sec" % (
+        len(items) - len(errors), clock() - time_start))
+    return 1 if len(errors) > 0 else 0
+
+#END
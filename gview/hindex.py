@@ -0,0 +1,286 @@
+#
+# hindex.py -- index of FITS headers in a local SQLite database
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+An index of the headers of the FITS files in chosen directories, kept in
+a SQLite file so that keyword queries over thousands of frames take
+milliseconds and survive between sessions.
+
+Only the headers are read (the primary header, merged with the first
+image extension's if the primary HDU has no data), several files at a
+time in a pool of processes.  Each file is recorded with its modification
+time and size, so updating the index only reads files that are new or
+have changed, and drops the ones that have gone.
+
+Every keyword is stored as text and, if it is a number, as a number too;
+a condition like `EXPTIME>30` compares numbers and `OBJECT=m31` or
+`FILTER~R*` (a case-insensitive glob) compare text.
+"""
+import os
+import re
+import sqlite3
+
+from ginga.misc import Bunch
+
+from gview import parallel
+
+fits_suffixes = ('.fits', '.fit', '.fts', '.fits.gz', '.fit.gz',
+                 '.fts.gz', '.fits.fz')
+
+# header cards that are not worth indexing
+_skip_kwds = set(['', 'COMMENT', 'HISTORY', 'END'])
+
+_cond_regex = re.compile(r'^([A-Za-z0-9_\-]+)(<=|>=|!=|=|<|>|~)(.*)$')
+
+_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    dir TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE TABLE IF NOT EXISTS keywords (
+    file_id INTEGER NOT NULL,
+    kwd TEXT NOT NULL,
+    sval TEXT,
+    nval REAL
+);
+CREATE INDEX IF NOT EXISTS keywords_nval ON keywords (kwd, nval);
+CREATE INDEX IF NOT EXISTS keywords_sval ON keywords (kwd, sval);
+CREATE INDEX IF NOT EXISTS keywords_file ON keywords (file_id);
+"""
+
+
+class HeaderIndexError(Exception):
+    pass
+
+
+def get_default_path():
+    return os.path.join(os.path.expanduser('~'), '.gview', 'hindex.sqlite')
+
+
+def is_fits_file(name):
+    return name.lower().endswith(fits_suffixes)
+
+
+def _get_value(value):
+    # returns the (text, number) pair stored for a keyword value
+    if isinstance(value, bool):
+        return ('T' if value else 'F'), None
+    if isinstance(value, (int, float)):
+        return str(value), float(value)
+    return str(value).strip(), None
+
+
+def read_header(path):
+    """Read the header of FITS file `path`.  Returns a list of
+    (keyword, text, number) tuples, or an error message string.
+    """
+    from astropy.io import fits
+
+    try:
+        with fits.open(path, 'readonly', memmap=True,
+                       lazy_load_hdus=True) as fits_f:
+            headers = [fits_f[0].header]
+            if fits_f[0].header.get('NAXIS', 0) == 0:
+                # data is in an extension, e.g. a compressed image
+                for i in range(1, len(fits_f)):
+                    if fits_f[i].is_image:
+                        headers.append(fits_f[i].header)
+                        break
+            kwds = {}
+            for header in headers:
+                for card in header.cards:
+                    if card.keyword in _skip_kwds:
+                        continue
+                    kwds[card.keyword] = _get_value(card.value)
+        return [(kwd, sval, nval) for kwd, (sval, nval) in kwds.items()]
+
+    except Exception as e:
+        return str(e)
+
+
+def parse_condition(text):
+    """Parse a condition like `EXPTIME>=30` into (kwd, op, value), where
+    value is a float if it looks like a number.
+    """
+    match = _cond_regex.match(text)
+    if match is None:
+        raise HeaderIndexError("Bad condition: '%s'" % (text))
+    kwd, op, value = match.groups()
+    try:
+        value = float(value)
+    except ValueError:
+        pass
+    return kwd.upper(), op, value
+
+
+class HeaderIndex(object):
+
+    def __init__(self, path, logger, num_workers=None):
+        self.path = path
+        self.logger = logger
+        self.num_workers = num_workers
+        # fewer files than this are read with threads, since starting
+        # up worker processes would take longer
+        self.min_process_files = 64
+
+        dirname = os.path.dirname(path)
+        if dirname != '' and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(_schema)
+
+    def close(self):
+        self.conn.close()
+
+    def _scan(self, dirpath, recursive):
+        res = {}
+        if recursive:
+            walk = os.walk(dirpath)
+        else:
+            walk = [(dirpath, [], os.listdir(dirpath))]
+        for dirname, _subdirs, filenames in walk:
+            for filename in filenames:
+                if not is_fits_file(filename):
+                    continue
+                path = os.path.join(dirname, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                res[path] = (dirname, st.st_mtime, st.st_size)
+        return res
+
+    def _get_indexed(self, dirpath, recursive):
+        cur = self.conn.cursor()
+        if recursive:
+            top = dirpath.rstrip('/') + '/'
+            cur.execute("SELECT id, path, mtime, size FROM files "
+                        "WHERE dir = ? OR substr(dir, 1, ?) = ?",
+                        (dirpath, len(top), top))
+        else:
+            cur.execute("SELECT id, path, mtime, size FROM files "
+                        "WHERE dir = ?", (dirpath,))
+        return dict([(path, (file_id, mtime, size))
+                     for file_id, path, mtime, size in cur.fetchall()])
+
+    def update(self, dirs, recursive=False):
+        """Bring the index up to date with the FITS files in directories
+        `dirs`.  Returns (number of files read, number of files dropped,
+        number of files indexed in those directories).
+        """
+        on_disk = {}
+        indexed = {}
+        for dirpath in dirs:
+            dirpath = os.path.abspath(dirpath)
+            if not os.path.isdir(dirpath):
+                raise HeaderIndexError("No such directory: '%s'" % (dirpath))
+            on_disk.update(self._scan(dirpath, recursive))
+            indexed.update(self._get_indexed(dirpath, recursive))
+
+        gone = [indexed[path][0] for path in indexed
+                if path not in on_disk]
+        to_read = sorted([path for path, (dirname, mtime, size)
+                          in on_disk.items()
+                          if indexed.get(path, (None,))[1:] != (mtime, size)])
+
+        results = []
+        if len(to_read) > 0:
+            processes = len(to_read) >= self.min_process_files
+            results = parallel.run_parallel(read_header,
+                                            [(path,) for path in to_read],
+                                            num_workers=self.num_workers,
+                                            processes=processes)
+
+        with self.conn:
+            cur = self.conn.cursor()
+            for file_id in gone:
+                self._delete(cur, file_id)
+
+            for path, kwds in zip(to_read, results):
+                if path in indexed:
+                    self._delete(cur, indexed[path][0])
+                if not isinstance(kwds, list):
+                    self.logger.warning("Can't read header of '%s': %s" % (
+                        path, kwds))
+                    continue
+                dirname, mtime, size = on_disk[path]
+                cur.execute("INSERT INTO files (path, dir, mtime, size) "
+                            "VALUES (?, ?, ?, ?)",
+                            (path, dirname, mtime, size))
+                file_id = cur.lastrowid
+                cur.executemany("INSERT INTO keywords (file_id, kwd, sval, "
+                                "nval) VALUES (?, ?, ?, ?)",
+                                [(file_id,) + tup for tup in kwds])
+
+        return len(to_read), len(gone), len(on_disk)
+
+    def _delete(self, cur, file_id):
+        cur.execute("DELETE FROM keywords WHERE file_id = ?", (file_id,))
+        cur.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+    def _make_where(self, conditions, path_glob):
+        clauses = []
+        params = []
+        for kwd, op, value in conditions:
+            if op == '~':
+                test = "upper(sval) GLOB upper(?)"
+            elif isinstance(value, float):
+                test = "nval %s ?" % (op)
+            elif op in ('=', '!='):
+                test = "sval %s ? COLLATE NOCASE" % (op)
+            else:
+                test = "sval %s ?" % (op)
+            clauses.append("id IN (SELECT file_id FROM keywords "
+                           "WHERE kwd = ? AND %s)" % (test))
+            params.extend([kwd, value])
+        if path_glob is not None:
+            clauses.append("path GLOB ?")
+            params.append(path_glob)
+        if len(clauses) == 0:
+            return "", params
+        return "WHERE " + " AND ".join(clauses), params
+
+    def query(self, conditions, columns=(), path_glob=None):
+        """Return the files whose headers match all of `conditions`, a
+        list of (kwd, op, value) as returned by parse_condition(), and
+        whose path matches `path_glob`, if given.
+
+        Each result is a Bunch with the file's `path` and a dict `kwds`
+        of the values of the keywords in `columns`.
+        """
+        where, params = self._make_where(conditions, path_glob)
+        cur = self.conn.cursor()
+        cur.execute("SELECT id, path FROM files %s ORDER BY path" % (where),
+                    params)
+        res = []
+        by_id = {}
+        for file_id, path in cur.fetchall():
+            bnch = Bunch.Bunch(path=path, kwds={})
+            res.append(bnch)
+            by_id[file_id] = bnch
+
+        columns = [kwd.upper() for kwd in columns]
+        if len(res) > 0 and len(columns) > 0:
+            cur.execute("SELECT file_id, kwd, sval FROM keywords "
+                        "WHERE kwd IN (%s) AND file_id IN "
+                        "(SELECT id FROM files %s)" % (
+                            ', '.join(['?'] * len(columns)), where),
+                        columns + params)
+            for file_id, kwd, sval in cur.fetchall():
+                by_id[file_id].kwds[kwd] = sval
+        return res
+
+    def get_stats(self):
+        cur = self.conn.cursor()
+        cur.execute("SELECT count(*), count(DISTINCT dir) FROM files")
+        num_files, num_dirs = cur.fetchone()
+        return dict(files=num_files, dirs=num_dirs, path=self.path)
+
+#END
@@ -0,0 +1,117 @@
+#
+# live.py -- rate limited background analysis
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+A worker thread that runs an analysis on the most recent request only.
+
+The GUI submits a request for every cursor motion event.  A new request
+replaces one that is still waiting, so work never queues up behind the
+cursor; requests are started at most once every `interval` seconds.  The
+result of the latest finished request is kept until the GUI thread picks
+it up with `get_result`, since plotting must happen on that thread.
+"""
+import threading
+
+from gview.timing import clock
+
+
+class LatestWinsWorker(object):
+
+    def __init__(self, fn, interval=0.1, logger=None, timing=None,
+                 name='live'):
+        self.fn = fn
+        self.interval = interval
+        self.logger = logger
+        self.timing = timing
+        self.name = name
+
+        self.cond = threading.Condition()
+        self._request = None
+        self._result = None
+        self._running = False
+        self._thread = None
+
+        # statistics
+        self.num_submitted = 0
+        self.num_dropped = 0
+        self.num_done = 0
+
+    def start(self):
+        with self.cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self.cond:
+            self._running = False
+            self._request = None
+            self.cond.notify()
+        # the thread exits after finishing any request in progress
+
+    def is_running(self):
+        return self._running
+
+    def submit(self, *args):
+        """Request a call of `fn` with `args`, replacing any request that
+        has not been started yet.
+        """
+        with self.cond:
+            if self._request is not None:
+                self.num_dropped += 1
+            self._request = args
+            self.num_submitted += 1
+            self.cond.notify()
+
+    def get_queue_depth(self):
+        """Return the number of requests waiting to be started."""
+        with self.cond:
+            return int(self._request is not None)
+
+    def get_result(self):
+        """Return the result of the latest finished request, or None if
+        there is no new one since the last call.
+        """
+        with self.cond:
+            res, self._result = self._result, None
+        return res
+
+    def _run(self):
+        time_last = 0.0
+        while True:
+            with self.cond:
+                while self._running and self._request is None:
+                    self.cond.wait()
+                if not self._running:
+                    return
+
+                # keep to the maximum rate; requests arriving while we
+                # wait replace this one
+                delay = time_last + self.interval - clock()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+                args, self._request = self._request, None
+
+            time_last = clock()
+            try:
+                res = self.fn(*args)
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.debug("%s: %s" % (self.name, str(e)))
+                res = None
+            if self.timing is not None:
+                self.timing.record(self.name, clock() - time_last)
+
+            if res is not None:
+                with self.cond:
+                    self._result = res
+                    self.num_done += 1
+
+#END
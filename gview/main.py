@@ -8,16 +8,20 @@
 #
 from __future__ import print_function
 import sys
+import os
 import threading
 
-from ginga.misc import log
+from gview import timing
+# the startup report measures from here
+time_start = timing.clock()
 
-from gview import GView
+from ginga.misc import log
 import ginga.toolkit as ginga_toolkit
 
 
 def main(options, args):
 
+    startup = timing.StartupReport(time_start)
     logger = log.get_logger("gview", options=options)
 
     if options.toolkit is None:
@@ -27,6 +31,7 @@ def main(options, args):
     ginga_toolkit.use(options.toolkit)
 
     from ginga.gw import Widgets
+    startup.mark("load %s toolkit" % (options.toolkit))
 
     if options.use_opencv:
         from ginga import trcalc
@@ -37,17 +42,55 @@ def main(options, args):
 
     ev_quit = threading.Event()
     app = Widgets.Application(logger=logger)
+    startup.mark("create application")
+
+    # imported here so that the cost shows up in the startup report
+    from gview import GView
+    startup.mark("import gview")
 
     gv = GView.GView(logger, app, ev_quit)
     app.add_callback('shutdown', lambda *args: gv.quit())
+    if options.profile:
+        gv.timing.set_profiling(True, every=options.profile_every)
+    startup.mark("create command window")
+
+    if options.restore:
+        args_session = []
+        if options.session is not None:
+            args_session = [options.session]
+        try:
+            gv.zv.cmd_load_session(*args_session)
+        except Exception as e:
+            logger.error("Error restoring session: %s" % (str(e)))
+        startup.mark("restore session")
+
+    if options.metrics_port is not None:
+        gv.zv.start_metrics_server(options.metrics_port)
+    if options.metrics_file is not None:
+        gv.zv.start_metrics_writer(options.metrics_file)
+
+    def first_pixels_cb(*args):
+        # called on every redraw; only the first one counts
+        if not startup.finished:
+            startup.finished = True
+            startup.mark("first pixels")
+            print(startup.get_report())
 
     i = 0
     for arg in args:
         name = 'gview_%d' % i
         viewer = gv.zv.make_viewer(name)
+        startup.mark("create viewer %s" % (name))
+        if options.startup_report and i == 0:
+            viewer.gw.add_callback('redraw', first_pixels_cb)
         viewer.load_file(args[i])
+        startup.mark("load %s" % (os.path.basename(args[i])))
         i += 1
 
+    if options.startup_report and len(args) == 0:
+        startup.finished = True
+        print(startup.get_report())
+
     try:
         # TODO: unify these
         if hasattr(app, 'start'):
@@ -73,12 +116,30 @@ def run_viewer(sys_argv):
     optprs.add_option("-t", "--toolkit", dest="toolkit", metavar="NAME",
                       default='qt',
                       help="Choose GUI toolkit (gtk|qt)")
+    optprs.add_option("--metrics-file", dest="metrics_file", default=None,
+                      metavar="PATH",
+                      help="Write monitoring metrics to PATH periodically")
+    optprs.add_option("--metrics-port", dest="metrics_port", type="int",
+                      default=None, metavar="PORT",
+                      help="Serve monitoring metrics on localhost PORT")
     optprs.add_option("--opencv", dest="use_opencv", default=False,
                       action="store_true",
                       help="Use OpenCv acceleration, if available")
     optprs.add_option("--profile", dest="profile", action="store_true",
                       default=False,
-                      help="Run the profiler on main()")
+                      help="Profile commands with cProfile (see 'timing')")
+    optprs.add_option("--profile-every", dest="profile_every", type="int",
+                      default=1, metavar="N",
+                      help="Profile only one in N calls of each operation")
+    optprs.add_option("--restore", dest="restore", default=False,
+                      action="store_true",
+                      help="Restore the session saved with 'save-session'")
+    optprs.add_option("--session", dest="session", default=None,
+                      metavar="DIR",
+                      help="Session directory for --restore")
+    optprs.add_option("--startup-report", dest="startup_report",
+                      default=False, action="store_true",
+                      help="Report where the time went during startup")
     log.addlogopts(optprs)
 
     (options, args) = optprs.parse_args(sys.argv[1:])
@@ -89,13 +150,6 @@ def run_viewer(sys_argv):
 
         pdb.run('main(options, args)')
 
-    # Are we profiling this?
-    elif options.profile:
-        import profile
-
-        print(("%s profile:" % sys.argv[0]))
-        profile.run('main(options, args)')
-
     else:
         main(options, args)
 
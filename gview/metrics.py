@@ -0,0 +1,183 @@
+#
+# metrics.py -- counters and gauges for monitoring
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Counters and gauges describing what gview is doing, in the Prometheus
+text exposition format, for watching quick-look health from a monitoring
+stack.
+
+Counters (files loaded, bytes read) are incremented where things happen,
+which costs a dictionary update.  Gauges (number and memory of buffers,
+queue depths) are functions that are only called when the metrics are
+exported, and latencies come from the histograms already kept by
+`timing.Timing`, so the hot paths pay nothing extra for them.
+
+The metrics can be served over HTTP on a localhost port (`MetricsServer`)
+or written to a file every few seconds (`MetricsWriter`), e.g. for the
+node_exporter textfile collector.
+"""
+import os
+import threading
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+prefix = 'gview_'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n',
+                                                                    '\\n')
+
+
+class Metrics(object):
+
+    def __init__(self, timing, logger):
+        self.timing = timing
+        self.logger = logger
+        self.lock = threading.Lock()
+        # name: [help, value]
+        self.counters = {}
+        # name: (help, function returning the value)
+        self.gauges = {}
+
+    def add_counter(self, name, help_text):
+        with self.lock:
+            self.counters.setdefault(name, [help_text, 0])
+
+    def inc(self, name, amount=1):
+        with self.lock:
+            self.counters[name][1] += amount
+
+    def add_gauge(self, name, help_text, fn):
+        """Add gauge `name`, whose value is returned by `fn()` when the
+        metrics are exported.
+        """
+        with self.lock:
+            self.gauges[name] = (help_text, fn)
+
+    def get_text(self):
+        """Return the metrics in the Prometheus text format."""
+        res = []
+        with self.lock:
+            counters = sorted([(name, tup[0], tup[1])
+                               for name, tup in self.counters.items()])
+            gauges = sorted(self.gauges.items())
+
+        for name, help_text, value in counters:
+            name = prefix + name
+            res.append("# HELP %s %s" % (name, help_text))
+            res.append("# TYPE %s counter" % (name))
+            res.append("%s %s" % (name, repr(float(value))))
+
+        for name, (help_text, fn) in gauges:
+            try:
+                value = fn()
+            except Exception as e:
+                self.logger.debug("Error getting gauge %s: %s" % (
+                    name, str(e)))
+                continue
+            name = prefix + name
+            res.append("# HELP %s %s" % (name, help_text))
+            res.append("# TYPE %s gauge" % (name))
+            res.append("%s %s" % (name, repr(float(value))))
+
+        # latencies of the timed operations, as summaries
+        name = prefix + 'latency_seconds'
+        res.append("# HELP %s Latency of operations (see 'timing')" % (name))
+        res.append("# TYPE %s summary" % (name))
+        with self.timing.lock:
+            ops = sorted(self.timing.histograms.keys())
+        for op in ops:
+            count, p50, p95, maxval, mean = self.timing.get_stats(op)
+            label = 'op="%s"' % (_escape(op))
+            for quantile, value in (('0.5', p50), ('0.95', p95),
+                                    ('1', maxval)):
+                res.append('%s{%s,quantile="%s"} %s' % (
+                    name, label, quantile, repr(value)))
+            res.append('%s_sum{%s} %s' % (name, label, repr(mean * count)))
+            res.append('%s_count{%s} %d' % (name, label, count))
+
+        return '\n'.join(res) + '\n'
+
+
+class MetricsServer(object):
+    """Serves the metrics at http://localhost:`port`/metrics."""
+
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        self.metrics = metrics
+        self.logger = metrics.logger
+
+        outer = self
+
+        class _Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = outer.metrics.get_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                outer.logger.debug("metrics: " + fmt % args)
+
+        self.server = HTTPServer((host, port), _Handler)
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        name='metrics-http')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsWriter(object):
+    """Writes the metrics to file `path` every `interval` seconds."""
+
+    def __init__(self, metrics, path, interval=15.0):
+        self.metrics = metrics
+        self.logger = metrics.logger
+        self.path = path
+        self.interval = interval
+        self._ev_stop = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='metrics-file')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._ev_stop.set()
+
+    def write(self):
+        # readers never see a partly written file
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as out_f:
+            out_f.write(self.metrics.get_text())
+        os.rename(tmp_path, self.path)
+
+    def _run(self):
+        while not self._ev_stop.is_set():
+            try:
+                self.write()
+            except Exception as e:
+                self.logger.error("Error writing metrics to %s: %s" % (
+                    self.path, str(e)))
+            self._ev_stop.wait(self.interval)
+
+#END
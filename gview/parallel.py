@@ -0,0 +1,69 @@
+#
+# parallel.py -- helpers for running numeric work across a worker pool
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Small helpers shared by the commands that split their work into pieces
+(row strips, tiles, files) and process them concurrently.
+
+Numpy releases the GIL in the heavy reductions we use, so a thread pool
+gives a real speedup without having to copy image data to other
+processes.  Work that is mostly pure python (parsing FITS headers, for
+example) can be run in a process pool instead.
+"""
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+def get_num_workers(num_workers=None):
+    """Return the number of workers to use; `None` or a value < 1 means
+    one per CPU.
+    """
+    if num_workers is None or num_workers < 1:
+        try:
+            num_workers = multiprocessing.cpu_count()
+        except NotImplementedError:
+            num_workers = 1
+    return num_workers
+
+
+def get_strips(height, strip_rows):
+    """Split `height` rows into a list of (y1, y2) ranges of at most
+    `strip_rows` rows each.
+    """
+    strip_rows = max(1, int(strip_rows))
+    return [(y, min(y + strip_rows, height))
+            for y in range(0, height, strip_rows)]
+
+
+def _call(args):
+    fn, item = args
+    return fn(*item)
+
+
+def run_parallel(fn, items, num_workers=None, processes=False):
+    """Call `fn(*item)` for each tuple in `items` using a pool of
+    `num_workers` threads and return the results in order.
+
+    If `processes` is True a pool of processes is used; `fn` must then
+    be a module level function, and the items and results picklable.
+    """
+    num_workers = get_num_workers(num_workers)
+    if num_workers == 1 or len(items) <= 1:
+        return [fn(*item) for item in items]
+
+    num_workers = min(num_workers, len(items))
+    if processes:
+        # hand out items in batches to keep the pickling overhead down
+        chunksize = max(1, len(items) // (num_workers * 4))
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            return list(pool.map(_call, [(fn, item) for item in items],
+                                 chunksize=chunksize))
+
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        futures = [pool.submit(fn, *item) for item in items]
+        return [future.result() for future in futures]
+
+#END
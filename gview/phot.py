@@ -0,0 +1,186 @@
+#
+# phot.py -- aperture photometry of many positions at once
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Aperture photometry with a local sky from an annulus, for thousands of
+positions at a time.
+
+There is no loop over the stars.  The positions are handled in batches:
+a box around each position is cut out of the image for the whole batch
+with one fancy indexing operation, and the aperture sums and sky medians
+are reductions over the stack of boxes.
+
+The fraction of each pixel inside the aperture is taken from a set of
+weight masks computed once for each radius, one for each of `nphase` x
+`nphase` positions of the center within a pixel (the fractions come from
+`supersample` x `supersample` points in each pixel).  A star uses the
+mask of the nearest phase, so its center is off by at most half of
+1/nphase pixel.  The sky is the median of the pixels whose centers are in
+the annulus; pixels off the image, NaNs and pixels flagged bad are left
+out of it, and counted (`nbad`) if they are in the aperture.
+"""
+import warnings
+
+import numpy
+
+from ginga.misc import Bunch
+
+columns = ('x', 'y', 'flux', 'flux_err', 'sky', 'sky_std', 'area', 'mag',
+           'mag_err', 'nbad')
+
+# weight masks, by (r_ap, r_in, r_out, nphase, supersample)
+_masks = {}
+
+
+class PhotError(Exception):
+    pass
+
+
+def get_masks(r_ap, r_in, r_out, nphase=10, supersample=10):
+    """Return a Bunch with the aperture weights (fraction of each pixel
+    within `r_ap`), and the annulus masks (pixels with centers between
+    `r_in` and `r_out`), for each phase of the center: arrays of shape
+    (nphase, nphase, box, box), indexed by the phase in y and in x.
+    """
+    key = (r_ap, r_in, r_out, nphase, supersample)
+    masks = _masks.get(key, None)
+    if masks is not None:
+        return masks
+
+    half = int(numpy.ceil(max(r_ap, r_out))) + 1
+    box = 2 * half + 1
+    offsets = numpy.arange(box) - half
+    phases = (numpy.arange(nphase) + 0.5) / nphase - 0.5
+    sub = (numpy.arange(supersample) + 0.5) / supersample - 0.5
+
+    # distance of the sample points in each pixel from the center, for
+    # each phase: (phase, pixel, sample) along one axis
+    d = offsets[None, :, None] + sub[None, None, :] - phases[:, None, None]
+    d2 = d ** 2
+    # (phase y, phase x, pixel y, sample y, pixel x, sample x), taken one
+    # phase in y at a time to keep the temporary small
+    aperture = numpy.empty((nphase, nphase, box, box))
+    for py in range(nphase):
+        r2 = (d2[py][None, :, :, None, None] +
+              d2[:, None, None, :, :])
+        aperture[py] = (r2 <= r_ap ** 2).mean(axis=(2, 4))
+
+    # pixel centers only
+    c2 = (offsets[None, :] - phases[:, None]) ** 2
+    r2 = c2[:, None, :, None] + c2[None, :, None, :]
+    annulus = (r2 >= r_in ** 2) & (r2 < r_out ** 2)
+
+    masks = Bunch.Bunch(aperture=aperture, annulus=annulus, half=half,
+                        nphase=nphase)
+    _masks[key] = masks
+    return masks
+
+
+def measure(data, xs, ys, r_ap, r_in, r_out, bad=None, gain=1.0,
+            zeropoint=25.0, batch_size=1024):
+    """Measure the stars at positions `xs`, `ys` (arrays) in image array
+    `data`.  `bad` is an optional boolean array of the pixels to leave
+    out.  Returns an array with a row for each position and the columns
+    in `columns`.  The flux error is from the photon noise (for `gain` in
+    electrons per count) and the noise and uncertainty of the sky.
+    """
+    if not 0 < r_ap <= r_in < r_out:
+        raise PhotError("Radii must be 0 < r_ap <= r_in < r_out")
+    xs = numpy.asarray(xs, dtype=float)
+    ys = numpy.asarray(ys, dtype=float)
+    ht, wd = data.shape
+    masks = get_masks(r_ap, r_in, r_out)
+    nphase, half = masks.nphase, masks.half
+    offsets = numpy.arange(-half, half + 1)
+    ann_flat = masks.annulus.reshape(nphase, nphase, -1)
+    ap_flat = masks.aperture.reshape(nphase, nphase, -1)
+
+    res = numpy.full((len(xs), len(columns)), numpy.nan)
+    res[:, 0], res[:, 1] = xs, ys
+    for i in range(0, len(xs), batch_size):
+        x, y = xs[i:i + batch_size], ys[i:i + batch_size]
+        ix, iy = numpy.round(x).astype(int), numpy.round(y).astype(int)
+        px = numpy.clip(((x - ix + 0.5) * nphase).astype(int), 0,
+                        nphase - 1)
+        py = numpy.clip(((y - iy + 0.5) * nphase).astype(int), 0,
+                        nphase - 1)
+
+        # boxes around every position: (star, y, x)
+        yy = iy[:, None] + offsets[None, :]
+        xx = ix[:, None] + offsets[None, :]
+        valid = (((yy >= 0) & (yy < ht))[:, :, None] &
+                 ((xx >= 0) & (xx < wd))[:, None, :])
+        cut = data[numpy.clip(yy, 0, ht - 1)[:, :, None],
+                   numpy.clip(xx, 0, wd - 1)[:, None, :]].astype(float)
+        if bad is not None:
+            valid &= ~bad[numpy.clip(yy, 0, ht - 1)[:, :, None],
+                          numpy.clip(xx, 0, wd - 1)[:, None, :]]
+        valid &= numpy.isfinite(cut)
+        cut = cut.reshape(len(x), -1)
+        valid = valid.reshape(len(x), -1)
+
+        # sky: median of the good annulus pixels
+        ann = ann_flat[py, px] & valid
+        sky_vals = numpy.where(ann, cut, numpy.nan)
+        n_sky = ann.sum(axis=1)
+        with warnings.catch_warnings():
+            # positions without sky pixels get NaN, as they should
+            warnings.simplefilter('ignore', RuntimeWarning)
+            sky = numpy.nanmedian(sky_vals, axis=1)
+            sky_std = numpy.nanstd(sky_vals, axis=1)
+
+        # aperture sums, leaving out the bad pixels
+        wts = ap_flat[py, px]
+        nbad = ((wts > 0) & ~valid).sum(axis=1)
+        wts = numpy.where(valid, wts, 0.0)
+        area = wts.sum(axis=1)
+        flux = (wts * numpy.where(valid, cut, 0.0)).sum(axis=1) - sky * area
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            var = (numpy.clip(flux, 0, None) / gain + area * sky_std ** 2 +
+                   area ** 2 * sky_std ** 2 / n_sky)
+            flux_err = numpy.sqrt(var)
+            mag = numpy.where(flux > 0, zeropoint - 2.5 * numpy.log10(flux),
+                              numpy.nan)
+            mag_err = numpy.where(flux > 0, 1.0857 * flux_err / flux,
+                                  numpy.nan)
+
+        res[i:i + batch_size, 2:] = numpy.column_stack(
+            [flux, flux_err, sky, sky_std, area, mag, mag_err, nbad])
+    return res
+
+
+def read_catalog(path):
+    """Return the x and y positions in the first two columns of text file
+    `path` ('#' starts a comment).
+    """
+    try:
+        pos = numpy.loadtxt(path, usecols=(0, 1), ndmin=2)
+    except (IOError, ValueError, IndexError) as e:
+        raise PhotError("Can't read catalog '%s': %s" % (path, str(e)))
+    return pos[:, 0], pos[:, 1]
+
+
+def save(path, res, offset=0.0):
+    """Write the measurements `res` to text file `path`, with pixel
+    coordinates shifted by `offset`.
+    """
+    res = res.copy()
+    res[:, :2] += offset
+    numpy.savetxt(path, res, fmt='%.6g', header=' '.join(columns))
+
+
+def make_canvas_object(dc, res, r_ap, r_in, r_out, color='green'):
+    """Make a ginga canvas object showing the apertures and sky annuli of
+    the measurements `res`; `dc` is the module of drawing classes.
+    """
+    objs = []
+    for x, y in res[:, :2]:
+        objs.append(dc.Circle(x, y, r_ap, color=color))
+        objs.append(dc.Circle(x, y, r_in, color=color, linestyle='dash'))
+        objs.append(dc.Circle(x, y, r_out, color=color, linestyle='dash'))
+    return dc.CompoundObject(*objs)
+
+#END
@@ -0,0 +1,433 @@
+#
+# plotting.py -- persistent, blitted analysis plots
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Analysis plots (radial profile, FWHM, contours and star tracking) that
+are created once and then updated in place.
+
+All plot types share one matplotlib figure, each with its own axis that
+is shown when that plot type is selected.  Data artists are "animated",
+so a full draw of the figure renders only the static parts (axes, ticks,
+labels); that is saved as a background and each update just restores the
+background, draws the changed artists and blits the result.  A full draw
+is only done when a plot is first shown, when the figure is resized, or
+when the data no longer fit the axis limits.
+
+The numerical work for the radial and FWHM plots is done by the
+`calc_radial` and `calc_fwhm` functions, separately from the drawing, so
+that it can be run in a background thread (see live.py).
+"""
+import numpy
+
+from ginga.misc import Bunch
+from matplotlib.figure import Figure
+from matplotlib.artist import Artist
+from matplotlib.patches import Rectangle
+
+
+def calc_radial(x, y, radius, image):
+    """Compute the radial profile of the object at `x`, `y`: the radius
+    and value of every pixel within `radius`, and a polynomial fit.
+
+    This does not touch any plot, so it may be called from a thread
+    other than the GUI one.
+    """
+    img_data, x1, y1, x2, y2 = image.cutout_radius(int(x), int(y), radius,
+                                                   astype=float)
+
+    # radius and value of every pixel in the cutout
+    ht, wd = img_data.shape
+    yi, xi = numpy.mgrid[0:ht, 0:wd]
+    r = numpy.sqrt((x1 + xi - x) ** 2 + (y1 + yi - y) ** 2).ravel()
+    v = img_data.ravel()
+
+    # compute radial fitting
+    coefficients = numpy.polyfit(x=r, y=v, deg=10)
+    polynomial = numpy.poly1d(coefficients)
+    x_curve = numpy.linspace(r.min(), r.max(), len(r))
+    y_curve = polynomial(x_curve)
+
+    return Bunch.Bunch(x=x, y=y, radius=radius, r=r, v=v,
+                       x_curve=x_curve, y_curve=y_curve,
+                       lo=numpy.nanmin(v), hi=numpy.nanmax(v))
+
+
+def _calc_fwhm_axis(arr, iqcalc, skybg):
+    N = len(arr)
+    X = numpy.arange(N)
+    # subtract sky background and clamp to 0..max
+    Y = arr - skybg
+    Y = Y.clip(0, Y.max())
+
+    fwhm, mu, sdev, maxv = iqcalc.calc_fwhm(arr)
+    # Make a little smoother gaussian curve by plotting intermediate
+    # points
+    XN = numpy.linspace(0.0, float(N), N * 10)
+    Z = iqcalc.gaussian(XN, (mu, sdev, maxv))
+    return Bunch.Bunch(X=X, Y=Y, XN=XN, Z=Z, fwhm=fwhm, mu=mu,
+                       hi=max(Y.max(), Z.max()))
+
+
+def calc_fwhm(x, y, radius, image, iqcalc, logger=None):
+    """Fit gaussians to the X and Y cuts through the object at `x`, `y`.
+
+    Like `calc_radial`, this is safe to call off the GUI thread.
+    """
+    x0, y0, xarr, yarr = image.cutout_cross(int(x), int(y), radius)
+    # integer data would wrap around when the sky is subtracted
+    xarr, yarr = xarr.astype(float), yarr.astype(float)
+    cutout_data, x1, y1, x2, y2 = image.cutout_radius(int(x), int(y),
+                                                      radius)
+    skybg = numpy.median(cutout_data)
+    if logger is not None:
+        logger.debug("cutting x=%d y=%d r=%d med=%f" % (
+            x, y, radius, skybg))
+
+    x_axis = _calc_fwhm_axis(xarr, iqcalc, skybg)
+    y_axis = _calc_fwhm_axis(yarr, iqcalc, skybg)
+    return Bunch.Bunch(x=x, y=y, x_axis=x_axis, y_axis=y_axis,
+                       length=float(max(len(xarr), len(yarr))),
+                       hi=max(x_axis.hi, y_axis.hi))
+
+
+class AnalysisPlot(object):
+    """Base class for a plot type living on an axis of a shared figure."""
+
+    kind = None
+    bgcolor = 'white'
+
+    def __init__(self, fig, logger):
+        self.fig = fig
+        self.logger = logger
+        self.fontsize = 10
+
+        # a unique label keeps matplotlib from handing back another
+        # plot's axis
+        self.ax = fig.add_subplot(111, label=self.kind)
+        if hasattr(self.ax, 'set_facecolor'):
+            self.ax.set_facecolor(self.bgcolor)
+        else:
+            # matplotlib < 2.0
+            self.ax.set_axis_bgcolor(self.bgcolor)
+        self.ax.set_visible(False)
+        self.artists = []
+        self.background = None
+        self.make_artists()
+
+    def make_artists(self):
+        """Create the (animated) artists that show the data, with
+        `add_artist`.  A plot type with no artists of its own has nothing
+        to do here.
+        """
+        pass
+
+    def add_artist(self, artist):
+        artist.set_animated(True)
+        self.artists.append(artist)
+        return artist
+
+    def set_titles(self, xtitle=None, ytitle=None, title=None):
+        ax = self.ax
+        if xtitle is not None:
+            ax.set_xlabel(xtitle)
+        if ytitle is not None:
+            ax.set_ylabel(ytitle)
+        if title is not None:
+            ax.set_title(title)
+        for item in ([ax.title, ax.xaxis.label, ax.yaxis.label] +
+                     ax.get_xticklabels() + ax.get_yticklabels()):
+            item.set_fontsize(self.fontsize)
+
+    def set_visible(self, tf):
+        self.ax.set_visible(tf)
+        if not tf:
+            self.background = None
+
+    def save_background(self):
+        canvas = self.fig.canvas
+        if getattr(canvas, 'supports_blit', False):
+            self.background = canvas.copy_from_bbox(self.fig.bbox)
+
+    def draw_artists(self):
+        for artist in self.artists:
+            if artist.get_visible():
+                self.ax.draw_artist(artist)
+
+    def redraw(self, full=False):
+        """Show the current state of the artists.  Unless `full` is set,
+        only the artists are redrawn on top of the saved background.
+        """
+        canvas = self.fig.canvas
+        if full or self.background is None:
+            # draw_cb() saves the background and draws the artists
+            canvas.draw()
+            return
+
+        canvas.restore_region(self.background)
+        self.draw_artists()
+        canvas.blit(self.fig.bbox)
+
+    def draw_cb(self, event):
+        # the figure has been fully drawn: save the static parts and put
+        # the animated artists on top
+        if not self.ax.get_visible():
+            return
+        self.save_background()
+        self.draw_artists()
+        if self.background is not None:
+            self.fig.canvas.blit(self.fig.bbox)
+
+    def update_ylim(self, lo, hi):
+        """Adjust the y limits to fit data spanning `lo`..`hi`, but only
+        when the data fall outside of the current limits or fill less
+        than a quarter of them, so that most updates can be blitted.
+        Returns True if the limits changed.
+        """
+        if not (numpy.isfinite(lo) and numpy.isfinite(hi)):
+            return False
+        cur_lo, cur_hi = self.ax.get_ylim()
+        span = cur_hi - cur_lo
+        if (lo >= cur_lo) and (hi <= cur_hi) and (hi - lo) >= 0.25 * span:
+            return False
+        # leave some headroom for the next, possibly brighter, object
+        rng = max(hi - lo, 1.0e-6)
+        self.ax.set_ylim(lo - 0.05 * rng, hi + 0.25 * rng)
+        return True
+
+
+class RadialPlot(AnalysisPlot):
+
+    kind = 'radial'
+
+    def make_artists(self):
+        ax = self.ax
+        self.set_titles(title="Radial plot", xtitle='Radius [pixels]',
+                        ytitle='Pixel Value (ADU)')
+        ax.grid(True)
+        self.points, = ax.plot([], [], marker='x', ls='none', color='blue')
+        self.add_artist(self.points)
+        self.curve, = ax.plot([], [], '-', color='green', lw=2)
+        self.add_artist(self.curve)
+
+    def show_radial(self, res):
+        """Show a radial profile computed by `calc_radial`."""
+        full = False
+        if self.ax.get_xlim() != (-0.1, res.radius):
+            self.ax.set_xlim(-0.1, res.radius)
+            full = True
+
+        self.points.set_data(res.r, res.v)
+        self.curve.set_data(res.x_curve, res.y_curve)
+
+        full = self.update_ylim(res.lo, res.hi) or full
+        self.redraw(full=full)
+
+    def plot_radial(self, x, y, radius, image):
+        try:
+            self.show_radial(calc_radial(x, y, radius, image))
+
+        except Exception as e:
+            self.logger.error("Error making radial plot: %s" % (
+                str(e)))
+
+
+class FWHMPlot(AnalysisPlot):
+
+    kind = 'fwhm'
+
+    def make_artists(self):
+        ax = self.ax
+        self.set_titles(ytitle='Brightness', xtitle='Pixels', title='FWHM')
+        ax.grid(True)
+        self.axes_artists = []
+        for color, spancolor in (('blue', 'skyblue'),
+                                 ('green', 'seagreen')):
+            data, = ax.plot([], [], color=color, marker='.')
+            gauss, = ax.plot([], [], color=color, linestyle=':')
+            span = ax.axvspan(0, 0, facecolor=spancolor, alpha=0.25)
+            self.axes_artists.append((data, gauss, span))
+            for artist in (data, gauss, span):
+                self.add_artist(artist)
+
+        handles = [self.axes_artists[0][0], self.axes_artists[0][1],
+                   self.axes_artists[1][0], self.axes_artists[1][1]]
+        ax.legend(handles, ('data x', 'gauss x', 'data y', 'gauss y'),
+                  loc='upper right', shadow=False, fancybox=False,
+                  prop={'size': 8}, labelspacing=0.2)
+        # the title changes with every update
+        self.add_artist(ax.title)
+
+    def _update_axis(self, artists, axis):
+        data, gauss, span = artists
+        data.set_data(axis.X, axis.Y)
+        gauss.set_data(axis.XN, axis.Z)
+
+        lo, hi = axis.mu - axis.fwhm / 2.0, axis.mu + axis.fwhm / 2.0
+        if isinstance(span, Rectangle):
+            # matplotlib >= 3.9 makes spans rectangles
+            span.set_x(lo)
+            span.set_width(hi - lo)
+        else:
+            span.set_xy([[lo, 0], [lo, 1], [hi, 1], [hi, 0], [lo, 0]])
+
+    def show_fwhm(self, res):
+        """Show FWHM fits computed by `calc_fwhm`."""
+        x_artists, y_artists = self.axes_artists
+        self._update_axis(x_artists, res.x_axis)
+        self._update_axis(y_artists, res.y_axis)
+        self.ax.set_title("FWHM X: %.2f  Y: %.2f" % (res.x_axis.fwhm,
+                                                    res.y_axis.fwhm))
+
+        full = False
+        if self.ax.get_xlim() != (0.0, res.length):
+            self.ax.set_xlim(0.0, res.length)
+            full = True
+        full = self.update_ylim(0.0, res.hi) or full
+        self.redraw(full=full)
+
+    def plot_fwhm(self, x, y, radius, image, iqcalc):
+        try:
+            self.show_fwhm(calc_fwhm(x, y, radius, image, iqcalc,
+                                     logger=self.logger))
+
+        except Exception as e:
+            self.logger.error("Error making fwhm plot: %s" % (
+                str(e)))
+
+
+class ContourPlot(AnalysisPlot):
+
+    kind = 'contour'
+    bgcolor = 'black'
+
+    def make_artists(self):
+        self.ax.set_aspect('equal', adjustable='box')
+        self.set_titles(title='Contours')
+        self.contours = []
+        self.marker, = self.ax.plot([], [], marker='x', ms=20.0,
+                                    color='cyan', ls='none')
+        self.add_artist(self.marker)
+
+    def plot_contours(self, x, y, radius, image, num_contours=8):
+        data, x1, y1, x2, y2 = image.cutout_radius(int(x), int(y), radius)
+        ht, wd = data.shape
+
+        # contour sets cannot be updated, so replace them
+        for artist in self.contours:
+            self.artists.remove(artist)
+            artist.remove()
+        self.contours = []
+
+        try:
+            colors = ['lightgreen'] * num_contours
+            cs = self.ax.contour(numpy.arange(wd), numpy.arange(ht), data,
+                                 num_contours, colors=colors)
+            # newer matplotlib makes the contour set a single artist
+            if isinstance(cs, Artist):
+                parts = [cs]
+            else:
+                parts = cs.collections
+            for artist in parts:
+                self.contours.append(self.add_artist(artist))
+
+            # Mark the center of the object
+            self.marker.set_data([x - x1], [y - y1])
+
+            full = False
+            if self.ax.get_xlim() != (0.0, wd - 1.0):
+                self.ax.set_xlim(0, wd - 1)
+                self.ax.set_ylim(0, ht - 1)
+                full = True
+            self.redraw(full=full)
+
+        except Exception as e:
+            self.logger.error("Error making contour plot: %s" % (
+                str(e)))
+
+
+class TrackPlot(AnalysisPlot):
+
+    kind = 'track'
+
+    def make_artists(self):
+        ax = self.ax
+        self.set_titles(title='Tracking', xtitle='Frame',
+                        ytitle='Offset / FWHM [pixels]')
+        ax.grid(True)
+        self.lines = []
+        for color, label in (('blue', 'dx'), ('green', 'dy'),
+                             ('red', 'fwhm')):
+            line, = ax.plot([], [], color=color, marker='.', ms=3,
+                            label=label)
+            self.lines.append(self.add_artist(line))
+        ax.legend(loc='upper left', shadow=False, fancybox=False,
+                  prop={'size': 8}, labelspacing=0.2)
+        ax.set_xlim(0, 100)
+
+    def show_track(self, series, x0, y0):
+        """Show the time series of a `track.Tracker`, as offsets from the
+        starting position `x0`, `y0`.
+        """
+        frames = numpy.arange(len(series.x))
+        values = (series.x - x0, series.y - y0, series.fwhm)
+        for line, arr in zip(self.lines, values):
+            line.set_data(frames, arr)
+
+        full = False
+        # grow the axis in steps, so that most updates can be blitted
+        if len(frames) > self.ax.get_xlim()[1]:
+            self.ax.set_xlim(0, 2 * len(frames))
+            full = True
+        arr = numpy.concatenate(values)
+        arr = arr[numpy.isfinite(arr)]
+        if len(arr) > 0:
+            full = self.update_ylim(arr.min(), arr.max()) or full
+        self.redraw(full=full)
+
+
+class PlotManager(object):
+    """Owns the figure shown in the plot window and the plot object for
+    each plot type, which are created on first use and then reused.
+    """
+
+    plot_classes = dict(radial=RadialPlot, fwhm=FWHMPlot,
+                        contour=ContourPlot, track=TrackPlot)
+
+    def __init__(self, logger, width=600, height=600, dpi=100):
+        self.logger = logger
+        wd_in, ht_in = float(width) / dpi, float(height) / dpi
+        self.fig = Figure(figsize=(wd_in, ht_in), dpi=dpi)
+        self.plots = {}
+        self.current = None
+        self._draw_cid = None
+
+    def get_figure(self):
+        return self.fig
+
+    def get_plot(self, kind):
+        """Return the plot object for `kind`, making it the one shown."""
+        plot = self.plots.get(kind, None)
+        if plot is None:
+            plot = self.plot_classes[kind](self.fig, self.logger)
+            self.plots[kind] = plot
+
+        if plot is not self.current:
+            if self.current is not None:
+                self.current.set_visible(False)
+            plot.set_visible(True)
+            self.current = plot
+            # the figure canvas is created by the plot widget, after us
+            canvas = self.fig.canvas
+            if self._draw_cid is None:
+                self._draw_cid = canvas.mpl_connect('draw_event',
+                                                    self.draw_cb)
+        return plot
+
+    def draw_cb(self, event):
+        if self.current is not None:
+            self.current.draw_cb(event)
+
+#END
@@ -0,0 +1,179 @@
+#
+# psfmap.py -- star FWHM and ellipticity across the field
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Measure how the PSF varies over the field, for focusing and collimation.
+
+The image is split into a grid of cells and the stars in each cell are
+found and selected the same way as for a single object (`select_stars`,
+also used by ZView.find_objects).  The cells are measured in a pool of
+worker processes, since fitting the stars is mostly python code that
+would hold the GIL.  Each cell is cut out with a margin, so that stars
+near its edges can be measured, and keeps the stars whose centers fall
+inside it.
+"""
+import logging
+
+import numpy
+
+from ginga.misc import Bunch
+
+from gview import parallel, crclean
+
+
+class StarError(Exception):
+    pass
+
+
+def select_stars(data, iqcalc, params, max_peaks=None):
+    """Find the stars in `data` that meet the selection criteria in dict
+    `params` (radius, threshold, min_fwhm, max_fwhm, min_ellipse, edgew),
+    best first.  If `max_peaks` is given, only that many of the
+    brightest peaks are evaluated.
+    """
+    peaks = iqcalc.find_bright_peaks(data, threshold=params['threshold'],
+                                     radius=params['radius'])
+    if len(peaks) == 0:
+        raise StarError("Cannot find bright peaks")
+    if max_peaks is not None and len(peaks) > max_peaks:
+        values = [data[int(y), int(x)] for x, y in peaks]
+        order = numpy.argsort(values)[::-1][:max_peaks]
+        peaks = [peaks[i] for i in order]
+
+    objlist = iqcalc.evaluate_peaks(peaks, data,
+                                    fwhm_radius=params['radius'])
+    if len(objlist) == 0:
+        raise StarError("Error evaluating bright peaks: no candidates found")
+
+    height, width = data.shape
+    results = iqcalc.objlist_select(objlist, width, height,
+                                    minfwhm=params['min_fwhm'],
+                                    maxfwhm=params['max_fwhm'],
+                                    minelipse=params['min_ellipse'],
+                                    edgew=params['edgew'])
+    if len(results) == 0:
+        raise StarError("No object matches selection criteria")
+    return results
+
+
+def _make_calc():
+    from ginga.util import iqcalc
+
+    class CellCalc(iqcalc.IQCalc):
+        """IQCalc computes the median (background) of the whole data for
+        the threshold and again for every peak it evaluates, which takes
+        most of the time on a large cell; this computes it once per data
+        array.
+        """
+        _data, _medv = None, None
+
+        def get_median(self, data):
+            if data is not self._data:
+                self._data, self._medv = data, numpy.median(data)
+            return self._medv
+
+        def get_threshold(self, data, sigma=5.0):
+            median = self.get_median(data)
+            dist = numpy.fabs(data - median).mean()
+            return median + sigma * dist
+
+        def get_fwhm(self, x, y, radius, data, medv=None):
+            if medv is None:
+                medv = self.get_median(data)
+            return super(CellCalc, self).get_fwhm(x, y, radius, data,
+                                                  medv=medv)
+
+    return CellCalc(logging.getLogger('gview.psfmap'))
+
+
+def measure_cell(data, x0, y0, bbox, params, max_peaks):
+    """Return (x, y, fwhm, ellipticity) of the stars selected in `data`,
+    a cutout whose first pixel is at `x0`, `y0` in the image, that fall
+    in `bbox` (x1, y1, x2, y2).
+    """
+    calc = _make_calc()
+    try:
+        results = select_stars(data, calc, params, max_peaks=max_peaks)
+    except StarError:
+        return []
+
+    x1, y1, x2, y2 = bbox
+    res = []
+    for obj in results:
+        x, y = obj.objx + x0, obj.objy + y0
+        if x1 <= x < x2 and y1 <= y < y2:
+            res.append((x, y, obj.fwhm, 1.0 - obj.elipse))
+    return res
+
+
+def get_cells(width, height, nx, ny):
+    """Split a `width` x `height` image into `nx` x `ny` cells; returns a
+    list of (i, j, x1, y1, x2, y2).
+    """
+    xs = numpy.linspace(0, width, nx + 1).astype(int)
+    ys = numpy.linspace(0, height, ny + 1).astype(int)
+    return [(i, j, xs[i], ys[j], xs[i + 1], ys[j + 1])
+            for j in range(ny) for i in range(nx)]
+
+
+def calc_psfmap(image, nx, ny, params, max_peaks=25, num_workers=None,
+                processes=True, bad=None):
+    """Measure the stars in each cell of an `nx` x `ny` grid over `image`,
+    ignoring the pixels where boolean array `bad` is True, if given.
+    Returns a list of Bunches, one per cell, with the cell's position `i`,
+    `j` and extent, the number of stars `num` and their median `fwhm` and
+    `ellipticity` (None if there are no stars).
+    """
+    width, height = image.get_size()
+    margin = int(params['radius'])
+
+    cells = get_cells(width, height, nx, ny)
+    items = []
+    for i, j, x1, y1, x2, y2 in cells:
+        cx1, cy1 = max(0, x1 - margin), max(0, y1 - margin)
+        cx2, cy2 = min(width, x2 + margin), min(height, y2 + margin)
+        data = image.cutout_data(cx1, cy1, cx2, cy2, astype=float)
+        if bad is not None:
+            data = crclean.fill_masked(data, bad[cy1:cy2, cx1:cx2])
+        items.append((data, cx1, cy1, (x1, y1, x2, y2), params, max_peaks))
+
+    results = parallel.run_parallel(measure_cell, items,
+                                    num_workers=num_workers,
+                                    processes=processes)
+
+    res = []
+    for (i, j, x1, y1, x2, y2), stars in zip(cells, results):
+        bnch = Bunch.Bunch(i=i, j=j, x1=x1, y1=y1, x2=x2, y2=y2,
+                           num=len(stars), stars=stars, fwhm=None,
+                           ellipticity=None)
+        if len(stars) > 0:
+            arr = numpy.array(stars)
+            bnch.fwhm = float(numpy.median(arr[:, 2]))
+            bnch.ellipticity = float(numpy.median(arr[:, 3]))
+        res.append(bnch)
+    return res
+
+
+def make_canvas_object(dc, cells, color='cyan'):
+    """Make a ginga canvas object showing the median FWHM and
+    ellipticity of each cell; `dc` is the module of drawing classes.
+    """
+    objs = []
+    for cell in cells:
+        objs.append(dc.Rectangle(cell.x1, cell.y1, cell.x2 - 1, cell.y2 - 1,
+                                 color=color, linestyle='dash'))
+        if cell.fwhm is None:
+            text = "no stars"
+        else:
+            text = "%.2f / %.2f (%d)" % (cell.fwhm, cell.ellipticity,
+                                         cell.num)
+        objs.append(dc.Text(cell.x1 + 5, cell.y2 - 5, text, color=color,
+                            fontsize=10))
+        for x, y, fwhm, ell in cell.stars:
+            objs.append(dc.Circle(x, y, fwhm, color=color))
+    return dc.CompoundObject(*objs)
+
+#END
@@ -0,0 +1,222 @@
+#
+# regions.py -- named regions of an image
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Boxes, circles and polygons that commands can be restricted to.
+
+Regions are defined in data coordinates (the center of the first pixel
+is 0, 0) and contain the pixels whose centers fall inside them.  A region
+is rasterized once for each image size it is used with: `get_mask`
+returns the bounding box of the region clipped to the image, as a slice,
+and a boolean mask of the pixels inside it (None for a box, where every
+pixel in the slice is inside).  These are kept, so commands run over and
+over on a region reuse them.
+"""
+import math
+
+import numpy
+
+from ginga.misc import Bunch
+
+kinds = ('box', 'circle', 'polygon')
+
+
+class RegionError(Exception):
+    pass
+
+
+class Region(object):
+    """A named region.  Each kind of region defines:
+
+        get_bbox()         the (x1, y1, x2, y2) extent of the region
+        get_params()       the coordinates that define the region
+        rasterize(xi, yi)  a boolean mask of the pixels with centers
+                           `xi`, `yi` (arrays of the same shape) that are
+                           inside the region
+    """
+
+    kind = None
+
+    def __init__(self, name):
+        self.name = name
+        # masks by image (height, width)
+        self._masks = {}
+
+    def get_mask(self, shape):
+        """Return a Bunch with the slice `view` covering the region in an
+        image of dimensions `shape` (height, width), its origin `x1`, `y1`
+        and a boolean `mask` of the pixels in the region, or None if all
+        of them are.
+        """
+        shape = tuple(shape[:2])
+        res = self._masks.get(shape, None)
+        if res is not None:
+            return res
+
+        ht, wd = shape
+        bx1, by1, bx2, by2 = self.get_bbox()
+        # pixels whose centers fall within the bounding box
+        x1, y1 = max(0, int(math.ceil(bx1))), max(0, int(math.ceil(by1)))
+        x2 = min(wd, int(math.floor(bx2)) + 1)
+        y2 = min(ht, int(math.floor(by2)) + 1)
+        if x2 <= x1 or y2 <= y1:
+            raise RegionError("Region '%s' is outside the image" % (
+                self.name))
+
+        mask = None
+        if self.kind != 'box':
+            yi, xi = numpy.mgrid[y1:y2, x1:x2]
+            mask = self.rasterize(xi, yi)
+        res = Bunch.Bunch(view=numpy.s_[y1:y2, x1:x2], x1=x1, y1=y1,
+                          x2=x2, y2=y2, mask=mask)
+        self._masks[shape] = res
+        return res
+
+    def get_values(self, image, bad=None):
+        """Return a 1D array of the values of the pixels of `image` in the
+        region, leaving out those where the boolean array `bad` (of the
+        size of the image) is True.
+        """
+        bnch = self.get_mask(image.get_data_size()[::-1])
+        # only the bounding box is taken out of the image
+        data = image.cutout_data(bnch.x1, bnch.y1, bnch.x2, bnch.y2)
+        mask = bnch.mask
+        if bad is not None:
+            good = ~bad[bnch.view]
+            mask = good if mask is None else (mask & good)
+        if mask is None:
+            return data.ravel()
+        return data[mask]
+
+
+class BoxRegion(Region):
+
+    kind = 'box'
+
+    def __init__(self, name, x1, y1, x2, y2):
+        super(BoxRegion, self).__init__(name)
+        self.x1, self.x2 = min(x1, x2), max(x1, x2)
+        self.y1, self.y2 = min(y1, y2), max(y1, y2)
+
+    def get_bbox(self):
+        return (self.x1, self.y1, self.x2, self.y2)
+
+    def get_params(self):
+        return self.get_bbox()
+
+    def rasterize(self, xi, yi):
+        return ((xi >= self.x1) & (xi <= self.x2) &
+                (yi >= self.y1) & (yi <= self.y2))
+
+
+class CircleRegion(Region):
+
+    kind = 'circle'
+
+    def __init__(self, name, x, y, radius):
+        super(CircleRegion, self).__init__(name)
+        self.x, self.y, self.radius = x, y, abs(radius)
+
+    def get_bbox(self):
+        r = self.radius
+        return (self.x - r, self.y - r, self.x + r, self.y + r)
+
+    def get_params(self):
+        return (self.x, self.y, self.radius)
+
+    def rasterize(self, xi, yi):
+        return (xi - self.x) ** 2 + (yi - self.y) ** 2 <= self.radius ** 2
+
+
+class PolygonRegion(Region):
+
+    kind = 'polygon'
+
+    def __init__(self, name, points):
+        super(PolygonRegion, self).__init__(name)
+        if len(points) < 3:
+            raise RegionError("A polygon needs at least 3 points")
+        self.points = [(float(x), float(y)) for x, y in points]
+
+    def get_bbox(self):
+        xs, ys = zip(*self.points)
+        return (min(xs), min(ys), max(xs), max(ys))
+
+    def get_params(self):
+        return [val for pt in self.points for val in pt]
+
+    def rasterize(self, xi, yi):
+        # even-odd rule: count the edges crossed by a ray going right
+        inside = numpy.zeros(xi.shape, dtype=bool)
+        pts = self.points
+        for (xa, ya), (xb, yb) in zip(pts, pts[1:] + pts[:1]):
+            if ya == yb:
+                continue
+            crosses = (ya > yi) != (yb > yi)
+            x_cross = xa + (yi - ya) * (xb - xa) / (yb - ya)
+            inside ^= crosses & (xi < x_cross)
+        return inside
+
+
+def make_region(name, kind, coords, offset=0.0):
+    """Make a region of `kind` from a list of numbers.  `offset` is
+    subtracted from the coordinates (e.g. 1 for 1-based coordinates).
+    """
+    if kind == 'box':
+        if len(coords) != 4:
+            raise RegionError("A box needs x1 y1 x2 y2")
+        return BoxRegion(name, *[val - offset for val in coords])
+    elif kind == 'circle':
+        if len(coords) != 3:
+            raise RegionError("A circle needs x y radius")
+        x, y, radius = coords
+        return CircleRegion(name, x - offset, y - offset, radius)
+    elif kind == 'polygon':
+        if len(coords) % 2 != 0:
+            raise RegionError("A polygon needs pairs of x y")
+        coords = [val - offset for val in coords]
+        return PolygonRegion(name, list(zip(coords[0::2], coords[1::2])))
+    raise RegionError("Unknown kind of region: '%s'" % (kind))
+
+
+def from_canvas_object(name, obj):
+    """Make a region from a ginga canvas object drawn by the user."""
+    if obj.kind == 'rectangle':
+        return BoxRegion(name, obj.x1, obj.y1, obj.x2, obj.y2)
+    elif obj.kind == 'circle':
+        return CircleRegion(name, obj.x, obj.y, obj.radius)
+    elif obj.kind == 'polygon':
+        return PolygonRegion(name, obj.points)
+    raise RegionError("Can't make a region from a %s" % (obj.kind))
+
+
+def make_canvas_object(dc, region, color='yellow'):
+    """Make a ginga canvas object showing `region`; `dc` is the module of
+    drawing classes (see get_canvas_types).
+    """
+    if region.kind == 'box':
+        shape = dc.Rectangle(region.x1, region.y1, region.x2, region.y2,
+                             color=color)
+    elif region.kind == 'circle':
+        shape = dc.Circle(region.x, region.y, region.radius, color=color)
+    else:
+        shape = dc.Polygon(region.points, color=color)
+    x1, y1, x2, y2 = region.get_bbox()
+    return dc.CompoundObject(shape, dc.Text(x1, y2 + 2, region.name,
+                                            color=color, fontsize=10))
+
+
+def calc_stats(values):
+    """Return a Bunch of statistics of the finite values in `values`."""
+    values = values[numpy.isfinite(values)]
+    if len(values) == 0:
+        raise RegionError("No valid pixels")
+    values = values.astype(numpy.float64)
+    return Bunch.Bunch(npix=len(values), mean=values.mean(),
+                       median=numpy.median(values), stddev=values.std(),
+                       min=values.min(), max=values.max())
+
+#END
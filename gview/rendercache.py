@@ -0,0 +1,255 @@
+#
+# rendercache.py -- cache of rendered viewer output
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+A least-recently-used cache of rendered RGB output, shared by all viewers.
+
+The cache is attached to a ginga viewer by wrapping its `get_rgb_object`
+and `auto_levels` methods.  A render is looked up under a key made of
+every image on the viewer's canvas (by version, see `get_token`), the
+window size, pan, scale, transforms, cut levels and a digest of the color
+map, so a viewer showing a buffer at a view that was rendered recently,
+by any viewer, gets the RGB output back without rendering.  Auto cut
+levels are cached in the same way, keyed by image version and auto cuts
+method, since they cost as much as the render for large images.
+
+Entries are evicted, oldest use first, when the total size of the cached
+renders exceeds `max_bytes`.
+
+Viewers of ginga 3.0 and later have no `get_rgb_object`; only their auto
+cut levels are cached.
+"""
+import hashlib
+import itertools
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy
+
+from ginga import RGBMap
+
+
+class _FixedCuts(object):
+    """Stands in for an auto cuts object, to apply cached levels through
+    the viewer's own auto_levels().
+    """
+
+    def __init__(self, loval, hival):
+        self.cuts = (loval, hival)
+
+    def calc_cut_levels(self, image):
+        return self.cuts
+
+
+class RenderCache(object):
+
+    # view settings that affect the rendered output
+    view_keys = ('pan', 'pan_coord', 'scale', 'rot_deg', 'flip_x', 'flip_y',
+                 'swap_xy', 'cuts', 'interpolation')
+
+    # canvas image object attributes that affect the rendered output
+    image_attrs = ('x', 'y', 'alpha', 'scale_x', 'scale_y', 'flipy',
+                   'interpolation')
+
+    def __init__(self, logger, max_bytes=128 * 1024 ** 2, max_cuts=256):
+        self.logger = logger
+        self.max_bytes = max_bytes
+        self.max_cuts = max_cuts
+        self.lock = threading.RLock()
+
+        self.renders = OrderedDict()
+        self.cuts = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        # version tokens of images, and digests of rgb maps
+        self._counter = itertools.count(1)
+        self._tokens = weakref.WeakKeyDictionary()
+        self._digests = weakref.WeakKeyDictionary()
+        # viewers that need a full render after being given a cached one
+        self._dirty = weakref.WeakKeyDictionary()
+        self._warned = False
+
+    def get_token(self, image):
+        """Return a number identifying the current contents of `image`.
+        It changes whenever the image is modified, and is never reused.
+        """
+        with self.lock:
+            token = self._tokens.get(image, None)
+            if token is None:
+                token = next(self._counter)
+                self._tokens[image] = token
+                image.add_callback('modified', self._image_modified_cb)
+            return token
+
+    def _image_modified_cb(self, image):
+        with self.lock:
+            self._tokens[image] = next(self._counter)
+
+    def _get_rgbmap_digest(self, rgbmap):
+        with self.lock:
+            digest = self._digests.get(rgbmap, None)
+            if digest is None:
+                dist = rgbmap.get_dist()
+                md5 = hashlib.md5()
+                md5.update(type(dist).__name__.encode())
+                for arr in (rgbmap.arr, rgbmap.sarr, dist.hash):
+                    if arr is not None:
+                        md5.update(numpy.ascontiguousarray(arr).tobytes())
+                digest = md5.hexdigest()
+                if rgbmap not in self._digests:
+                    rgbmap.add_callback('changed', self._rgbmap_changed_cb)
+                self._digests[rgbmap] = digest
+            return digest
+
+    def _rgbmap_changed_cb(self, rgbmap):
+        with self.lock:
+            # recomputed on next use
+            self._digests[rgbmap] = None
+
+    def _get_images(self, canvas, res):
+        # same walk as ImageViewBase.overlay_images()
+        if not hasattr(canvas, 'objects'):
+            return
+        for obj in canvas.get_objects():
+            if hasattr(obj, 'draw_image'):
+                image = obj.get_image()
+                if image is None:
+                    continue
+                res.append((self.get_token(image),) + tuple(
+                    [getattr(obj, name, None) for name in self.image_attrs]))
+            elif obj.is_compound() and (obj != canvas):
+                self._get_images(obj, res)
+
+    def get_view_key(self, gw):
+        """Return the cache key for what viewer `gw` would render now, or
+        None if its output should not be cached.
+        """
+        rgbmap = gw.get_rgbmap()
+        if rgbmap.get_dist().__class__.__name__.startswith('Histogram'):
+            # histogram equalization depends on the data being rendered
+            return None
+        images = []
+        self._get_images(gw.get_canvas(), images)
+        if len(images) == 0:
+            return None
+
+        settings = gw.get_settings()
+        view = tuple([repr(settings.get(name, None))
+                      for name in self.view_keys])
+        return (tuple(images), gw.get_window_size(), gw.get_rgb_order(),
+                repr(gw.img_bg), view, self._get_rgbmap_digest(rgbmap))
+
+    def get_render(self, key):
+        """Return the (RGB output, window position) cached under `key`,
+        or None.
+        """
+        with self.lock:
+            render = self.renders.get(key, None)
+            if render is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # most recently used goes to the end
+            del self.renders[key]
+            self.renders[key] = render
+            return render
+
+    def put_render(self, key, rgbobj, dst):
+        # the viewer reuses its arrays, so keep our own copy
+        order = rgbobj.get_order()
+        rgbobj = RGBMap.RGBPlanes(numpy.copy(rgbobj.get_array(order)),
+                                  order)
+        nbytes = rgbobj.rgbarr.nbytes
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.renders:
+                self.num_bytes -= self.renders.pop(key)[0].rgbarr.nbytes
+            self.renders[key] = (rgbobj, dst)
+            self.num_bytes += nbytes
+            while self.num_bytes > self.max_bytes:
+                _key, old = self.renders.popitem(last=False)
+                self.num_bytes -= old[0].rgbarr.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.renders = OrderedDict()
+            self.cuts = OrderedDict()
+            self.num_bytes = 0
+            self.hits = self.misses = 0
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            while self.num_bytes > self.max_bytes and len(self.renders) > 0:
+                _key, old = self.renders.popitem(last=False)
+                self.num_bytes -= old[0].rgbarr.nbytes
+
+    def get_stats(self):
+        with self.lock:
+            return dict(renders=len(self.renders), cuts=len(self.cuts),
+                        num_bytes=self.num_bytes, max_bytes=self.max_bytes,
+                        hits=self.hits, misses=self.misses)
+
+    def attach(self, gw):
+        """Make viewer `gw` use the cache."""
+        auto_levels = gw.auto_levels
+        get_rgb_object = getattr(gw, 'get_rgb_object', None)
+        if get_rgb_object is None and not self._warned:
+            self._warned = True
+            self.logger.info("this ginga's viewers can't use the render "
+                             "cache; caching cut levels only")
+
+        def _get_rgb_object(whence=0):
+            if whence >= 3:
+                # nothing but the graphics overlays changed
+                return get_rgb_object(whence=whence)
+
+            key = self.get_view_key(gw)
+            if key is not None:
+                render = self.get_render(key)
+                if render is not None:
+                    rgbobj, (gw._dst_x, gw._dst_y) = render
+                    gw._rgbobj = rgbobj
+                    # the viewer's intermediate results do not match
+                    # what is shown now; the next render starts afresh
+                    self._dirty[gw] = True
+                    return rgbobj
+
+            if self._dirty.pop(gw, False):
+                whence = 0
+            rgbobj = get_rgb_object(whence=whence)
+            if key is not None:
+                self.put_render(key, rgbobj, (gw._dst_x, gw._dst_y))
+            return rgbobj
+
+        def _auto_levels(autocuts=None):
+            image = gw.get_image()
+            if autocuts is not None or image is None:
+                return auto_levels(autocuts=autocuts)
+
+            settings = gw.get_settings()
+            key = (self.get_token(image), str(gw.autocuts),
+                   repr(settings.get('autocut_params', None)))
+            with self.lock:
+                cuts = self.cuts.get(key, None)
+            if cuts is not None:
+                return auto_levels(autocuts=_FixedCuts(*cuts))
+
+            auto_levels()
+            with self.lock:
+                self.cuts[key] = gw.get_cut_levels()
+                while len(self.cuts) > self.max_cuts:
+                    self.cuts.popitem(last=False)
+
+        if get_rgb_object is not None:
+            gw.get_rgb_object = _get_rgb_object
+        gw.auto_levels = _auto_levels
+
+#END
@@ -0,0 +1,290 @@
+#
+# session.py -- save and restore buffers and viewers
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Save the state of a gview session to a directory and restore it.
+
+A session directory holds `session.json`, describing the buffers and
+viewers, and one .npy file for each buffer whose data did not come
+unchanged from a file.  Buffers read from files are recorded by path,
+with the data type policy they were read with, and cubes also by the
+plane shown.
+
+Restored buffers are placeholders (`LazyBuffer`) until first used: the
+buffer store (see buffers.py) loads a buffer when it is looked up, from
+its file or by memory mapping its .npy file.  Only the buffers shown in
+viewers are loaded during the restore.
+"""
+import os
+import json
+import time
+import shutil
+
+import numpy
+
+from ginga import AstroImage
+
+from gview import cube, storage
+
+session_version = 1
+session_file = 'session.json'
+
+
+class SessionError(Exception):
+    pass
+
+
+def get_default_path():
+    return os.path.join(os.path.expanduser('~'), '.gview', 'session')
+
+
+class LazyBuffer(object):
+    """Stands in for a restored buffer until it is needed."""
+
+    def __init__(self, record, session_dir, logger):
+        self.record = record
+        self.session_dir = session_dir
+        self.logger = logger
+        self.width = record.get('width', 0)
+        self.height = record.get('height', 0)
+
+    def get(self, key, alt=None):
+        # enough of the image interface for listing buffers
+        if key == 'path':
+            return self.record.get('path', alt)
+        return alt
+
+    def load(self):
+        rec = self.record
+        if rec['source'] in ('file', 'cube'):
+            image = _load_file(rec['path'], rec.get('policy', 'native'),
+                               self.logger)
+            if rec['source'] == 'cube' and \
+                   isinstance(image, cube.CubeImage):
+                image.set_plane(rec.get('plane', 0))
+        else:
+            image = AstroImage.AstroImage(logger=self.logger)
+            path = os.path.join(self.session_dir, rec['file'])
+            # copy-on-write, so changes never reach the session file
+            data = numpy.load(path, mmap_mode='c')
+            image.set_data(data)
+            image.update_keywords(dict(rec.get('keywords', [])))
+            image.set(name=rec['name'], path=None)
+        if 'processing' in rec:
+            image.set(processing=list(rec['processing']))
+        return image
+
+
+def _load_file(path, policy, logger):
+    # read the way 'rd' does
+    image = storage.ScaledImage(logger=logger)
+    try:
+        storage.load_file(image, path, policy=policy)
+    except storage.CubeError:
+        image = cube.CubeImage(logger=logger)
+        cube.load_file(image, path, policy=policy)
+    except storage.StorageError as e:
+        logger.info("%s; loading it as is" % (str(e)))
+        image.load_file(path)
+    return image
+
+
+def _keyword_list(image):
+    res = []
+    header = image.get_header()
+    for kwd in header.keys():
+        value = header[kwd]
+        if isinstance(value, numpy.generic):
+            value = value.item()
+        if not isinstance(value, (bool, int, float, str)):
+            value = str(value)
+        res.append([kwd, value])
+    return res
+
+
+def _same_file(path1, path2):
+    return os.path.abspath(path1) == os.path.abspath(path2)
+
+
+def _replace_file(path, write_fn):
+    # write a new file and rename it over the old one: a buffer may still
+    # be memory mapped from the old file, and a crash while saving must
+    # not leave a broken session behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as out_f:
+        write_fn(out_f)
+    os.rename(tmp_path, path)
+
+
+def _copy_file(src_path, out_f):
+    with open(src_path, 'rb') as in_f:
+        shutil.copyfileobj(in_f, out_f)
+
+
+def get_view_state(gw):
+    rgbmap = gw.get_rgbmap()
+    flip_x, flip_y, swap_xy = gw.get_transforms()
+    return dict(pan=[float(v) for v in gw.get_pan()[:2]],
+                pan_coord=gw.get_settings().get('pan_coord', 'data'),
+                scale=[float(v) for v in gw.get_scale_xy()],
+                cuts=[float(v) for v in gw.get_cut_levels()],
+                cmap=rgbmap.get_cmap().name,
+                imap=rgbmap.get_imap().name,
+                dist=rgbmap.get_hash_algorithm(),
+                rot_deg=float(gw.get_rotation()),
+                transforms=[bool(flip_x), bool(flip_y), bool(swap_xy)])
+
+
+def set_view_state(gw, state):
+    with gw.suppress_redraw:
+        gw.transform(*state['transforms'])
+        gw.rotate(state['rot_deg'])
+        gw.set_color_map(state['cmap'])
+        gw.set_intensity_map(state['imap'])
+        gw.set_color_algorithm(state['dist'])
+        gw.scale_to(*state['scale'])
+        pan_x, pan_y = state['pan']
+        gw.set_pan(pan_x, pan_y, coord=state['pan_coord'])
+        gw.cut_levels(*state['cuts'])
+
+
+def save_session(zv, path):
+    """Save the buffers and viewers of ZView `zv` in directory `path`.
+    Returns the number of buffers written out as .npy files.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    buffers = []
+    names_by_id = {}
+    keep_files = set([session_file])
+    num_written = 0
+    # the buffers as they are now, even if changed by other threads
+    # while saving
+    snap = zv.buffers.snapshot()
+    for name in sorted(snap.keys()):
+        image = snap[name]
+        if isinstance(image, LazyBuffer):
+            # never loaded: the record is still good, but the data may
+            # have to be copied from another session directory
+            rec = dict(image.record)
+            if rec['source'] == 'npy':
+                keep_files.add(rec['file'])
+                src_path = os.path.join(image.session_dir, rec['file'])
+                dst_path = os.path.join(path, rec['file'])
+                if not _same_file(src_path, dst_path):
+                    _replace_file(dst_path,
+                                  lambda f: _copy_file(src_path, f))
+                    num_written += 1
+            buffers.append(rec)
+            continue
+
+        names_by_id[id(image)] = name
+        rec = dict(name=name, width=image.width, height=image.height,
+                   processing=image.get('processing', []))
+        source = zv.get_buffer_source(name, snap=snap)
+        if source is not None and source['kind'] in ('file', 'cube'):
+            rec.update(source=source['kind'], path=source['path'],
+                       policy=source['policy'])
+            if source['kind'] == 'cube':
+                rec['plane'] = image.plane
+        else:
+            filename = 'buf_%s.npy' % (name)
+            keep_files.add(filename)
+            rec.update(source='npy', file=filename,
+                       keywords=_keyword_list(image))
+            dst_path = os.path.join(path, filename)
+            if source is None or not _same_file(source['path'], dst_path):
+                # (a restored, unchanged buffer is already there)
+                data = image.get_data()
+                _replace_file(dst_path, lambda f: numpy.save(f, data))
+                num_written += 1
+        buffers.append(rec)
+
+    viewers = []
+    for name in sorted(zv.viewers.keys()):
+        viewer = zv.viewers[name]
+        gw = viewer.gw
+        # the size to make the viewer with, not that of its image area
+        width, height = viewer.get_size()
+        rec = dict(name=name, width=width, height=height, buffer=None)
+        image = gw.get_image()
+        if image is not None:
+            rec['buffer'] = names_by_id.get(id(image), None)
+            rec['view'] = get_view_state(gw)
+        viewers.append(rec)
+
+    current = None
+    if zv._view is not None:
+        current = zv._view.name
+    d = dict(version=session_version,
+             time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+             cwd=zv.cwd, current_viewer=current,
+             buffers=buffers, viewers=viewers)
+
+    text = json.dumps(d, indent=1, sort_keys=True)
+    _replace_file(os.path.join(path, session_file),
+                  lambda f: f.write(text.encode('utf-8')))
+
+    # remove blobs of buffers that no longer exist
+    for filename in os.listdir(path):
+        if filename.endswith('.npy') and filename not in keep_files:
+            os.remove(os.path.join(path, filename))
+
+    return num_written
+
+
+def load_session(zv, path):
+    """Restore the session saved in directory `path` into ZView `zv`.
+    Buffers are restored lazily; only the ones shown in viewers are
+    loaded.
+    """
+    filepath = os.path.join(path, session_file)
+    if not os.path.exists(filepath):
+        raise SessionError("No session saved in '%s'" % (path))
+    with open(filepath, 'r') as in_f:
+        d = json.load(in_f)
+    if d.get('version', None) != session_version:
+        raise SessionError("Unknown session version: %s" % (
+            d.get('version', None)))
+
+    for rec in d['buffers']:
+        name = rec['name']
+        zv.buffers[name] = LazyBuffer(rec, path, zv.logger)
+        if rec['source'] in ('file', 'cube'):
+            zv.set_buffer_source(name, rec['source'], rec['path'],
+                                 policy=rec.get('policy', 'native'))
+        else:
+            zv.set_buffer_source(name, 'npy',
+                                 os.path.join(path, rec['file']))
+
+    for rec in d['viewers']:
+        name = rec['name']
+        if name in zv.viewers:
+            viewer = zv.viewers[name]
+        else:
+            viewer = zv.make_viewer(name, width=rec['width'],
+                                    height=rec['height'])
+        bufname = rec.get('buffer', None)
+        if bufname is None or bufname not in zv.buffers:
+            continue
+        gw = viewer.gw
+        gw.set_image(zv.buffers[bufname])
+        try:
+            set_view_state(gw, rec['view'])
+        except Exception as e:
+            zv.logger.warning("Error restoring view of '%s': %s" % (
+                name, str(e)))
+
+    current = d.get('current_viewer', None)
+    if current in zv.viewers:
+        zv._view = zv.viewers[current]
+    if os.path.isdir(d.get('cwd', '')):
+        zv.set_cwd(d['cwd'])
+
+    return len(d['buffers']), len(d['viewers'])
+
+#END
@@ -0,0 +1,277 @@
+#
+# storage.py -- how the pixels of a buffer are kept in memory
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Read FITS images into buffers using a chosen in-memory data type.
+
+The usual way of loading has astropy apply BSCALE/BZERO, which turns
+16-bit camera data into floating point (2-4 times the memory), and keeps
+the big-endian byte order of the file, so that every later conversion
+makes another copy.  `load_file` reads the raw pixels instead, swaps their
+bytes in place, and then stores them according to a policy:
+
+    native   keep the integers as they are; 16-bit data with BZERO=32768
+             becomes uint16, and any other scaling is applied lazily
+    float32  apply the scaling into a float32 array
+    float64  apply the scaling into a float64 array
+
+Pixels equal to the BLANK value of integer data are undefined; as when
+astropy scales the data, they become NaN wherever the data is converted
+to floating point.  Integers kept as they are keep their BLANK value
+instead, and are then converted lazily like scaled ones.
+
+A lazily scaled buffer is a `ScaledImage`: every cutout of it is scaled
+as it is taken, so the viewer and the analysis commands only ever convert
+the pixels they look at.
+"""
+import numpy
+
+from ginga import AstroImage
+from ginga.util import iohelper
+
+policies = ('native', 'float32', 'float64')
+
+
+class StorageError(Exception):
+    pass
+
+
+class CubeError(StorageError):
+    """The data has more than two dimensions (see cube.py)."""
+    pass
+
+
+def to_native(data):
+    """Return `data` in the native byte order, swapping it in place if
+    possible rather than making a copy.
+    """
+    if data.dtype.isnative:
+        return data
+    if data.flags.writeable:
+        data.byteswap(True)
+        return data.view(data.dtype.newbyteorder('='))
+    return data.astype(data.dtype.newbyteorder('='))
+
+
+def get_nbytes(image):
+    """Return the memory used by the pixels of `image`."""
+    if isinstance(image, ScaledImage):
+        return image.get_raw_data().nbytes
+    data = image.get_data()
+    if data is None:
+        return 0
+    return data.nbytes
+
+
+class ScaledImage(AstroImage.AstroImage):
+    """An image whose pixels are kept as raw values along with the
+    BSCALE/BZERO that give the physical ones, and the BLANK value of
+    undefined pixels (or None).  Data taken out of it, by cutouts or
+    get_data(), comes out scaled, with NaN for undefined pixels.
+    """
+
+    def __init__(self, data_np=None, metadata=None, logger=None,
+                 name=None, **kwdargs):
+        self.bscale = 1.0
+        self.bzero = 0.0
+        self.blank = None
+        super(ScaledImage, self).__init__(data_np=data_np, metadata=metadata,
+                                          logger=logger, name=name,
+                                          **kwdargs)
+
+    def set_data(self, data_np, metadata=None, astype=None, bscale=1.0,
+                 bzero=0.0, blank=None):
+        self.bscale = bscale
+        self.bzero = bzero
+        self.blank = blank
+        super(ScaledImage, self).set_data(data_np, metadata=metadata,
+                                          astype=astype)
+
+    @property
+    def shape(self):
+        # not through _get_data(), which would scale the whole image
+        return self._data.shape
+
+    def is_scaled(self):
+        return ((self.bscale != 1.0) or (self.bzero != 0.0) or
+                (self.blank is not None))
+
+    def get_raw_data(self):
+        return self._data
+
+    def get_storage(self):
+        """Return a short description of how the pixels are kept."""
+        if self.is_scaled():
+            return "%s*" % (self._data.dtype.name)
+        return self._data.dtype.name
+
+    def _scale(self, raw):
+        if not self.is_scaled():
+            return raw
+        dtype = numpy.float32
+        if raw.dtype.itemsize > 2:
+            # float32 can't hold 32-bit integers exactly
+            dtype = numpy.float64
+        data = raw.astype(dtype)
+        if self.bscale != 1.0:
+            data *= dtype(self.bscale)
+        if self.bzero != 0.0:
+            data += dtype(self.bzero)
+        if self.blank is not None:
+            data[raw == self.blank] = numpy.nan
+        return data
+
+    def _slice(self, view):
+        return self._scale(self._data[view])
+
+    def get_data(self):
+        # scaling the whole image is expensive; code that only needs part
+        # of it should use cutout_data()
+        return self._scale(self._data)
+
+    _get_data = get_data
+
+    def copy_data(self):
+        if self.is_scaled():
+            return self.get_data()
+        return self._data.copy()
+
+    def _set_minmax(self):
+        if not self.is_scaled():
+            return super(ScaledImage, self)._set_minmax()
+        # the scaling is linear, so scale the limits of the raw values
+        # (integers have no NaNs or infinities, but may be blank)
+        raw = self._data
+        if self.blank is not None:
+            raw = raw[raw != self.blank]
+        if raw.size == 0:
+            lo = hi = 0.0
+        else:
+            lo, hi = self._scale(numpy.array([raw.min(), raw.max()]))
+            lo, hi = min(lo, hi), max(lo, hi)
+        self.minval = self.minval_noinf = lo
+        self.maxval = self.maxval_noinf = hi
+
+
+def _find_image_hdu(fits_f):
+    for i, hdu in enumerate(fits_f):
+        if hdu.is_image and hdu.header.get('NAXIS', 0) >= 2:
+            return i, hdu
+    return None, None
+
+
+def get_shape(header):
+    """Return the shape of the data described by FITS `header`, without
+    degenerate leading axes (e.g. NAXIS3 = 1).
+    """
+    shape = [header.get('NAXIS%d' % (i + 1), 0)
+             for i in range(header.get('NAXIS', 0))][::-1]
+    while len(shape) > 2 and shape[0] == 1:
+        shape = shape[1:]
+    return tuple(shape)
+
+
+def get_scaling(header):
+    """Return the (bscale, bzero, blank) of the data described by FITS
+    `header`; `blank` is None if the data has no undefined pixels.
+    """
+    bscale = float(header.get('BSCALE', 1.0))
+    bzero = float(header.get('BZERO', 0.0))
+    blank = header.get('BLANK', None)
+    if header.get('BITPIX', 8) < 0:
+        # BLANK is only defined for integer data
+        blank = None
+    return bscale, bzero, blank
+
+
+def convert(data, bscale, bzero, policy, blank=None):
+    """Return raw FITS pixels `data` in native byte order, stored
+    according to `policy`, and the scaling left to apply lazily as
+    (data, bscale, bzero, blank).  Pixels equal to `blank` become NaN
+    if the data is converted to floating point.
+    """
+    data = to_native(data)
+    if blank is not None and data.dtype.kind in 'iu':
+        blank = data.dtype.type(blank)
+    else:
+        blank = None
+    if policy == 'native':
+        if (data.dtype == numpy.int16 and bscale == 1.0 and
+                bzero == 32768.0):
+            # the FITS convention for unsigned 16-bit data; adding
+            # 32768 just flips the sign bit
+            if not data.flags.writeable:
+                data = data.copy()
+            data = data.view(numpy.uint16)
+            data ^= numpy.uint16(0x8000)
+            bscale, bzero = 1.0, 0.0
+            if blank is not None:
+                blank = blank.view(numpy.uint16) ^ numpy.uint16(0x8000)
+        elif data.dtype.kind == 'f' and (bscale != 1.0 or bzero != 0.0):
+            data = data * bscale + bzero
+            bscale, bzero = 1.0, 0.0
+    else:
+        mask = None
+        if blank is not None:
+            mask = (data == blank)
+        dtype = numpy.dtype(policy)
+        if data.dtype != dtype or not data.flags.writeable:
+            data = data.astype(dtype)
+        if bscale != 1.0:
+            data *= dtype.type(bscale)
+        if bzero != 0.0:
+            data += dtype.type(bzero)
+        if mask is not None:
+            data[mask] = numpy.nan
+        bscale, bzero, blank = 1.0, 0.0, None
+    return data, bscale, bzero, blank
+
+
+def copy_header(image, hdu):
+    """Copy the header of astropy HDU `hdu` into the header of `image`."""
+    if hasattr(image.io, 'copy_header'):
+        image.io.copy_header(hdu, image.get_header())
+    else:
+        # ginga < 3
+        image.io.fromHDU(hdu, image.get_header())
+
+
+def load_file(image, path, policy='native'):
+    """Read the first image in FITS file `path` into ScaledImage `image`,
+    storing the pixels according to `policy` (see above).  Raises
+    CubeError, before reading any data, if the image has more than two
+    dimensions.
+    """
+    from astropy.io import fits
+
+    if policy not in policies:
+        raise StorageError("Unknown data type policy: '%s'" % (policy))
+
+    # not memory mapped, so the array is ours to byte swap in place
+    with fits.open(path, 'readonly', memmap=False,
+                   do_not_scale_image_data=True) as fits_f:
+        idx, hdu = _find_image_hdu(fits_f)
+        if hdu is None:
+            raise StorageError("No image data found in '%s'" % (path))
+        header = hdu.header
+        shape = get_shape(header)
+        if len(shape) != 2:
+            raise CubeError("'%s' has %d dimensions" % (path, len(shape)))
+        bscale, bzero, blank = get_scaling(header)
+
+        data, bscale, bzero, blank = convert(hdu.data.reshape(shape),
+                                             bscale, bzero, policy,
+                                             blank=blank)
+
+        image.clear_metadata()
+        copy_header(image, hdu)
+        image.wcs.load_header(header, fobj=fits_f)
+
+    image.set_data(data, bscale=bscale, bzero=bzero, blank=blank)
+    image.set(name=iohelper.name_image_from_path(path), path=path, idx=idx)
+    return image
+
+#END
@@ -0,0 +1,113 @@
+#
+# synthetic.py -- synthetic star field images
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Generate reproducible synthetic star fields for benchmarking and
+trying out gview without real data.
+
+Example:
+    data, header, stars = make_star_field(2048, 2048, seed=1)
+    write_fits('/tmp/field.fits', data, header)
+"""
+import numpy
+
+
+def make_wcs_header(width, height, ra_deg=150.0, dec_deg=2.0,
+                    scale_arcsec=0.2):
+    """Return a dict of keywords for a simple TAN projection centered
+    on the image, with `scale_arcsec` arcsec pixels and north up.
+    """
+    cdelt = scale_arcsec / 3600.0
+    return dict(CTYPE1='RA---TAN', CTYPE2='DEC--TAN',
+                CRVAL1=ra_deg, CRVAL2=dec_deg,
+                CRPIX1=width / 2.0 + 0.5, CRPIX2=height / 2.0 + 0.5,
+                CD1_1=-cdelt, CD1_2=0.0, CD2_1=0.0, CD2_2=cdelt,
+                CUNIT1='deg', CUNIT2='deg',
+                RADESYS='FK5', EQUINOX=2000.0)
+
+
+def make_star_field(width, height, dtype='float32', density=1.0e-4,
+                    fwhm=3.0, sky=1000.0, noise=10.0, peak_range=(500.0,
+                    30000.0), seed=0, wcs=True):
+    """Make a star field image.
+
+    Parameters
+    ----------
+    width, height : int
+        Dimensions of the image.
+    dtype : str
+        Numpy dtype of the returned data; integer types are clipped to
+        their range.
+    density : float
+        Number of stars per pixel.
+    fwhm : float
+        FWHM of the Gaussian PSF in pixels.
+    sky, noise : float
+        Sky level and standard deviation of the Gaussian noise.
+    peak_range : tuple
+        Range of star peak values; peaks follow a power law so faint
+        stars dominate.
+    seed : int
+        Seed for the random generator; the same arguments always give
+        the same image.
+    wcs : bool
+        Include a TAN WCS in the header.
+
+    Returns
+    -------
+    data, header, stars : ndarray, dict, ndarray
+        The image, its header keywords and an (N, 3) array of the star
+        positions (0-based x, y) and peak values.
+    """
+    rs = numpy.random.RandomState(seed)
+
+    data = rs.normal(sky, noise, size=(height, width)).astype(numpy.float32)
+
+    num_stars = int(round(density * width * height))
+    xs = rs.uniform(0, width - 1, num_stars)
+    ys = rs.uniform(0, height - 1, num_stars)
+    lo, hi = peak_range
+    peaks = lo * (hi / lo) ** (rs.uniform(0.0, 1.0, num_stars) ** 2)
+
+    # add each star over a stamp about 3 FWHM in radius
+    sigma = fwhm / 2.3548
+    rad = int(numpy.ceil(3 * fwhm))
+    offsets = numpy.arange(-rad, rad + 1)
+    for x, y, peak in zip(xs, ys, peaks):
+        xc, yc = int(round(x)), int(round(y))
+        x1, x2 = max(0, xc - rad), min(width, xc + rad + 1)
+        y1, y2 = max(0, yc - rad), min(height, yc + rad + 1)
+        dx = offsets[x1 - (xc - rad):x2 - (xc - rad)] + xc - x
+        dy = offsets[y1 - (yc - rad):y2 - (yc - rad)] + yc - y
+        gx = numpy.exp(-0.5 * (dx / sigma) ** 2)
+        gy = numpy.exp(-0.5 * (dy / sigma) ** 2)
+        data[y1:y2, x1:x2] += peak * numpy.outer(gy, gx)
+
+    dtype = numpy.dtype(dtype)
+    if dtype.kind in ('i', 'u'):
+        info = numpy.iinfo(dtype)
+        data = numpy.clip(numpy.round(data), info.min, info.max)
+    data = data.astype(dtype)
+
+    header = dict(OBJECT='SYNTHETIC', EXPTIME=1.0, SEED=seed,
+                  NSTARS=num_stars, PSFFWHM=fwhm, SKYLEVEL=sky)
+    if wcs:
+        header.update(make_wcs_header(width, height))
+
+    stars = numpy.array([xs, ys, peaks]).T
+    return data, header, stars
+
+
+def write_fits(path, data, header):
+    """Write `data` with keywords from `header` to a FITS file."""
+    from astropy.io import fits
+
+    hdu = fits.PrimaryHDU(data)
+    for kwd, value in header.items():
+        hdu.header[kwd] = value
+    hdu.writeto(path, overwrite=True)
+
+#END
@@ -0,0 +1,253 @@
+#
+# timing.py -- low-overhead latency instrumentation
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Per-operation latency histograms for commands, key handlers, file loads
+and renders.
+
+Recording a measurement costs two clock reads, a logarithm and a couple
+of increments, so the instrumentation is always on.  Latencies are kept
+in logarithmic bins about 10% wide, which bounds the memory used per
+operation and gives percentiles to within a bin width.
+
+Optionally, operations can also be run under cProfile.  Only one in
+every `profile_every` calls of each operation is profiled, and the
+statistics of the most recent profiled call are kept for display.
+"""
+import math
+import time
+import threading
+import functools
+import cProfile
+import pstats
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+# high resolution clock, if we have one
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class Histogram(object):
+    """Latency histogram with logarithmic bins from 1 usec upward."""
+
+    min_latency = 1.0e-6
+    base = 1.1
+    num_bins = 250
+    _log_base = math.log(base)
+
+    def __init__(self):
+        self.counts = [0] * self.num_bins
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, elapsed):
+        if elapsed <= self.min_latency:
+            idx = 0
+        else:
+            idx = int(math.log(elapsed / self.min_latency) /
+                      self._log_base) + 1
+            idx = min(idx, self.num_bins - 1)
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += elapsed
+        self.last = elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def percentile(self, pct):
+        """Return the latency below which `pct` percent of the
+        measurements fall (the upper edge of the bin that contains it).
+        """
+        if self.count == 0:
+            return 0.0
+        target = self.count * pct / 100.0
+        cum = 0
+        for idx, num in enumerate(self.counts):
+            cum += num
+            if cum >= target:
+                break
+        upper = self.min_latency * self.base ** idx
+        return min(upper, self.max)
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+
+class _Measurement(object):
+
+    def __init__(self, timing, name):
+        self.timing = timing
+        self.name = name
+        self.prof = None
+
+    def __enter__(self):
+        if self.timing.profiling:
+            self.prof = self.timing._start_profile(self.name)
+        self.time_start = clock()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = clock() - self.time_start
+        if self.prof is not None:
+            self.timing._stop_profile(self.name, self.prof)
+        self.timing.record(self.name, elapsed)
+        return False
+
+
+class Timing(object):
+    """Registry of latency histograms, keyed by operation name."""
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+        # cProfile sampling
+        self.profiling = False
+        self.profile_every = 1
+        self.profile_limit = 25
+        self.profiles = {}
+        self._profile_active = False
+
+    def measure(self, name):
+        """Return a context manager that records the time spent in its
+        body under operation `name`.
+        """
+        return _Measurement(self, name)
+
+    def record(self, name, elapsed):
+        with self.lock:
+            hist = self.histograms.get(name, None)
+            if hist is None:
+                hist = Histogram()
+                self.histograms[name] = hist
+            hist.add(elapsed)
+
+    def instrument(self, obj, attrname, name):
+        """Replace method `attrname` on instance `obj` with a version that
+        records its latency under operation `name`.
+        """
+        method = getattr(obj, attrname)
+
+        @functools.wraps(method)
+        def _timed_method(*args, **kwdargs):
+            with self.measure(name):
+                return method(*args, **kwdargs)
+
+        setattr(obj, attrname, _timed_method)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.profiles = {}
+
+    def set_profiling(self, tf, every=1):
+        """Turn cProfile sampling on or off.  When on, one out of every
+        `every` calls of each operation is profiled.
+        """
+        self.profiling = tf
+        self.profile_every = max(1, int(every))
+
+    def _start_profile(self, name):
+        with self.lock:
+            # profilers cannot be nested; only profile the outermost
+            # operation
+            if self._profile_active:
+                return None
+            hist = self.histograms.get(name, None)
+            count = 0 if hist is None else hist.count
+            if count % self.profile_every != 0:
+                return None
+            self._profile_active = True
+
+        prof = cProfile.Profile()
+        prof.enable()
+        return prof
+
+    def _stop_profile(self, name, prof):
+        prof.disable()
+        with self.lock:
+            self._profile_active = False
+
+        out_f = StringIO()
+        stats = pstats.Stats(prof, stream=out_f)
+        stats.sort_stats('cumulative').print_stats(self.profile_limit)
+        self.profiles[name] = out_f.getvalue()
+
+    def get_profile(self, name):
+        return self.profiles.get(name, None)
+
+    def get_stats(self, name):
+        """Return a tuple of (count, p50, p95, max, mean) latencies in
+        seconds for operation `name`.
+        """
+        with self.lock:
+            hist = self.histograms[name]
+            return (hist.count, hist.percentile(50), hist.percentile(95),
+                    hist.max, hist.mean())
+
+    def get_report(self, prefix=None):
+        """Return a text table of the latency statistics, in msec."""
+        with self.lock:
+            names = sorted(self.histograms.keys())
+        if prefix is not None:
+            names = [name for name in names if name.startswith(prefix)]
+
+        res = ["%-28.28s %7s %10s %10s %10s" % (
+            'operation', 'count', 'p50 ms', 'p95 ms', 'max ms')]
+        for name in names:
+            count, p50, p95, maxval, mean = self.get_stats(name)
+            res.append("%-28.28s %7d %10.2f %10.2f %10.2f" % (
+                name, count, p50 * 1000.0, p95 * 1000.0, maxval * 1000.0))
+        return '\n'.join(res)
+
+
+class StartupReport(object):
+    """Records when each phase of application startup finished, for the
+    `--startup-report` option.
+    """
+
+    def __init__(self, time_start=None):
+        if time_start is None:
+            time_start = clock()
+        self.time_start = time_start
+        self.phases = []
+        self.finished = False
+
+    def mark(self, name):
+        """Note that phase `name` has just finished."""
+        self.phases.append((name, clock()))
+
+    def get_report(self):
+        res = ["%-36.36s %10s %10s" % ('startup phase', 'ms', 'total ms')]
+        time_prev = self.time_start
+        for name, time_done in self.phases:
+            res.append("%-36.36s %10.1f %10.1f" % (
+                name, (time_done - time_prev) * 1000.0,
+                (time_done - self.time_start) * 1000.0))
+            time_prev = time_done
+        return '\n'.join(res)
+
+
+def timed(name):
+    """Decorator for methods of objects having a `timing` attribute that
+    records the latency of each call under operation `name`.
+    """
+    def _decorator(method):
+        @functools.wraps(method)
+        def _timed_method(self, *args, **kwdargs):
+            with self.timing.measure(name):
+                return method(self, *args, **kwdargs)
+        return _timed_method
+    return _decorator
+
+#END
@@ -0,0 +1,192 @@
+#
+# track.py -- follow a star through a stream of frames
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Follow the position and size of a star over many consecutive frames, e.g.
+to check guiding.
+
+The star is found once with the full object finding; after that only a
+small box around the position predicted from the last two frames is cut
+out of each new frame.  The centroid is the center of gravity of the
+pixels above a quarter of the peak (over the background, the median of
+the box), and the FWHM comes from the number of pixels above half the
+peak.  This takes a few tens of microseconds for a box of 20-30 pixels,
+so tracking keeps up with any readout rate; the slow part, plotting, is
+done separately at a limited rate.
+
+A `Tracker` follows a buffer by name and measures every new frame put
+into it, whether the image of the buffer is modified or replaced (it
+listens to the buffer store, see buffers.py).  The measurements are
+appended to arrays that grow as needed.
+"""
+import math
+
+import numpy
+
+from ginga.misc import Bunch
+
+from gview.timing import clock
+
+columns = ('time', 'x', 'y', 'fwhm', 'peak')
+
+
+def measure(data, x1, y1):
+    """Return (x, y, fwhm, peak) of the star in cutout `data`, whose first
+    pixel is at `x1`, `y1`, or None if there is no star in it.
+    """
+    bg = numpy.median(data)
+    peak = data.max() - bg
+    if not peak > 0:
+        return None
+
+    # center of gravity of the upper part of the star
+    wts = data - (bg + 0.25 * peak)
+    wts[wts < 0] = 0.0
+    total = wts.sum()
+    ht, wd = data.shape
+    x = numpy.dot(wts.sum(axis=0), numpy.arange(wd)) / total + x1
+    y = numpy.dot(wts.sum(axis=1), numpy.arange(ht)) / total + y1
+
+    # area above half maximum is pi * (fwhm / 2) ** 2
+    area = numpy.count_nonzero(data > bg + 0.5 * peak)
+    fwhm = 2.0 * math.sqrt(area / math.pi)
+    return (float(x), float(y), fwhm, float(peak))
+
+
+class Tracker(object):
+    """Tracks the star at `x`, `y` with FWHM `fwhm` in buffer `name` of
+    BufferStore `store`; each frame is measured in a box of `radius`
+    pixels (by default twice the FWHM) around the predicted position.
+    """
+
+    def __init__(self, store, name, x, y, fwhm, radius=None, timing=None):
+        self.store = store
+        self.name = name
+        self.timing = timing
+        if radius is None:
+            radius = max(5, int(round(2.0 * fwhm)))
+        self.radius = radius
+
+        self.num_frames = 0
+        self.num_lost = 0
+        self._data = numpy.empty((1024, len(columns)))
+        self._len = 0
+        self._new = False
+        self.x0, self.y0 = x, y
+        self.add(clock(), (x, y, fwhm, numpy.nan))
+
+        self.active = True
+        store.add_callback('modified', self.modified_cb)
+        store.add_callback('added', self.added_cb)
+
+    def stop(self):
+        self.active = False
+        for name, fn in (('modified', self.modified_cb),
+                         ('added', self.added_cb)):
+            if hasattr(self.store, 'remove_callback'):
+                self.store.remove_callback(name, fn)
+            else:
+                # ginga 2.6 can only clear all the callbacks of a kind
+                try:
+                    self.store.cb[name].remove((fn, (), {}))
+                except (KeyError, ValueError):
+                    pass
+
+    def add(self, t, res):
+        if self._len == len(self._data):
+            self._data = numpy.concatenate([self._data,
+                                            numpy.empty(self._data.shape)])
+        self._data[self._len] = (t,) + tuple(res)
+        self._len += 1
+        self._new = True
+
+    def predict(self):
+        """Return the expected position of the star in the next frame,
+        extrapolating from the last two frames in which it was found.
+        """
+        data = self._data
+        start = max(0, self._len - 8)
+        found = numpy.flatnonzero(numpy.isfinite(data[start:self._len, 1]))
+        if len(found) == 0:
+            return self.x0, self.y0
+        i = start + found[-1]
+        x, y = data[i, 1:3]
+        if len(found) > 1 and found[-2] == found[-1] - 1:
+            # moving at the same speed as from the frame before
+            x, y = 2 * x - data[i - 1, 1], 2 * y - data[i - 1, 2]
+        return x, y
+
+    def modified_cb(self, store, name, what, version):
+        if self.active and name == self.name and what == 'data':
+            self.update()
+
+    def added_cb(self, store, name, version):
+        # (the buffer was removed and read again)
+        if self.active and name == self.name:
+            self.update()
+
+    def update(self):
+        """Measure the star in the current frame."""
+        if self.name not in self.store:
+            return
+        image = self.store[self.name]
+        time_start = clock()
+        x, y = self.predict()
+        wd, ht = image.get_size()
+        x, y, r = int(round(x)), int(round(y)), self.radius
+        x1, y1 = max(0, x - r), max(0, y - r)
+        x2, y2 = min(wd, x + r + 1), min(ht, y + r + 1)
+
+        res = None
+        if x2 - x1 > 2 and y2 - y1 > 2:
+            data = image.cutout_data(x1, y1, x2, y2, astype=float)
+            res = measure(data, x1, y1)
+        self.num_frames += 1
+        if res is None:
+            self.num_lost += 1
+            res = (numpy.nan,) * 4
+        self.add(time_start, res)
+
+        if self.timing is not None:
+            self.timing.record('analysis.track', clock() - time_start)
+
+    def get_series(self):
+        """Return the measurements as a Bunch of arrays (see `columns`);
+        the first row is the initial position.
+        """
+        data = self._data[:self._len]
+        return Bunch.Bunch([(name, data[:, i])
+                            for i, name in enumerate(columns)])
+
+    def has_new(self):
+        """Return True if there are measurements not yet seen since the
+        last call.
+        """
+        res, self._new = self._new, False
+        return res
+
+    def get_stats(self):
+        """Return a Bunch with the drift of the star since the start and
+        the scatter of its position and FWHM.
+        """
+        data = self._data[1:self._len]
+        data = data[numpy.isfinite(data[:, 1])]
+        res = Bunch.Bunch(frames=self.num_frames, lost=self.num_lost)
+        if len(data) == 0:
+            return res
+        res.update(dict(x=data[-1, 1], y=data[-1, 2],
+                        dx=data[-1, 1] - self.x0, dy=data[-1, 2] - self.y0,
+                        rms_x=data[:, 1].std(), rms_y=data[:, 2].std(),
+                        fwhm=numpy.median(data[:, 3])))
+        return res
+
+    def save(self, path):
+        data = self._data[:self._len].copy()
+        data[:, 0] -= data[0, 0]
+        numpy.savetxt(path, data, fmt='%.6f',
+                      header=' '.join(columns))
+
+#END
@@ -0,0 +1,77 @@
+#
+# viewsync.py -- keep the pan, zoom and cuts of viewers in step
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Propagate pan, zoom and cut level changes from one viewer to the others.
+
+Each viewer's settings get a callback when they are first added.  A change
+in one viewer is copied to the others through the usual viewer methods,
+so each of them only redraws as much as that change requires (a cut
+level change does not cut out the image again, for example).
+"""
+from gview.blink import get_setting
+
+
+class ViewSync(object):
+
+    # the settings that are synchronized
+    keys = ('pan', 'scale', 'cuts')
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.enabled = False
+        self.viewers = []
+        self._busy = False
+
+    def add_viewer(self, gw):
+        if gw in self.viewers:
+            return
+        self.viewers.append(gw)
+        settings = gw.get_settings()
+        for key in self.keys:
+            get_setting(settings, key).add_callback('set', self.changed_cb,
+                                                    gw, key)
+
+    def remove_viewer(self, gw):
+        # the callbacks stay registered, but do nothing for viewers that
+        # are no longer in the list
+        if gw in self.viewers:
+            self.viewers.remove(gw)
+
+    def set_enabled(self, tf):
+        self.enabled = tf
+
+    def changed_cb(self, setting, value, src_gw, key):
+        # _busy keeps the changes we make from being propagated back
+        if not self.enabled or self._busy or src_gw not in self.viewers:
+            return
+        self._busy = True
+        try:
+            for gw in self.viewers:
+                if gw is src_gw or gw.get_image() is None:
+                    continue
+                self.copy_setting(src_gw, gw, key, value)
+        except Exception as e:
+            self.logger.error("Error synchronizing viewers: %s" % (str(e)))
+        finally:
+            self._busy = False
+
+    def copy_setting(self, src_gw, dst_gw, key, value):
+        if key == 'pan':
+            coord = src_gw.get_settings().get('pan_coord', 'data')
+            dst_gw.set_pan(value[0], value[1], coord=coord)
+        elif key == 'scale':
+            dst_gw.scale_to(value[0], value[1])
+        elif key == 'cuts':
+            dst_gw.cut_levels(value[0], value[1])
+
+    def sync_to(self, src_gw):
+        """Make all viewers match `src_gw` now."""
+        for key in self.keys:
+            value = src_gw.get_settings().get(key)
+            self.changed_cb(None, value, src_gw, key)
+
+#END
@@ -32,7 +32,7 @@ setup(
     packages = ['gview',
                 ],
     package_data = {},
-    scripts = ['scripts/gview'],
+    scripts = ['scripts/gview', 'scripts/gview-export'],
     install_requires = ['ginga>=2.5'],
     classifiers=[
           'Intended Audience :: Science/Research',
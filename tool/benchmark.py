@@ -0,0 +1,331 @@
+#! /usr/bin/env python
+#
+# benchmark.py -- headless performance benchmarks for gview
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.txt for details.
+#
+"""
+Time the main gview code paths on synthetic star fields of several sizes,
+without a display.  The viewer is an offscreen PIL-backed ginga viewer.
+
+Usage:
+    python tool/benchmark.py [options]
+
+Examples:
+    python tool/benchmark.py --sizes=1024,4096 --output=before.json
+    (make changes)
+    python tool/benchmark.py --sizes=1024,4096 --output=after.json \\
+        --compare=before.json
+
+Results are written as JSON so that runs can be compared; `--compare`
+prints the ratio of each median time against an earlier run.
+"""
+from __future__ import print_function
+import sys
+import os
+import json
+import time
+import platform
+import logging
+import collections
+from optparse import OptionParser
+
+import numpy
+
+# run from a source checkout without installing
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+from gview import GView, ZView, synthetic, timing, version
+
+
+class HeadlessLabel(object):
+    """Stands in for the readout label of a viewer."""
+
+    def __init__(self):
+        self.text = ''
+
+    def set_text(self, text):
+        self.text = text
+
+
+class HeadlessHistory(object):
+    """Stands in for the command history text widget."""
+
+    def __init__(self, limit):
+        self.lines = collections.deque(maxlen=limit)
+
+    def append_text(self, text, autoscroll=True):
+        self.lines.append(text)
+
+
+class HeadlessViewer(object):
+    """Offscreen stand-in for GView.FitsViewer."""
+
+    # share the readout code of the real viewer
+    motion = vars(GView.FitsViewer)['motion']
+
+    def __init__(self, name, logger, width, height):
+        from ginga.pilw.ImageViewPil import CanvasView
+
+        self.name = name
+        self.logger = logger
+        fi = CanvasView(logger=logger)
+        fi.enable_autocuts('on')
+        fi.set_autocut_params('zscale')
+        fi.enable_autozoom('on')
+        fi.configure_surface(width, height)
+        self.gw = fi
+        self.readout = HeadlessLabel()
+
+    def get_size(self):
+        return self.gw.get_window_size()
+
+
+class HeadlessGView(object):
+    """Offscreen stand-in for GView.GView, hosting a ZView."""
+
+    # share the history logging code of the real application
+    log = vars(GView.GView)['log']
+
+    def __init__(self, logger, histlimit=5000):
+        self.logger = logger
+        self.timing = timing.Timing(logger)
+        self.hist_w = HeadlessHistory(histlimit)
+        self.zv = ZView.ZView(logger, self)
+        # time the renders where they happen
+        self.zv.render_in_thread = False
+
+    def make_viewer(self, name, width=900, height=1000):
+        return HeadlessViewer(name, self.logger, width, height)
+
+    def exec_shell(self, cmd_str):
+        pass
+
+
+def get_test_file(workdir, size, dtype, options):
+    """Return the path of the synthetic image for `size`, creating it if
+    needed.  Files are named after their parameters so they are reused
+    between runs.
+    """
+    name = "synth_%d_%s_d%g_n%g_s%d.fits" % (size, dtype, options.density,
+                                              options.noise, options.seed)
+    path = os.path.join(workdir, name)
+    data, header, stars = synthetic.make_star_field(
+        size, size, dtype=dtype, density=options.density,
+        noise=options.noise, seed=options.seed, wcs=True)
+    if not os.path.exists(path):
+        synthetic.write_fits(path, data, header)
+    return path, stars
+
+
+def pick_stars(stars, size, num=20):
+    """Pick isolated, unsaturated stars well inside the image."""
+    margin = 30
+    ok = ((stars[:, 0] > margin) & (stars[:, 0] < size - margin) &
+          (stars[:, 1] > margin) & (stars[:, 1] < size - margin) &
+          (stars[:, 2] < 20000.0))
+    stars = stars[ok]
+    stars = stars[numpy.argsort(stars[:, 2])[::-1]]
+    return stars[:num, :2]
+
+
+def make_benchmarks(gv, path, stars, size):
+    """Return a list of (name, fn) pairs; each fn performs one timed
+    operation.
+    """
+    zv = gv.zv
+    rs = numpy.random.RandomState(0)
+
+    def bench_rd():
+        zv.cmd_rd('bench', path)
+
+    def bench_v():
+        zv.cmd_v('bench')
+        zv._view.gw.redraw_now(whence=0)
+
+    positions = pick_stars(stars, size)
+    state = dict(i=0)
+
+    def next_position():
+        x, y = positions[state['i'] % len(positions)]
+        state['i'] += 1
+        return x, y
+
+    def bench_find_objects():
+        x, y = next_position()
+        try:
+            zv.find_objects(zv._view.gw, x, y)
+        except Exception:
+            pass
+
+    reports = []
+
+    def bench_make_report():
+        if len(reports) == 0:
+            image = zv._view.gw.get_image()
+            for x, y in positions:
+                try:
+                    qs = zv.find_objects(zv._view.gw, x, y)[0]
+                    reports.append((image, qs))
+                except Exception:
+                    pass
+        image, qs = reports[state['i'] % len(reports)]
+        state['i'] += 1
+        zv.make_report(image, qs)
+
+    mouse = rs.uniform(0, size - 1, size=(1000, 2))
+
+    def bench_motion():
+        x, y = mouse[state['i'] % len(mouse)]
+        state['i'] += 1
+        zv._view.motion(zv._view.gw, None, x, y)
+
+    def bench_log():
+        gv.log("gview> rd bench %s" % (path), w_time=True)
+
+    return [('cmd_rd', bench_rd),
+            ('cmd_v', bench_v),
+            ('find_objects', bench_find_objects),
+            ('make_report', bench_make_report),
+            ('motion', bench_motion),
+            ('log', bench_log),
+            ]
+
+
+def run_benchmark(fn, repeat, min_time):
+    """Call `fn` at least `repeat` times and for at least `min_time` sec
+    after one untimed warm-up call; return the list of elapsed times.
+    """
+    fn()
+    times = []
+    time_start = timing.clock()
+    while len(times) < repeat or timing.clock() - time_start < min_time:
+        t1 = timing.clock()
+        fn()
+        times.append(timing.clock() - t1)
+    return times
+
+
+def summarize(times):
+    arr = numpy.array(times) * 1000.0
+    return dict(n=len(arr), min_ms=float(arr.min()),
+                median_ms=float(numpy.median(arr)),
+                mean_ms=float(arr.mean()), max_ms=float(arr.max()))
+
+
+def compare(results, baseline, threshold):
+    """Print the ratio of each median time to that of the same benchmark
+    in `baseline`.
+    """
+    old = dict([((r['name'], r['size'], r['dtype']), r)
+                for r in baseline['results']])
+    print("%-14s %6s %8s %10s %10s %7s" % (
+        'benchmark', 'size', 'dtype', 'old ms', 'new ms', 'ratio'))
+    for r in results['results']:
+        key = (r['name'], r['size'], r['dtype'])
+        if key not in old:
+            continue
+        t_old, t_new = old[key]['median_ms'], r['median_ms']
+        ratio = t_new / t_old if t_old > 0 else float('inf')
+        flag = ''
+        if ratio > 1.0 + threshold:
+            flag = 'SLOWER'
+        elif ratio < 1.0 - threshold:
+            flag = 'faster'
+        print("%-14s %6d %8s %10.3f %10.3f %7.2f %s" % (
+            r['name'], r['size'], r['dtype'], t_old, t_new, ratio, flag))
+
+
+def main(options, args):
+    logger = logging.getLogger('benchmark')
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.ERROR)
+
+    workdir = options.workdir
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    sizes = [int(s) for s in options.sizes.split(',')]
+    only = None
+    if options.only is not None:
+        only = options.only.split(',')
+
+    results = dict(meta=dict(date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                             gview=version.version,
+                             python=platform.python_version(),
+                             numpy=numpy.__version__,
+                             platform=platform.platform(),
+                             density=options.density, noise=options.noise,
+                             seed=options.seed, repeat=options.repeat),
+                   results=[])
+    try:
+        import ginga
+        results['meta']['ginga'] = ginga.__version__
+    except (ImportError, AttributeError):
+        pass
+
+    for size in sizes:
+        path, stars = get_test_file(workdir, size, options.dtype, options)
+        gv = HeadlessGView(logger)
+        gv.zv.make_viewer('bench')
+
+        for name, fn in make_benchmarks(gv, path, stars, size):
+            if only is not None and name not in only:
+                continue
+            times = run_benchmark(fn, options.repeat, options.min_time)
+            res = summarize(times)
+            res.update(dict(name=name, size=size, dtype=options.dtype))
+            results['results'].append(res)
+            print("%-14s %6d %8s  median %10.3f ms  (n=%d)" % (
+                name, size, options.dtype, res['median_ms'], res['n']),
+                file=sys.stderr)
+
+    if options.output is not None:
+        with open(options.output, 'w') as out_f:
+            json.dump(results, out_f, indent=2, sort_keys=True)
+    elif options.compare is None:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    if options.compare is not None:
+        with open(options.compare, 'r') as in_f:
+            baseline = json.load(in_f)
+        compare(results, baseline, options.threshold)
+
+
+if __name__ == "__main__":
+    usage = "usage: %prog [options]"
+    optprs = OptionParser(usage=usage)
+    optprs.add_option("--sizes", dest="sizes", default="512,1024,2048,4096",
+                      help="Comma separated list of image sizes (pixels)")
+    optprs.add_option("--dtype", dest="dtype", default="float32",
+                      help="Data type of the synthetic images")
+    optprs.add_option("--density", dest="density", type="float",
+                      default=1.0e-4, help="Stars per pixel")
+    optprs.add_option("--noise", dest="noise", type="float", default=10.0,
+                      help="Standard deviation of the noise")
+    optprs.add_option("--seed", dest="seed", type="int", default=0,
+                      help="Random seed for the synthetic images")
+    optprs.add_option("--repeat", dest="repeat", type="int", default=10,
+                      help="Minimum number of timed calls per benchmark")
+    optprs.add_option("--min-time", dest="min_time", type="float",
+                      default=0.5,
+                      help="Minimum time (sec) to run each benchmark")
+    optprs.add_option("--only", dest="only", default=None,
+                      help="Comma separated list of benchmarks to run")
+    optprs.add_option("--workdir", dest="workdir",
+                      default=os.path.join('/tmp', 'gview_bench'),
+                      help="Directory for the synthetic FITS files")
+    optprs.add_option("-o", "--output", dest="output", default=None,
+                      help="Write JSON results to this file")
+    optprs.add_option("--compare", dest="compare", default=None,
+                      help="Compare against the JSON results in this file")
+    optprs.add_option("--threshold", dest="threshold", type="float",
+                      default=0.1,
+                      help="Relative change flagged when comparing")
+
+    (options, args) = optprs.parse_args(sys.argv[1:])
+    main(options, args)
+
+#END